@@ -56,6 +56,17 @@ class Backend:
     """Records a new drink with the given parameters."""
     raise NotImplementedError
 
+  def RecordDrinks(self, batch):
+    """Records several drinks at once, eg pours replayed after an outage.
+
+    Args
+      batch: a list of dicts, each of the keyword arguments to RecordDrink
+    Returns
+      a list with a result for each item: the new drink, None for a spill, or
+      the BackendError rejecting it
+    """
+    raise NotImplementedError
+
   def CancelDrink(self, seqn, spilled=False):
     """Cancels the given drink.
 
@@ -65,10 +76,32 @@ class Backend:
     """
     raise NotImplementedError
 
+  def WaitForPostProcess(self, seqn, timeout=0, refresh=None):
+    """Returns whether stats and events include the given drink.
+
+    Drinks are post-processed asynchronously when KEGBOT_ASYNC_POSTPROCESS is
+    set; this waits up to `timeout` seconds for that to happen.  A worker's
+    commit may not be visible within the caller's transaction; if given,
+    `refresh` is called before each check to start a new one.
+    """
+    raise NotImplementedError
+
   def LogSensorReading(self, sensor_name, temperature, when=None):
     """Records a new sensor reading."""
     raise NotImplementedError
 
+  def LogSensorReadings(self, readings):
+    """Records several sensor readings at once, eg from a board with many probes.
+
+    Args
+      readings: a list of (sensor_name, temperature, when) tuples, as the
+          arguments to LogSensorReading
+    Returns
+      a list with a result for each reading: the recorded reading, or the
+      ValueError rejecting it
+    """
+    raise NotImplementedError
+
   def GetAuthToken(self, auth_device, token_value):
     """Returns an AuthenticationToken instance."""
     raise NotImplementedError
@@ -22,10 +22,13 @@ from __future__ import absolute_import
 
 import datetime
 import logging
+import time
 
 from django.conf import settings
+from pykeg.core import commit_hooks
 from pykeg.core import kb_common
 from pykeg.core import models
+from pykeg.core import thermostore
 
 from . import backend
 
@@ -43,27 +46,25 @@ class KegbotBackend(backend.Backend):
       self._site = models.KegbotSite.objects.get(name=sitename)
 
   def _GetTapFromName(self, tap_name):
-    try:
-      return models.KegTap.objects.get(site=self._site, meter_name=tap_name)
-    except models.KegTap.DoesNotExist:
-      return None
+    return models.TapConfig.ForSite(self._site).GetTap(tap_name)
 
   def _GetKegForTapName(self, tap_name):
     tap = self._GetTapFromName(tap_name)
-    if tap and tap.current_keg and tap.current_keg.status == 'online':
+    if tap:
+      return self._TapKeg(tap)
+    return None
+
+  def _TapKeg(self, tap):
+    if tap.current_keg and tap.current_keg.status == 'online':
       return tap.current_keg
     return None
 
   def _GetSensorFromName(self, name, autocreate=True):
-    try:
-      return models.ThermoSensor.objects.get(site=self._site, raw_name=name)
-    except models.ThermoSensor.DoesNotExist:
-      if autocreate:
-        sensor = models.ThermoSensor(site=self._site, raw_name=name, nice_name=name)
-        sensor.save()
-        return sensor
-      else:
-        return None
+    sensor = models.TapConfig.ForSite(self._site).GetSensor(name)
+    if sensor is None and autocreate:
+      sensor = models.ThermoSensor(site=self._site, raw_name=name, nice_name=name)
+      sensor.save()
+    return sensor
 
   def _GetUserObjFromUsername(self, username):
     try:
@@ -106,43 +107,96 @@ class KegbotBackend(backend.Backend):
     tap = self._GetTapFromName(tap_name)
     if not tap:
       raise backend.BackendError("Tap unknown")
+    user = self._GetDrinker(username)
 
-    if volume_ml is None:
-      volume_ml = float(ticks) * tap.ml_per_tick
+    d = self._NewDrink(tap, ticks, volume_ml, user, pour_time, duration,
+        auth_token, spilled, shout)
+    if d is None:
+      return
+
+    models.DrinkingSession.AssignSessionForDrink(d)
+    d.save()
+    if do_postprocess:
+      if settings.HAVE_CELERY and settings.KEGBOT_ASYNC_POSTPROCESS:
+        # Acknowledge the drink now; a worker catches up on stats and events,
+        # once the drink is committed.
+        commit_hooks.Add(tasks.postprocess_drinks.delay, self._site)
+        return d
+      d.PostProcess()
+      event_list = [e for e in models.SystemEvent.objects.filter(drink=d).order_by('id')]
+      if settings.HAVE_CELERY:
+        tasks.handle_new_events.delay(self._site, event_list)
+
+    return d
+
+  def RecordDrinks(self, batch, do_postprocess=True):
+    results = [None] * len(batch)
+    taps = {}
+    users = {}
+    pending = []
+    for i, item in enumerate(batch):
+      item = dict(item)
+      tap_name = item.pop('tap_name')
+      if tap_name not in taps:
+        taps[tap_name] = self._GetTapFromName(tap_name)
+      tap = taps[tap_name]
+      if not tap:
+        results[i] = backend.BackendError("Tap unknown")
+        continue
+      username = item.pop('username', None)
+      if username not in users:
+        users[username] = self._GetDrinker(username)
+      d = self._NewDrink(tap, user=users[username], **item)
+      if d is not None:
+        pending.append((i, d))
+
+    drinks = models.Drink.SaveMany(d for i, d in pending)
+    models.DrinkingSession.AssignSessionsForDrinks(drinks)
+    by_seqn = dict((d.seqn, d) for d in drinks)
+    for i, d in pending:
+      results[i] = by_seqn[d.seqn]
+
+    if do_postprocess and drinks:
+      if settings.HAVE_CELERY and settings.KEGBOT_ASYNC_POSTPROCESS:
+        commit_hooks.Add(tasks.postprocess_drinks.delay, self._site)
+        return results
+      models.Drink.PostProcessDrinks(drinks)
+      event_list = list(models.SystemEvent.objects.filter(
+          drink__in=drinks).order_by('id'))
+      if settings.HAVE_CELERY:
+        tasks.handle_new_events.delay(self._site, event_list)
+
+    return results
 
-    user = None
+  def _GetDrinker(self, username):
     if username:
-      user = self._GetUserObjFromUsername(username)
-    elif self._site.settings.default_user:
-      user = self._site.settings.default_user
+      return self._GetUserObjFromUsername(username)
+    return models.TapConfig.ForSite(self._site).settings.default_user
+
+  def _NewDrink(self, tap, ticks, volume_ml=None, user=None, pour_time=None,
+      duration=0, auth_token=None, spilled=False, shout=''):
+    """Returns a new, unsaved Drink poured from `tap`.
+
+    A spill is added to the keg's spilled_ml in the database, and None is
+    returned.  The keg is shared by TapConfig, so it is never saved here.
+    """
+    if volume_ml is None:
+      volume_ml = float(ticks) * tap.ml_per_tick
 
     if not pour_time:
       pour_time = datetime.datetime.now()
 
-    keg = None
-    if tap.current_keg and tap.current_keg.status == 'online':
-      keg = tap.current_keg
-
+    keg = self._TapKeg(tap)
     if spilled:
       if not keg:
         self._logger.warning('Got spilled pour for tap missing keg; ignoring')
-        return
-      keg.spilled_ml += volume_ml
-      keg.save()
-      return
+        return None
+      keg.AddSpilledVolume(volume_ml)
+      return None
 
-    d = models.Drink(ticks=ticks, site=self._site, keg=keg, user=user,
+    return models.Drink(ticks=ticks, site=self._site, keg=keg, user=user,
         volume_ml=volume_ml, time=pour_time, duration=duration,
         auth_token=auth_token, shout=shout)
-    models.DrinkingSession.AssignSessionForDrink(d)
-    d.save()
-    if do_postprocess:
-      d.PostProcess()
-      event_list = [e for e in models.SystemEvent.objects.filter(drink=d).order_by('id')]
-      if settings.HAVE_CELERY:
-        tasks.handle_new_events.delay(self._site, event_list)
-
-    return d
 
   def CancelDrink(self, seqn, spilled=False):
     try:
@@ -150,69 +204,102 @@ class KegbotBackend(backend.Backend):
     except models.Drink.DoesNotExist:
       return
 
+    # Only the call that changes the status subtracts the drink; a repeated
+    # or concurrent cancel would otherwise subtract it again.
+    if d.status != 'valid' or not models.Drink.objects.filter(pk=d.pk,
+        status='valid').update(status='deleted'):
+      return d
+
     keg = d.keg
     user = d.user
     session = d.session
 
     # Transfer volume to spillage if requested.
     if spilled and d.volume_ml and d.keg:
-      d.keg.spilled_ml += d.volume_ml
-      d.keg.save()
+      d.keg.AddSpilledVolume(d.volume_ml)
 
+    # Saved as well, so that the keg's served volume is updated.
     d.status = 'deleted'
     d.save()
 
-    # Invalidate all statistics.
-    models.SystemStats.objects.filter(site=self._site).delete()
-    models.KegStats.objects.filter(site=self._site, keg=d.keg).delete()
-    models.UserStats.objects.filter(site=self._site, user=d.user).delete()
-    models.SessionStats.objects.filter(site=self._site, session=d.session).delete()
+    # Subtract the drink from each affected statistics record.  A drink not yet
+    # post-processed isn't in any, and now never will be.
+    records = []
+    if d.postprocessed:
+      records.extend(models.SystemStats.objects.filter(site=self._site))
+    if d.postprocessed and keg:
+      records.extend(models.KegStats.objects.filter(site=self._site, keg=keg))
+    if d.postprocessed and user:
+      records.extend(models.UserStats.objects.filter(site=self._site, user=user))
+    if d.postprocessed and session:
+      records.extend(models.SessionStats.objects.filter(site=self._site,
+          session=session))
+    for record in records:
+      record.Revert(d)
 
     # Delete any SystemEvents for this drink.
     models.SystemEvent.objects.filter(site=self._site, drink=d).delete()
 
-    # Regenerate new statistics, based on the most recent drink
-    # post-cancellation.
-    last_qs = self._site.drinks.valid().order_by('-seqn')
-    if last_qs:
-      last_drink = last_qs[0]
-      last_drink._UpdateSystemStats()
-
-    if keg:
-      keg.RecomputeStats()
-    if user and user.get_profile():
-      user.get_profile().RecomputeStats()
     if session:
-      session.Rebuild()
-      session.RecomputeStats()
-
-    # TODO(mikey): recompute session.
+      session.RemoveDrink(d)
     return d
 
-  def LogSensorReading(self, sensor_name, temperature, when=None):
-    if not when:
-      when = datetime.datetime.now()
+  def WaitForPostProcess(self, seqn, timeout=0, refresh=None):
+    deadline = time.time() + timeout
+    while True:
+      if refresh and time.time() < deadline:
+        refresh()
+      drinks = self._site.drinks.filter(seqn=seqn)
+      if not drinks.exists():
+        raise backend.BackendError('Drink unknown')
+      if drinks.filter(postprocessed=True).exists():
+        return True
+      if time.time() >= deadline:
+        return False
+      time.sleep(0.1)
 
-    # The maximum resolution of ThermoSensor records is 1 minute.  Round the
-    # time down to the nearest minute; if a record already exists for this time,
-    # replace it.
-    when = when.replace(second=0, microsecond=0)
+  def LogSensorReading(self, sensor_name, temperature, when=None):
+    result = self.LogSensorReadings([(sensor_name, temperature, when)])[0]
+    if isinstance(result, ValueError):
+      raise result
+    return result
 
-    # If the temperature is out of bounds, reject it.
+  def LogSensorReadings(self, readings):
+    now = datetime.datetime.now()
     min_val = kb_common.THERMO_SENSOR_RANGE[0]
     max_val = kb_common.THERMO_SENSOR_RANGE[1]
-    if temperature < min_val or temperature > max_val:
-      raise ValueError('Temperature out of bounds')
-
-    sensor = self._GetSensorFromName(sensor_name)
-    defaults = {
-        'temp': temperature,
-    }
-    record, created = models.Thermolog.objects.get_or_create(site=self._site,
-        sensor=sensor, time=when, defaults=defaults)
-    record.temp = temperature
-    record.save()
-    return record
+    results = [None] * len(readings)
+    sensors = {}
+    pending = []
+    for i, (sensor_name, temperature, when) in enumerate(readings):
+      # If the temperature is out of bounds, reject it.
+      if temperature < min_val or temperature > max_val:
+        results[i] = ValueError('Temperature out of bounds')
+        continue
+      if sensor_name not in sensors:
+        sensors[sensor_name] = self._GetSensorFromName(sensor_name)
+      # The maximum resolution of ThermoSensor records is 1 minute.  Round the
+      # time down to the nearest minute; if a record already exists for this
+      # time, replace it.
+      when = (when or now).replace(second=0, microsecond=0)
+      pending.append((i, models.Thermolog(site=self._site,
+          sensor=sensors[sensor_name], temp=temperature, time=when)))
+
+    if thermostore.Enabled():
+      for i, record in pending:
+        record.seqn = thermostore.ToMinute(record.time)
+        if not thermostore.ForSensor(record.sensor).Put(record.time,
+            record.temp):
+          models.ThermoSummaryLog.AddReading(record)
+        results[i] = record
+      return results
+
+    saved = models.Thermolog.SaveMany([record for i, record in pending])
+    for (i, record), log in zip(pending, saved):
+      results[i] = log
+    if not settings.HAVE_CELERY:
+      models.Thermolog.PurgeOldIfDue()
+    return results
 
   def GetAuthToken(self, auth_device, token_value):
     if token_value and auth_device in kb_common.AUTH_MODULE_NAMES_HEX_VALUES:
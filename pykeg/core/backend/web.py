@@ -48,6 +48,9 @@ class WebBackend(backend.Backend):
         duration=duration, auth_token=auth_token, spilled=spilled,
         shout=shout)
 
+  def RecordDrinks(self, batch):
+    return self._client.RecordDrinks(batch)
+
   def CancelDrink(self, seqn, spilled=False):
     return self._client.CancelDrink(seqn, spilled)
 
@@ -70,6 +73,16 @@ class WebBackend(backend.Backend):
       self._logger.warning('Socket error recording temperature; dropping reading.')
       return None
 
+  def LogSensorReadings(self, readings):
+    try:
+      return self._client.LogSensorReadings(readings)
+    except kbapi.ServerError:
+      self._logger.warning('Server error recording temperatures; dropping readings.')
+      return [None] * len(readings)
+    except socket.error:
+      self._logger.warning('Socket error recording temperatures; dropping readings.')
+      return [None] * len(readings)
+
   def GetAuthToken(self, auth_device, token_value):
     try:
       return self._client.GetToken(auth_device, token_value)
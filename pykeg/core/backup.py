@@ -282,9 +282,14 @@ def restore(input_fp, kbsite, log_cb=_no_log):
     if username:
       drink.user = user_map[username]
     drink.auth_token = rec.get('auth_token')
+    # Stats and events are regenerated below.
+    drink.postprocessed = True
     drink.save()
     _log(drink)
 
+  # Restored records carry their own seqns; start counting from those.
+  models.SequenceCounter.Reset(kbsite)
+
   log_cb('Regenerating sessions ...')
   _RegenSessions(kbsite)
   log_cb('Regenerating stats ...')
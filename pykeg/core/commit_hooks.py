@@ -0,0 +1,67 @@
+# Copyright 2013 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Calls deferred until the current transaction commits.
+
+Django 1.4 has no on-commit hook.  Inside a managed transaction, eg a request
+under TransactionMiddleware, Add() queues the call; CommitHooksMiddleware runs
+the queue once the transaction has been committed, or discards it if the
+request failed.  Outside one, the call is made at once.
+
+This matters for work handed to another process, such as a Celery task, which
+must not start before the rows it reads are visible.
+"""
+
+import logging
+import threading
+
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+def _Queue():
+  queue = getattr(_local, 'queue', None)
+  if queue is None:
+    queue = _local.queue = []
+  return queue
+
+def Add(fn, *args, **kwargs):
+  """Calls `fn(*args, **kwargs)` after the current transaction commits."""
+  if not transaction.is_managed():
+    fn(*args, **kwargs)
+    return
+  call = (fn, args, kwargs)
+  queue = _Queue()
+  if call not in queue:
+    queue.append(call)
+
+def Run():
+  """Makes the queued calls, after the transaction has been committed."""
+  queue = _Queue()
+  while queue:
+    fn, args, kwargs = queue.pop(0)
+    try:
+      fn(*args, **kwargs)
+    except Exception:
+      logger.exception('Error in commit hook %s' % fn)
+
+def Discard():
+  """Drops the queued calls, eg after a rollback."""
+  del _Queue()[:]
@@ -0,0 +1,55 @@
+# Copyright 2013 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unittests for pykeg.core.commit_hooks"""
+
+import unittest
+
+from django.db import transaction
+
+from pykeg.core import commit_hooks
+
+class CommitHooksTestCase(unittest.TestCase):
+  def testAdd(self):
+    calls = []
+    commit_hooks.Add(calls.append, 'now')
+    self.assertEqual(calls, ['now'])
+
+    transaction.enter_transaction_management()
+    transaction.managed(True)
+    try:
+      commit_hooks.Add(calls.append, 'later')
+      commit_hooks.Add(calls.append, 'later')
+      commit_hooks.Add(calls.append, 'other')
+      self.assertEqual(calls, ['now'])
+      transaction.commit()
+    finally:
+      transaction.leave_transaction_management()
+    commit_hooks.Run()
+    self.assertEqual(calls, ['now', 'later', 'other'])
+
+    transaction.enter_transaction_management()
+    transaction.managed(True)
+    try:
+      commit_hooks.Add(calls.append, 'rolled back')
+      transaction.rollback()
+    finally:
+      transaction.leave_transaction_management()
+    commit_hooks.Discard()
+    commit_hooks.Run()
+    self.assertEqual(calls, ['now', 'later', 'other'])
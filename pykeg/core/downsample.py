@@ -0,0 +1,147 @@
+# Copyright 2013 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Downsampling of time series for charts.
+
+Lttb() implements largest-triangle-three-buckets: the points between the first
+and last are split into equal buckets, and from each bucket the point forming
+the largest triangle with the previous pick and the next bucket's mean is kept.
+Peaks and dips survive, which averaging would flatten.
+
+When NumPy is installed, bucket edges and means are computed for all buckets
+at once and each bucket's areas in one expression; otherwise the same
+selection is made in plain Python.
+"""
+
+from pykeg.core.optional_modules import HAVE_NUMPY
+
+if HAVE_NUMPY:
+  import numpy
+
+def _Edges(n, threshold):
+  """Returns the first index of each bucket, and n.
+
+  Bucket 0 is the points after the first, up to bucket 1; the last bucket is
+  the last point alone.
+  """
+  buckets = threshold - 2
+  edges = [k * (n - 2) // buckets + 1 for k in xrange(buckets + 1)]
+  edges.append(n)
+  return edges
+
+def _LttbPython(xs, ys, threshold):
+  edges = _Edges(len(xs), threshold)
+  means = []
+  for lo, hi in zip(edges[1:], edges[2:]):
+    means.append((sum(xs[lo:hi]) / float(hi - lo),
+        sum(ys[lo:hi]) / float(hi - lo)))
+
+  picked = [0]
+  a = 0
+  for i, (cx, cy) in enumerate(means):
+    xa, ya = xs[a], ys[a]
+    best = best_area = None
+    for j in xrange(edges[i], edges[i + 1]):
+      area = abs((xa - cx) * (ys[j] - ya) - (xa - xs[j]) * (cy - ya))
+      if best is None or area > best_area:
+        best, best_area = j, area
+    a = best
+    picked.append(a)
+  picked.append(len(xs) - 1)
+  return picked
+
+def _LttbNumpy(xs, ys, threshold):
+  xs = numpy.asarray(xs, dtype=numpy.float64)
+  ys = numpy.asarray(ys, dtype=numpy.float64)
+  edges = numpy.array(_Edges(len(xs), threshold))
+  counts = numpy.diff(edges)[1:]
+  cxs = numpy.add.reduceat(xs, edges[1:-1]) / counts
+  cys = numpy.add.reduceat(ys, edges[1:-1]) / counts
+
+  picked = [0]
+  a = 0
+  for i in xrange(threshold - 2):
+    lo, hi = edges[i], edges[i + 1]
+    xa, ya = xs[a], ys[a]
+    areas = numpy.abs((xa - cxs[i]) * (ys[lo:hi] - ya) -
+        (xa - xs[lo:hi]) * (cys[i] - ya))
+    a = lo + int(numpy.argmax(areas))
+    picked.append(a)
+  picked.append(len(xs) - 1)
+  return picked
+
+def Lttb(xs, ys, threshold):
+  """Returns the indices of at most `threshold` points to keep, in order."""
+  n = len(xs)
+  if threshold >= n:
+    return range(n)
+  if threshold < 3:
+    return [0, n - 1][:threshold]
+  if HAVE_NUMPY:
+    return _LttbNumpy(xs, ys, threshold)
+  return _LttbPython(xs, ys, threshold)
+
+def Segments(xs, max_gap):
+  """Returns (start, end) index pairs of the runs of `xs` with no gap wider
+  than `max_gap`."""
+  if HAVE_NUMPY:
+    breaks = (numpy.nonzero(numpy.diff(xs) > max_gap)[0] + 1).tolist()
+  else:
+    breaks = [i for i in xrange(1, len(xs)) if xs[i] - xs[i - 1] > max_gap]
+  bounds = [0] + breaks + [len(xs)]
+  return zip(bounds[:-1], bounds[1:])
+
+def Downsample(xs, ys, max_points, max_gap=None):
+  """Returns at most `max_points` (x, y) pairs tracing the series.
+
+  If `max_gap` is given, the series is broken where consecutive xs are further
+  apart than that: each run is downsampled on its own, with points in
+  proportion to its length, and an (x, None) pair marks the gap between runs.
+  Each run takes at least two points, so if there are too many runs for
+  `max_points`, only the widest gaps are kept.
+  """
+  if not xs:
+    return []
+  if max_gap is None:
+    segments = [(0, len(xs))]
+  else:
+    segments = Segments(xs, max_gap)
+  # k runs need up to 2k points and k - 1 gap markers.
+  max_segments = max((max_points + 1) // 3, 1)
+  if len(segments) > max_segments:
+    starts = sorted((lo for lo, hi in segments[1:]),
+        key=lambda lo: xs[lo] - xs[lo - 1], reverse=True)
+    bounds = [0] + sorted(starts[:max_segments - 1]) + [len(xs)]
+    segments = zip(bounds[:-1], bounds[1:])
+  budget = max(max_points - (len(segments) - 1), 1)
+
+  # Each run gets its minimum, and the rest is shared out by length.
+  minimums = [min(hi - lo, 2, budget) for lo, hi in segments]
+  spare = budget - sum(minimums)
+  rest = len(xs) - sum(minimums)
+
+  result = []
+  for (lo, hi), minimum in zip(segments, minimums):
+    if result:
+      result.append(((xs[lo - 1] + xs[lo]) / 2.0, None))
+    points = minimum
+    if rest:
+      points += spare * (hi - lo - minimum) // rest
+    for i in Lttb(xs[lo:hi], ys[lo:hi], points):
+      result.append((xs[lo + i], ys[lo + i]))
+  return result
@@ -0,0 +1,85 @@
+# Copyright 2013 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unittests for pykeg.core.downsample"""
+
+import math
+import unittest
+
+from pykeg.core import downsample
+from pykeg.core.optional_modules import HAVE_NUMPY
+
+class DownsampleTestCase(unittest.TestCase):
+  def setUp(self):
+    self.xs = [float(i) for i in range(1000)]
+    self.ys = [math.sin(i / 50.0) for i in range(1000)]
+    self.ys[333] = 5.0
+
+  def testLttb(self):
+    self.assertEqual(downsample.Lttb(self.xs[:5], self.ys[:5], 10), range(5))
+    self.assertEqual(downsample.Lttb(self.xs, self.ys, 2), [0, 999])
+
+    picked = downsample.Lttb(self.xs, self.ys, 50)
+    self.assertEqual(len(picked), 50)
+    self.assertEqual(picked[0], 0)
+    self.assertEqual(picked[-1], 999)
+    self.assertEqual(picked, sorted(set(picked)))
+    # The spike survives.
+    self.assertTrue(333 in picked)
+
+    if HAVE_NUMPY:
+      for threshold in (3, 7, 50, 999):
+        self.assertEqual(downsample._LttbNumpy(self.xs, self.ys, threshold),
+            downsample._LttbPython(self.xs, self.ys, threshold))
+
+  def testDownsampleGaps(self):
+    xs = self.xs[:300] + self.xs[700:]
+    ys = self.ys[:300] + self.ys[700:]
+    self.assertEqual(downsample.Segments(xs, 1.5), [(0, 300), (300, 600)])
+
+    points = downsample.Downsample(xs, ys, 61, max_gap=1.5)
+    self.assertEqual(len(points), 61)
+    self.assertEqual(points[30], (499.5, None))
+    self.assertEqual(points[0], (0.0, ys[0]))
+    self.assertEqual(points[-1], (999.0, ys[-1]))
+    self.assertEqual(downsample.Downsample([], [], 10), [])
+
+  def testDownsampleManyGaps(self):
+    # 200 runs of 3 points; the gap after every tenth run is the widest.
+    xs = []
+    for run in range(200):
+      start = run * 10.0 + (run // 10) * 100.0
+      xs.extend([start, start + 1, start + 2])
+    ys = [math.sin(x) for x in xs]
+    self.assertEqual(len(downsample.Segments(xs, 1.5)), 200)
+
+    for max_points in (1, 2, 3, 10, 59, 100, 599, 600):
+      points = downsample.Downsample(xs, ys, max_points, max_gap=1.5)
+      self.assertTrue(0 < len(points) <= max_points, max_points)
+      self.assertEqual(points[0], (xs[0], ys[0]))
+      if max_points > 1:
+        self.assertEqual(points[-1], (xs[-1], ys[-1]))
+
+    # Only the widest gaps are marked.
+    points = downsample.Downsample(xs, ys, 59, max_gap=1.5)
+    gaps = [x for x, y in points if y is None]
+    self.assertEqual(len(gaps), 19)
+    self.assertEqual(gaps[0], (xs[29] + xs[30]) / 2.0)
+
+    points = downsample.Downsample(xs, ys, 1000, max_gap=1.5)
+    self.assertEqual(len(points), 799)
@@ -0,0 +1,87 @@
+# Copyright 2013 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Keg depletion forecasting.
+
+Each keg keeps an exponentially-weighted sum of its pours:
+
+  weight = sum(volume_ml * exp((drink time - epoch) / TIME_CONSTANT))
+
+Weighting against a fixed epoch, rather than against the current time, means
+a pour only ever adds a term: Keg.forecast_weight is updated with a single
+increment per drink, and the rate at any later time is found by decaying the
+sum once.  Nothing rescans the keg's drinks.
+
+The epoch is moved forward, scaling the sum to match, once pours get more than
+REBASE_AFTER past it, which keeps the weights in floating point range.
+"""
+
+import datetime
+import math
+
+# Pours this long ago count for 1/e as much as a pour now.
+TIME_CONSTANT = datetime.timedelta(days=7)
+
+# No forecast is made for a keg younger than this.
+MIN_HISTORY = datetime.timedelta(hours=1)
+
+# Predictions further out than this are not made.
+MAX_FORECAST = datetime.timedelta(days=365)
+
+# Pours this far past the epoch move it forward.
+REBASE_AFTER = 10 * TIME_CONSTANT
+
+def _Seconds(delta):
+  return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
+_TAU = _Seconds(TIME_CONSTANT)
+
+def Weight(time, epoch):
+  """Returns the weight of a pour at `time`, relative to `epoch`."""
+  return math.exp(_Seconds(time - epoch) / _TAU)
+
+def Sum(pours):
+  """Returns (epoch, weight) for an iterable of (time, volume_ml) pours."""
+  pours = list(pours)
+  if not pours:
+    return None, 0.0
+  epoch = max(time for time, volume_ml in pours)
+  return epoch, sum(volume_ml * Weight(time, epoch) for time, volume_ml in pours)
+
+def Rate(weight, epoch, start_time, now):
+  """Returns the consumption rate in mL per second at `now`, or None.
+
+  The decayed sum is normalized by the weight a constant rate would have had
+  over the keg's life so far, so a young keg is not under-estimated.
+  """
+  age = _Seconds(now - start_time)
+  if age < _Seconds(MIN_HISTORY):
+    return None
+  decayed = weight * math.exp(-_Seconds(now - epoch) / _TAU)
+  return max(decayed, 0.0) / (_TAU * -math.expm1(-age / _TAU))
+
+def EmptyTime(remaining_ml, rate, now):
+  """Returns when `remaining_ml` runs out at `rate`, or None if not soon."""
+  if remaining_ml <= 0:
+    return now
+  if not rate:
+    return None
+  seconds = remaining_ml / rate
+  if seconds > _Seconds(MAX_FORECAST):
+    return None
+  return now + datetime.timedelta(seconds=seconds)
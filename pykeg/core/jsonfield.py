@@ -25,6 +25,7 @@
 #   - disabled assert in JSONEncoder
 #   - added south introspection rules
 #   - use kbjson common json encode/decode methods
+#   - added LazyJSONField
 
 """
 JSONField automatically serializes most Python terms to JSON data.
@@ -80,6 +81,63 @@ class JSONField(models.TextField):
       return super(JSONField, self).get_db_prep_save(kbjson.dumps(value),
           connection=connection)
 
+class _LazyJSONDescriptor(object):
+  """Holds the stored JSON text of a LazyJSONField, until first read."""
+  def __init__(self, field):
+    self.field = field
+
+  def __get__(self, obj, type=None):
+    if obj is None:
+      raise AttributeError('Can only be accessed via an instance.')
+    value = obj.__dict__[self.field.name]
+    if isinstance(value, basestring):
+      value = self.field.to_python(value)
+      obj.__dict__[self.field.name] = value
+    return value
+
+  def __set__(self, obj, value):
+    obj.__dict__[self.field.name] = value
+
+class LazyJSONField(models.TextField):
+  """A JSONField which decodes its value on first access, not on load.
+
+  The attribute may also be assigned JSON text, which is saved as-is; until
+  the attribute is read, value_to_string() returns that text undecoded.
+  """
+
+  def __init__(self, *args, **kwargs):
+    if 'default' not in kwargs:
+      kwargs['default'] = '{}'
+    models.TextField.__init__(self, *args, **kwargs)
+
+  def contribute_to_class(self, cls, name):
+    super(LazyJSONField, self).contribute_to_class(cls, name)
+    setattr(cls, self.name, _LazyJSONDescriptor(self))
+
+  def to_python(self, value):
+    if not value:
+      return {}
+    elif isinstance(value, basestring):
+      res = kbjson.loads(value)
+      assert isinstance(res, dict)
+      return JSONDict(**res)
+    else:
+      return value
+
+  def value_to_string(self, obj):
+    value = obj.__dict__[self.name]
+    if isinstance(value, basestring):
+      return value
+    return kbjson.dumps(value)
+
+  def get_db_prep_save(self, value, connection):
+    if not value:
+      value = ''
+    elif not isinstance(value, basestring):
+      value = kbjson.dumps(value)
+    return super(LazyJSONField, self).get_db_prep_save(value,
+        connection=connection)
+
 try:
   from south.modelsinspector import add_introspection_rules
 except ImportError:
@@ -88,3 +146,6 @@ else:
   add_introspection_rules([
     ([JSONField], [], {}),
     ], ["^pykeg\.core\.jsonfield\.JSONField"])
+  add_introspection_rules([
+    ([LazyJSONField], [], {}),
+    ], ["^pykeg\.core\.jsonfield\.LazyJSONField"])
@@ -19,33 +19,18 @@
 from django.core.management.base import BaseCommand
 from django.core.management.base import CommandError
 
-import datetime
-
 from pykeg.core import models
 
 
 class Command(BaseCommand):
-  help = u'Deletes any old temperature sensor records'
+  help = (u'Deletes old temperature sensor records.  Run periodically (eg from '
+      'cron) if Celery is not used.')
   args = '<none>'
 
   def handle(self, *args, **options):
     if len(args) != 0:
       raise CommandError('No arguments required')
 
-    now = datetime.datetime.now()
-
-    # keep at least the most recent 24 hours
-    keep_time = now - datetime.timedelta(hours=24)
-
-    # round down to the start of the day
-    keep_date = datetime.datetime(year=keep_time.year, month=keep_time.month,
-        day=keep_time.day)
-
-    print "Deleting entries older than %s" % keep_date
-
-    for sensor in models.ThermoSensor.objects.all():
-      old_entries = sensor.thermolog_set.filter(time__lt=keep_date).order_by('time')
-      print "Sensor: %s" % sensor
-      print "Deleting %s entries ..." % (old_entries.count())
-      old_entries.delete()
-      print ""
+    print "Deleting entries older than %s ..." % models.Thermolog.KEEP_TIME
+    deleted = models.Thermolog.PurgeOld()
+    print "Deleted %i entries." % deleted
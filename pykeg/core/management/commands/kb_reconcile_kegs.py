@@ -0,0 +1,63 @@
+# Copyright 2013 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from pykeg.core import models
+
+# Largest difference, in mL, put down to floating point error.
+TOLERANCE_ML = 0.01
+
+class Command(NoArgsCommand):
+  option_list = NoArgsCommand.option_list + (
+      make_option('--dry-run',
+        action='store_true',
+        dest='dry_run',
+        default=False,
+        help='Report kegs whose served volume is wrong, without fixing them.'),
+      )
+
+  help = (u'Check each keg\'s served volume against its drinks, and repair it. '
+      'Also rebuilds each keg\'s depletion forecast.')
+  args = '<none>'
+
+  def handle(self, **options):
+    dry_run = options.get('dry_run')
+    checked = 0
+    wrong = 0
+    for keg in models.Keg.objects.all().order_by('id'):
+      checked += 1
+      if not dry_run:
+        keg.RebuildForecast()
+      actual = keg.ServedVolumeFromDrinks()
+      drift = keg.served_ml - actual
+      if abs(drift) <= TOLERANCE_ML:
+        continue
+      wrong += 1
+      print 'Keg #%s: served_ml is %.2f, drinks total %.2f (off by %.2f)' % (
+          keg.id, keg.served_ml, actual, drift)
+      if not dry_run:
+        # Relative to the stored value, so pours meanwhile aren't lost.
+        keg.AddServedVolume(-drift)
+
+    if dry_run or not wrong:
+      print '%i kegs checked, %i wrong.' % (checked, wrong)
+    else:
+      print '%i kegs checked, %i repaired.' % (checked, wrong)
@@ -16,66 +16,49 @@
 # You should have received a copy of the GNU General Public License
 # along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
 
-from django.db import connection
-from django.core.management.base import CommandError
+from optparse import make_option
+import time
+
 from django.core.management.base import NoArgsCommand
 
 from pykeg.core import models
 from pykeg.core.management.commands.common import progbar
 
 class Command(NoArgsCommand):
-  help = u'Regenerate all cached stats.'
+  option_list = NoArgsCommand.option_list + (
+      make_option('--resume',
+        action='store_true',
+        dest='resume',
+        default=False,
+        help='Keep sessions written by an interrupted run, and continue '
+            'from there.'),
+      )
+
+  help = u'Regenerate all drinking sessions.'
   args = '<none>'
 
   def handle(self, **options):
-    drinks = models.Drink.objects.valid()
-
-    pos = 0
-    count = drinks.count()
-    for d in drinks:
-      pos += 1
-      progbar('clear drink sessions', pos, count)
-      d.session = None
-      d.save()
-    print ''
+    resume = options.get('resume')
+    for site in models.KegbotSite.objects.all():
+      print 'site: %s' % site
+      self.handle_site(site, resume)
+    print 'Now run kb_regen_events and kb_regen_stats.'
 
-    pics = models.Picture.objects.all()
-    pos = 0
-    for p in pics:
-      pos += 1
-      progbar('clear image sessions', pos, count)
-      p.session = None
-      p.save()
-    print ''
-
-    print 'deleting old sessions..',
-    try:
-      cursor = connection.cursor()
-      for table in ('core_drinkingsession', 'core_kegsessionchunk',
-        'core_usersessionchunk', 'core_sessionchunk'):
-        cursor.execute('TRUNCATE TABLE `%s`' % table)
-      print 'truncate successful'
-    except Exception, e:
-      models.DrinkingSession.objects.all().delete()
-      print 'orm delete successful'
-
-    pos = 0
-    count = drinks.count()
-    for d in drinks.order_by('time'):
-      pos += 1
-      progbar('calc new sessions', pos, count)
-      sess = models.DrinkingSession.AssignSessionForDrink(d)
-    print ''
+  def handle_site(self, site, resume):
+    regen = models.SessionRegenerator(site)
+    if resume:
+      count = regen.Drinks().count()
+    else:
+      count = site.drinks.valid().count()
+    start = time.time()
 
-    pics = models.Picture.objects.all()
-    count = pics.count()
-    pos = 0
-    for p in pics:
-      pos += 1
-      progbar('set image sessions', pos, count)
-      if p.drink:
-        p.session = p.drink.session
-        p.save()
+    progbar('calc new sessions', 0, count)
+    regen.Run(resume=resume,
+        progress=lambda pos: progbar('calc new sessions', pos, count))
+    progbar('calc new sessions', count, count)
     print ''
 
-    print 'done!'
+    elapsed = time.time() - start
+    rate = count / max(elapsed, 0.001)
+    print 'done! %i drinks, %i sessions in %.2fs (%.0f drinks/s)' % (count,
+        regen.next_seqn - 1, elapsed, rate)
@@ -16,70 +16,156 @@
 # You should have received a copy of the GNU General Public License
 # along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
 
-from django.core.management.base import CommandError
+import multiprocessing
+from optparse import make_option
+import time
+
 from django.core.management.base import NoArgsCommand
+from django.db import connection
+
+from kegbot.api.protoutil import ProtoMessageToDict
 
 from pykeg.core import models
+from pykeg.core import stats
 from pykeg.core.management.commands.common import progbar
 
+# Rows per INSERT when writing stats records.
+BULK_CREATE_SIZE = 100
+
+
+def regen_shard(args):
+  """Builds partial stats for a range of a site's drinks, in a worker."""
+  site_id, seqn_range = args
+  site = models.KegbotSite.objects.get(pk=site_id)
+  regen = stats.StatsRegenerator(site, seqn_range)
+  regen.Feed()
+  return regen
+
 
 class Command(NoArgsCommand):
+  option_list = NoArgsCommand.option_list + (
+      make_option('-j', '--jobs',
+        type='int',
+        action='store',
+        dest='jobs',
+        default=1,
+        help='Number of worker processes to build stats with.'),
+      )
+
   help = u'Regenerate all cached stats.'
   args = '<none>'
 
   def handle(self, **options):
+    sites = list(models.KegbotSite.objects.all())
+    # Catch up on drinks pending asynchronous post-processing, which would
+    # otherwise be added again after the rebuild.
+    for site in sites:
+      models.Drink.PostProcessPending(site)
+
+    # Decide before deleting anything, so a stat without a merge function
+    # costs a slower rebuild rather than the stats.
+    jobs = options.get('jobs') or 1
+    if jobs > 1 and not stats.StatsRegenerator.CanMerge():
+      print 'Some stats cannot be built in parallel; using one process.'
+      jobs = 1
+
     models.SystemStats.objects.all().delete()
     models.KegStats.objects.all().delete()
     models.UserStats.objects.all().delete()
     models.SessionStats.objects.all().delete()
 
-    for site in models.KegbotSite.objects.all():
+    if jobs > 1:
+      self.handle_parallel(sites, jobs)
+      return
+
+    for site in sites:
       print 'site: %s' % site
       self.handle_site(site)
 
   def handle_site(self, site):
-    drinks = site.drinks.valid()
+    count = site.drinks.valid().count()
+    start = time.time()
 
-    last_drinks = drinks.order_by('-time')
-    if last_drinks:
-      progbar('recalc system stats', 0, 1)
-      last_drinks[0]._UpdateSystemStats()
-    progbar('recalc system stats', 1, 1)
+    regen = stats.StatsRegenerator(site)
+    progbar('recalc stats', 0, count)
+    regen.Run(progress=lambda pos: progbar('recalc stats', pos, count))
+    progbar('recalc stats', count, count)
     print ''
 
-    kegs = site.kegs.all()
-    count = kegs.count()
-    pos = 0
-    for k in kegs:
-      pos += 1
-      progbar('recalc keg stats', pos, count)
-      last_drinks = k.drinks.valid().order_by('-time')
-      if last_drinks:
-        last_drinks[0]._UpdateKegStats()
-    print ''
+    self.write_stats(regen, count, start)
 
-    users = models.User.objects.all()
-    count = users.count()
-    pos = 0
-    for user in users:
-      pos += 1
-      progbar('recalc user stats', pos, count)
-      user_drinks = user.drinks.valid().filter(site=site).order_by('-time')
-      if user_drinks:
-        last = user_drinks[0]
-        last._UpdateUserStats()
-    print ''
+  def handle_parallel(self, sites, jobs):
+    """Builds stats in `jobs` processes, each given a range of drinks.
 
-    sessions = models.DrinkingSession.objects.all()
-    count = sessions.count()
-    pos = 0
-    for session in sessions:
-      pos += 1
-      progbar('recalc session stats', pos, count)
-      session_drinks = session.drinks.valid().filter(site=site).order_by('-time')
-      if session_drinks:
-        last = session_drinks[0]
-        last._UpdateSessionStats()
+    Each site's drinks are split into `jobs` consecutive ranges, whose partial
+    stats are merged in order; the result is the same as a serial rebuild.
+    Every stat must have a merge function; see StatsRegenerator.CanMerge().
+    """
+    start = time.time()
+    shards = []
+    counts = {}
+    for site in sites:
+      counts[site.pk] = site.drinks.valid().count()
+      for seqn_range in self.seqn_ranges(site, counts[site.pk], jobs):
+        shards.append((site.pk, seqn_range))
+
+    # Workers must open their own database connections.
+    connection.close()
+    pool = multiprocessing.Pool(jobs)
+    results = {}
+    try:
+      progbar('recalc stats', 0, len(shards))
+      for pos, regen in enumerate(pool.imap(regen_shard, shards)):
+        progbar('recalc stats', pos + 1, len(shards))
+        site_id = regen.site.pk
+        if site_id in results:
+          results[site_id].Merge(regen)
+        else:
+          results[site_id] = regen
+    finally:
+      pool.close()
+      pool.join()
     print ''
 
-    print 'done!'
+    for site in sites:
+      regen = results.get(site.pk)
+      if regen is None:
+        continue
+      print 'site: %s' % site
+      regen.Finish()
+      self.write_stats(regen, counts[site.pk], start)
+
+  def seqn_ranges(self, site, count, jobs):
+    """Splits the valid drinks of `site` into up to `jobs` equal ranges."""
+    if not count:
+      return []
+    jobs = min(jobs, count)
+    seqns = site.drinks.valid().order_by('seqn').values_list('seqn', flat=True)
+    firsts = [seqns[i * count / jobs] for i in xrange(jobs)]
+    lasts = [first - 1 for first in firsts[1:]] + [seqns[count - 1]]
+    return zip(firsts, lasts)
+
+  def write_stats(self, regen, count, start):
+    site = regen.site
+    if count:
+      self._bulk_create(models.SystemStats, [models.SystemStats(site=site,
+          stats=ProtoMessageToDict(regen.system.stats))])
+    self._bulk_create(models.KegStats, [models.KegStats(site=site, keg_id=k,
+        stats=ProtoMessageToDict(b.stats)) for k, b in regen.kegs.iteritems()])
+    self._bulk_create(models.UserStats, [models.UserStats(site=site, user_id=u,
+        stats=ProtoMessageToDict(b.stats)) for u, b in regen.users.iteritems()])
+    self._bulk_create(models.SessionStats, [models.SessionStats(site=site,
+        session_id=s, stats=ProtoMessageToDict(b.stats))
+        for s, b in regen.sessions.iteritems()])
+
+    elapsed = time.time() - start
+    records = len(regen.kegs) + len(regen.users) + len(regen.sessions)
+    if count:
+      records += 1
+    rate = count / max(elapsed, 0.001)
+    print 'done! %i drinks, %i records in %.2fs (%.0f drinks/s)' % (count,
+        records, elapsed, rate)
+
+  def _bulk_create(self, model, records):
+    for i in xrange(0, len(records), BULK_CREATE_SIZE):
+      model.objects.bulk_create(records[i:i+BULK_CREATE_SIZE])
@@ -38,12 +38,21 @@ def run(cmd, args=[]):
   cmd.run_from_argv([sys.argv[0], cmdname] + args)
 
 class Command(NoArgsCommand):
+  option_list = NoArgsCommand.option_list + (
+      make_option('-j', '--jobs',
+        type='int',
+        action='store',
+        dest='jobs',
+        default=1,
+        help='Number of worker processes to regenerate stats with.'),
+      )
+
   help = u'Perform post-upgrade tasks.'
 
   def handle(self, **options):
     run(syncdb.Command(), args=['--noinput', '-v', '0'])
     run(migrate.Command(), args=['-v', '0'])
-    run(kb_regen_stats.Command())
+    run(kb_regen_stats.Command(), args=['--jobs', str(options.get('jobs') or 1)])
     run(collectstatic.Command())
 
     from pykeg.core import models
@@ -29,3 +29,14 @@ class SessionManager(models.Manager):
   """Manager for session models."""
   def valid(self):
     return self.filter(volume_ml__gt=kb_common.MIN_SESSION_VOLUME_DISPLAY_ML)
+
+  def overlapping(self, start_time, end_time):
+    """Returns sessions overlapping [start_time, end_time), in time order.
+
+    Sessions are disjoint, and each lasts at least the session timeout, so a
+    range n timeouts long overlaps at most n + 1 of them.  Sliced to that, the
+    query reads a few rows of the (site, end_time) index (core migration
+    0086), however many sessions come later.
+    """
+    return self.filter(end_time__gt=start_time,
+        start_time__lt=end_time).order_by('end_time')
@@ -17,13 +17,22 @@
 # You should have received a copy of the GNU General Public License
 # along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
 
+import atexit
 import datetime
+import logging
 import os
 import random
+import threading
 
 from django.conf import settings
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
+from django.db import IntegrityError
+from django.db import connection
 from django.db import models
+from django.db import transaction
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_init
 from django.db.models.signals import post_save
 from django.db.models.signals import pre_save
 from django.contrib.sites.models import Site
@@ -34,11 +43,14 @@ from autoslug import AutoSlugField
 from pykeg import EPOCH
 
 from pykeg.core import kb_common
-from pykeg.core import fields
+from pykeg.core import forecast
 from pykeg.core import imagespecs
+from pykeg.core import jsonfield
 from pykeg.core import managers
 from pykeg.core import stats
+from pykeg.core import thermostore
 
+from kegbot.util import kbjson
 from kegbot.util import units
 from kegbot.util import util
 
@@ -51,15 +63,12 @@ from pykeg.beerdb import models as bdb
 
 """Django models definition for the kegbot database."""
 
+logger = logging.getLogger(__name__)
+
 def _set_seqn_pre_save(sender, instance, **kwargs):
   if instance.seqn:
     return
-  prev = sender.objects.filter(site=instance.site).order_by('-seqn')
-  if not prev.count():
-    seqn = 1
-  else:
-    seqn = prev[0].seqn + 1
-  instance.seqn = seqn
+  instance.seqn = SequenceCounter.Next(instance.site, sender)
 
 class KegbotSite(models.Model):
   name = models.CharField(max_length=64, unique=True,
@@ -72,6 +81,9 @@ class KegbotSite(models.Model):
   epoch = models.PositiveIntegerField(default=EPOCH,
       help_text='Database epoch number.',
       editable=False)
+  config_version = models.PositiveIntegerField(default=0, editable=False,
+      help_text='Incremented whenever a tap, keg, sensor or the settings of '
+          'this site change; see TapConfig.')
 
   def __str__(self):
     return self.name
@@ -105,6 +117,131 @@ def _kegbotsite_post_save(sender, instance, **kwargs):
   settings, _ = SiteSettings.objects.get_or_create(site=instance)
 post_save.connect(_kegbotsite_post_save, sender=KegbotSite)
 
+class SequenceCounter(models.Model):
+  """The last sequence number allocated for a model within a site.
+
+  Counters are created on first use, starting from the largest seqn already
+  stored.  Numbers are claimed by incrementing the counter in place and reading
+  it back under a row lock, so concurrent inserts never receive the same seqn
+  and never retry.  When settings.KEGBOT_SEQN_BLOCK_SIZE is greater than 1,
+  each process claims numbers in blocks and hands them out from memory;
+  numbers left unused in a block when a process exits are skipped.  Drinks are
+  never numbered in blocks: stats depend on their seqns following pour order.
+  """
+  class Meta:
+    unique_together = ('site', 'name')
+
+  site = models.ForeignKey(KegbotSite, related_name='sequence_counters',
+      blank=True, null=True)
+  name = models.CharField(max_length=64,
+      help_text='Name of the sequenced model.')
+  value = models.PositiveIntegerField(default=0,
+      help_text='Last sequence number allocated.')
+  generation = models.PositiveIntegerField(default=0, editable=False,
+      help_text='Incremented by each reset, which discards reserved blocks.')
+
+  # Primary key of each counter, by (site id, name).  A stale entry only costs
+  # an update of no rows and a re-read.
+  _known = {}
+
+  # Reserved but unused [next, last, counter pk, generation] numbers, by
+  # (site id, name).
+  _blocks = {}
+  _blocks_lock = threading.Lock()
+
+  def __str__(self):
+    return '%s %s: %s' % (self.site, self.name, self.value)
+
+  @classmethod
+  def Next(cls, site, model):
+    """Returns the next sequence number for a new `model` instance."""
+    block_size = getattr(settings, 'KEGBOT_SEQN_BLOCK_SIZE', 1)
+    if block_size <= 1 or model is Drink:
+      return cls.Reserve(site, model)
+    key = (site and site.id, cls._Name(model))
+    with cls._blocks_lock:
+      block = cls._blocks.get(key)
+      # A block reserved before a reset, by any process, is discarded.
+      if (not block or block[0] > block[1] or not cls.objects.filter(
+          pk=block[2], generation=block[3]).exists()):
+        first, pk, generation = cls._ReserveBlock(site, model, block_size)
+        block = cls._blocks[key] = [first, first + block_size - 1, pk,
+            generation]
+      seqn = block[0]
+      block[0] += 1
+      return seqn
+
+  @classmethod
+  def Reserve(cls, site, model, count=1):
+    """Reserves `count` consecutive sequence numbers, returning the first.
+
+    Outside a managed transaction, the reservation is committed at once.
+    Inside one, eg a request, the counter row stays locked until it ends, and
+    other reservers wait for it; KEGBOT_SEQN_BLOCK_SIZE makes that rarer.
+    """
+    return cls._ReserveBlock(site, model, count)[0]
+
+  @classmethod
+  def _ReserveBlock(cls, site, model, count):
+    """Like Reserve(), also returning the counter's pk and generation."""
+    if transaction.is_managed():
+      return cls._Reserve(site, model, count)
+    with transaction.commit_on_success():
+      return cls._Reserve(site, model, count)
+
+  @classmethod
+  def _Reserve(cls, site, model, count):
+    name = cls._Name(model)
+    key = (site and site.id, name)
+    pk = cls._known.get(key)
+    if pk is None or not cls._Increment(pk, count):
+      counter, created = cls.objects.get_or_create(site=site, name=name,
+          defaults={'value': cls._MaxSeqn(site, model)})
+      pk = cls._known[key] = counter.pk
+      cls._Increment(pk, count)
+    # A locking read sees the latest value, whatever the isolation level.
+    value, generation = cls.objects.select_for_update().filter(
+        pk=pk).values_list('value', 'generation')[0]
+    return value - count + 1, pk, generation
+
+  @classmethod
+  def _Increment(cls, pk, count):
+    return cls.objects.filter(pk=pk).update(value=models.F('value') + count)
+
+  @classmethod
+  def Reset(cls, site, model=None):
+    """Restarts the counters of `site` from the largest seqns stored, eg after
+    restoring it from a backup.
+
+    If `model` is given, only its counter is reset.  Blocks reserved by any
+    process before the reset are discarded.
+    """
+    counters = cls.objects.filter(site=site)
+    if model is not None:
+      counters = counters.filter(name=cls._Name(model))
+    for pk, name in counters.values_list('pk', 'name'):
+      counted = models.get_model('core', name)
+      if counted is None:
+        cls.objects.filter(pk=pk).delete()
+        continue
+      cls.objects.filter(pk=pk).update(value=cls._MaxSeqn(site, counted),
+          generation=models.F('generation') + 1)
+    site_id = site and site.id
+    with cls._blocks_lock:
+      for key in cls._blocks.keys():
+        if key[0] == site_id and (model is None or key[1] == cls._Name(model)):
+          del cls._blocks[key]
+
+  @classmethod
+  def _Name(cls, model):
+    return model._meta.object_name.lower()
+
+  @classmethod
+  def _MaxSeqn(cls, site, model):
+    result = model.objects.filter(site=site).aggregate(
+        max_seqn=models.Max('seqn'))
+    return result['max_seqn'] or 0
+
 PRIVACY_CHOICES = (
   ('public', 'Public: Browsing does not require login'),
   ('members', 'Members only: Must log in to browse'),
@@ -269,9 +406,7 @@ class KegTap(models.Model):
 
   def Temperature(self):
     if self.temperature_sensor:
-      last_rec = self.temperature_sensor.thermolog_set.all().order_by('-time')
-      if last_rec:
-        return last_rec[0]
+      return self.temperature_sensor.LastLog()
     return None
 
 pre_save.connect(_set_seqn_pre_save, sender=KegTap)
@@ -289,11 +424,95 @@ class Keg(models.Model):
     return self.size.volume_ml
 
   def served_volume(self):
-    drinks = Drink.objects.filter(keg__exact=self, status__exact='valid')
-    total = 0
-    for d in drinks:
-      total += d.volume_ml
-    return total
+    return self.served_ml
+
+  def ServedVolumeFromDrinks(self):
+    """Returns the served volume, summed from the keg's valid drinks."""
+    total = self.drinks.valid().aggregate(models.Sum('volume_ml'))
+    return total['volume_ml__sum'] or 0.0
+
+  def AddServedVolume(self, volume_ml, time=None):
+    """Adds `volume_ml` to served_ml; a pour at `time` adds to the forecast."""
+    if time is not None:
+      self.AddPours([(time, volume_ml)])
+      return
+    Keg.objects.filter(pk=self.pk).update(
+        served_ml=models.F('served_ml') + volume_ml)
+    self.served_ml += volume_ml
+
+  def AddSpilledVolume(self, volume_ml):
+    """Adds `volume_ml` to spilled_ml, without saving the keg."""
+    Keg.objects.filter(pk=self.pk).update(
+        spilled_ml=models.F('spilled_ml') + volume_ml)
+    self.spilled_ml += volume_ml
+
+  def AddPours(self, pours):
+    """Adds (time, volume_ml) pours to served_ml and the forecast at once."""
+    volume_ml = sum(v for t, v in pours)
+    latest = max(t for t, v in pours)
+    while True:
+      epoch = self.forecast_epoch
+      if latest - epoch > forecast.REBASE_AFTER:
+        new_epoch, scale = latest, forecast.Weight(epoch, latest)
+      else:
+        new_epoch, scale = epoch, 1.0
+      weight = sum(v * forecast.Weight(t, new_epoch) for t, v in pours)
+      # Matching the epoch makes sure `weight` is relative to the stored one.
+      updated = Keg.objects.filter(pk=self.pk, forecast_epoch=epoch).update(
+          served_ml=models.F('served_ml') + volume_ml,
+          forecast_epoch=new_epoch,
+          forecast_weight=models.F('forecast_weight') * scale + weight)
+      if updated:
+        break
+      # Another process moved the epoch; retry against its.
+      rows = Keg.objects.filter(pk=self.pk).values_list('forecast_epoch',
+          'forecast_weight')
+      if not rows:
+        return
+      self.forecast_epoch, self.forecast_weight = rows[0]
+    self.served_ml += volume_ml
+    self.forecast_epoch = new_epoch
+    self.forecast_weight = self.forecast_weight * scale + weight
+
+  def ConsumptionRate(self, now=None):
+    """Returns the recent consumption rate in mL per hour, or None."""
+    if now is None:
+      now = datetime.datetime.now()
+    rate = forecast.Rate(self.forecast_weight, self.forecast_epoch,
+        self.start_time, now)
+    if rate is None:
+      return None
+    return rate * 3600
+
+  def PredictedEmptyTime(self, now=None):
+    """Returns when this online keg should run dry, or None if unknown."""
+    if not self.is_active():
+      return None
+    if now is None:
+      now = datetime.datetime.now()
+    rate = forecast.Rate(self.forecast_weight, self.forecast_epoch,
+        self.start_time, now)
+    return forecast.EmptyTime(self.remaining_volume(), rate, now)
+
+  def RebuildForecast(self):
+    """Recomputes the forecast from the keg's session chunks.
+
+    Each chunk's volume is placed midway between its first and last drink,
+    which is close enough for sessions much shorter than the time constant.
+    """
+    session_delta = self.site.settings.GetSessionTimeoutDelta()
+    pours = []
+    for chunk in self.keg_session_chunks.all():
+      last_drink = max(chunk.end_time - session_delta, chunk.start_time)
+      middle = chunk.start_time + (last_drink - chunk.start_time) / 2
+      pours.append((middle, chunk.volume_ml))
+    epoch, weight = forecast.Sum(pours)
+    if epoch is None:
+      epoch = self.start_time
+    Keg.objects.filter(pk=self.pk).update(forecast_epoch=epoch,
+        forecast_weight=weight)
+    self.forecast_epoch = epoch
+    self.forecast_weight = weight
 
   def spilled_volume(self):
     return self.spilled_ml
@@ -394,11 +613,28 @@ class Keg(models.Model):
   description = models.CharField(max_length=256, blank=True, null=True)
   origcost = models.FloatField(default=0, blank=True, null=True)
   spilled_ml = models.FloatField(default=0)
+  served_ml = models.FloatField(default=0, editable=False,
+      help_text='Total volume of valid drinks poured from this keg.  '
+          'Maintained as drinks are saved; see kb_reconcile_kegs.')
+  forecast_epoch = models.DateTimeField(null=True, editable=False,
+      help_text='Reference time for forecast_weight.')
+  forecast_weight = models.FloatField(default=0, editable=False,
+      help_text='Exponentially-weighted sum of pours, for forecasting when '
+          'the keg runs dry.  See pykeg.core.forecast.')
   notes = models.TextField(blank=True, null=True,
       help_text='Private notes about this keg, viewable only by admins.')
 
 def _keg_pre_save(sender, instance, **kwargs):
   keg = instance
+  # These are only changed by drinks; don't overwrite them with a stale copy.
+  if keg.pk:
+    rows = Keg.objects.filter(pk=keg.pk).values_list('served_ml',
+        'forecast_epoch', 'forecast_weight')
+    if rows:
+      keg.served_ml, keg.forecast_epoch, keg.forecast_weight = rows[0]
+  if keg.forecast_epoch is None:
+    keg.forecast_epoch = keg.start_time
+
   # We don't need to do anything if the keg is still online.
   if keg.status != 'offline':
     return
@@ -426,6 +662,86 @@ def _keg_post_save(sender, instance, **kwargs):
 
 post_save.connect(_keg_post_save, sender=Keg)
 
+def _CacheVersion(key):
+  """Returns the version number kept in the Django cache at `key`."""
+  version = cache.get(key)
+  if version is None:
+    # Start somewhere unpredictable, in case the value was evicted.
+    cache.add(key, random.randrange(1 << 30))
+    version = cache.get(key)
+  return version
+
+def _BumpCacheVersion(key):
+  """Increments the version number at `key`, returning the new version."""
+  try:
+    return cache.incr(key)
+  except ValueError:
+    return _CacheVersion(key)
+
+class TapConfig(object):
+  """A site's settings, its taps by meter name with their current kegs, and its
+  temperature sensors by raw name.
+
+  Recording a drink or reading needs these, and they rarely change, so each
+  process keeps a copy per site: a pour on a known tap reads only the site's
+  config_version, by primary key.  Any save or delete of a KegTap, Keg,
+  SiteSettings or ThermoSensor increments it, which discards the copy in every
+  process, whatever cache backend is configured.
+  """
+  lock = threading.Lock()
+
+  # TapConfig by site id.
+  _by_site = {}
+
+  def __init__(self, site, version):
+    self.version = version
+    self.settings = SiteSettings.objects.select_related('default_user').get(
+        site=site)
+    self.taps = dict((tap.meter_name, tap) for tap in
+        site.taps.select_related('current_keg'))
+    self.sensors = dict((sensor.raw_name, sensor) for sensor in
+        site.thermosensors.all())
+
+  @classmethod
+  def ForSite(cls, site):
+    """Returns the current TapConfig of `site`, loading it if needed.
+
+    The site's `settings` are set to the cached copy, too.
+    """
+    # Read before loading: a write while loading leaves this out of date.
+    versions = KegbotSite.objects.filter(pk=site.id).values_list(
+        'config_version', flat=True)
+    version = versions[0] if versions else None
+    with cls.lock:
+      config = cls._by_site.get(site.id)
+      if config is None or config.version != version:
+        config = cls._by_site[site.id] = cls(site, version)
+    setattr(site, SiteSettings._meta.get_field('site').related.get_cache_name(),
+        config.settings)
+    return config
+
+  @classmethod
+  def Invalidate(cls, site_id):
+    """Discards every TapConfig of the site."""
+    KegbotSite.objects.filter(pk=site_id).update(
+        config_version=models.F('config_version') + 1)
+
+  def GetTap(self, meter_name):
+    return self.taps.get(meter_name)
+
+  def GetSensor(self, raw_name):
+    return self.sensors.get(raw_name)
+
+def _tap_config_changed(sender, instance, **kwargs):
+  TapConfig.Invalidate(instance.site_id)
+
+post_save.connect(_tap_config_changed, sender=KegTap)
+post_delete.connect(_tap_config_changed, sender=KegTap)
+post_save.connect(_tap_config_changed, sender=Keg)
+post_delete.connect(_tap_config_changed, sender=Keg)
+post_save.connect(_tap_config_changed, sender=SiteSettings)
+post_delete.connect(_tap_config_changed, sender=SiteSettings)
+
 
 class Drink(models.Model):
   """ Table of drinks records """
@@ -476,11 +792,81 @@ class Drink(models.Model):
       stats.Update(self)
 
   def PostProcess(self):
-    self._UpdateSystemStats()
-    self._UpdateUserStats()
-    self._UpdateKegStats()
-    self._UpdateSessionStats()
-    SystemEvent.ProcessDrink(self)
+    Drink.PostProcessDrinks([self])
+
+  @classmethod
+  def PostProcessDrinks(cls, drinks):
+    """Updates stats and events for new drinks of one site, in order.
+
+    Each stats record is loaded and saved once, no matter how many of the
+    drinks it covers.
+    """
+    drinks = list(drinks)
+    if not drinks:
+      return
+    site = drinks[0].site
+    valid = [d for d in drinks if d.status == 'valid']
+
+    groups = [(SystemStats, {}, valid)]
+    for model, attrname in ((UserStats, 'user'), (KegStats, 'keg'),
+        (SessionStats, 'session')):
+      by_id = {}
+      for d in valid:
+        if getattr(d, attrname + '_id') is not None:
+          by_id.setdefault(getattr(d, attrname + '_id'), []).append(d)
+      for key, group in sorted(by_id.iteritems()):
+        groups.append((model, {attrname + '_id': key}, group))
+    for model, lookup, group in groups:
+      if group:
+        record, created = model.objects.get_or_create(site=site, **lookup)
+        record.UpdateMany(group)
+
+    for d in valid:
+      SystemEvent.ProcessDrink(d)
+    Drink.objects.filter(pk__in=[d.pk for d in drinks]).update(
+        postprocessed=True)
+    for d in drinks:
+      d.postprocessed = True
+
+  @classmethod
+  def PostProcessPending(cls, site):
+    """Post-processes every drink of `site` saved without post-processing.
+
+    Returns the SystemEvents created.
+    """
+    with transaction.commit_on_success():
+      # Concurrent callers wait here, then find the drinks already processed.
+      list(KegbotSite.objects.select_for_update().filter(pk=site.pk))
+      pending = list(site.drinks.filter(postprocessed=False).select_related(
+          'keg', 'user', 'session').order_by('seqn'))
+      cls.PostProcessDrinks(pending)
+    return list(SystemEvent.objects.filter(drink__in=pending).order_by('id'))
+
+  @classmethod
+  def SaveMany(cls, drinks):
+    """Saves new drinks of one site with bulk inserts.
+
+    Sequence numbers are reserved at once and given out in time order, and
+    each keg's served volume is updated once.  Sessions are not assigned; see
+    DrinkingSession.AssignSessionsForDrinks.  Returns the saved drinks, read
+    back in time order.
+    """
+    drinks = sorted(drinks, key=lambda d: d.time)
+    if not drinks:
+      return []
+    site = drinks[0].site
+    first = SequenceCounter.Reserve(site, cls, len(drinks))
+    pours = {}
+    for i, d in enumerate(drinks):
+      d.seqn = first + i
+      if d.status == 'valid' and d.keg is not None:
+        pours.setdefault(d.keg, []).append((d.time, d.volume_ml))
+    _BulkCreate(cls, drinks)
+    # bulk_create sends no signals, so do what _drink_post_save would.
+    for keg, keg_pours in pours.iteritems():
+      keg.AddPours(keg_pours)
+    return list(site.drinks.filter(seqn__gte=first,
+        seqn__lt=first + len(drinks)).order_by('seqn'))
 
   objects = managers.DrinkManager()
 
@@ -509,9 +895,54 @@ class Drink(models.Model):
   auth_token = models.CharField(max_length=256, blank=True, null=True)
   shout = models.TextField(blank=True, null=True,
       help_text='Comment from the drinker at the time of the pour.')
+  postprocessed = models.BooleanField(default=False, editable=False,
+      help_text='Whether stats and events include this drink yet.')
 
 pre_save.connect(_set_seqn_pre_save, sender=Drink)
 
+def _drink_served(drink):
+  """Returns (keg id, volume, time) the drink adds to its keg, if anything."""
+  if drink.status == 'valid' and drink.keg_id is not None:
+    return drink.keg_id, drink.volume_ml, drink.time
+  return None
+
+def _drink_post_init(sender, instance, **kwargs):
+  # What the stored row contributes; nothing, for a drink not yet saved.
+  if instance.pk is None:
+    instance._saved_served = None
+  else:
+    instance._saved_served = _drink_served(instance)
+
+def _update_served(drink, old, new):
+  if old == new:
+    return
+  cached_keg = getattr(drink, drink._meta.get_field('keg').get_cache_name(),
+      None)
+  for (keg_id, volume_ml, time), sign in ((old, -1), (new, 1)):
+    if keg_id is None:
+      continue
+    if cached_keg is not None and cached_keg.pk == keg_id:
+      kegs = [cached_keg]
+    else:
+      # The forecast epoch is needed; the keg may also be mid-delete.
+      kegs = Keg.objects.filter(pk=keg_id)
+    for keg in kegs:
+      keg.AddServedVolume(sign * volume_ml, time)
+
+def _drink_post_save(sender, instance, **kwargs):
+  new = _drink_served(instance)
+  _update_served(instance, instance._saved_served or (None, 0, None),
+      new or (None, 0, None))
+  instance._saved_served = new
+
+def _drink_post_delete(sender, instance, **kwargs):
+  _update_served(instance, instance._saved_served or (None, 0, None),
+      (None, 0, None))
+
+post_init.connect(_drink_post_init, sender=Drink)
+post_save.connect(_drink_post_save, sender=Drink)
+post_delete.connect(_drink_post_delete, sender=Drink)
+
 class AuthenticationToken(models.Model):
   """A secret token to authenticate a user, optionally pin-protected."""
   class Meta:
@@ -554,6 +985,17 @@ def _auth_token_pre_save(sender, instance, **kwargs):
 pre_save.connect(_auth_token_pre_save, sender=AuthenticationToken)
 pre_save.connect(_set_seqn_pre_save, sender=AuthenticationToken)
 
+# Rows per INSERT by _BulkCreate().
+BULK_CREATE_SIZE = 100
+
+# Query parameters per INSERT by _BulkCreate(); SQLite allows 999 by default.
+BULK_CREATE_PARAMS = 900
+
+def _BulkCreate(model, records):
+  size = min(BULK_CREATE_SIZE, BULK_CREATE_PARAMS // len(model._meta.fields))
+  for i in xrange(0, len(records), size):
+    model.objects.bulk_create(records[i:i+size])
+
 class _AbstractChunk(models.Model):
   class Meta:
     abstract = True
@@ -567,8 +1009,9 @@ class _AbstractChunk(models.Model):
   def Duration(self):
     return self.end_time - self.start_time
 
-  def _AddDrinkNoSave(self, drink):
-    session_delta = drink.site.settings.GetSessionTimeoutDelta()
+  def _AddDrinkNoSave(self, drink, session_delta=None):
+    if session_delta is None:
+      session_delta = drink.site.settings.GetSessionTimeoutDelta()
     session_end = drink.time + session_delta
 
     if self.start_time > drink.time:
@@ -577,9 +1020,102 @@ class _AbstractChunk(models.Model):
       self.end_time = session_end
     self.volume_ml += drink.volume_ml
 
-  def AddDrink(self, drink):
-    self._AddDrinkNoSave(drink)
-    self.save()
+  def AddDrink(self, drink, session_delta=None):
+    if session_delta is None:
+      session_delta = drink.site.settings.GetSessionTimeoutDelta()
+    self._AddDrinkNoSave(drink, session_delta)
+    if self.pk is None:
+      self.save()
+    else:
+      self._Accumulate(drink, session_delta, id=self.pk)
+
+  @classmethod
+  def _Accumulate(cls, drink, session_delta, **lookup):
+    """Adds `drink` to the rows matching `lookup` with a single UPDATE.
+
+    The volume is incremented and the times widened by the database, so
+    concurrent pours can't overwrite each other's changes.  Returns the number
+    of rows updated.
+    """
+    qn = connection.ops.quote_name
+    drink_start = connection.ops.value_to_db_datetime(drink.time)
+    drink_end = connection.ops.value_to_db_datetime(drink.time + session_delta)
+    params = [drink.volume_ml, drink_start, drink_start, drink_end, drink_end]
+    where = []
+    for column, value in sorted(lookup.iteritems()):
+      if value is None:
+        where.append('%s IS NULL' % qn(column))
+      else:
+        where.append('%s = %%s' % qn(column))
+        params.append(value)
+    sql = ('UPDATE %(table)s SET '
+        '%(volume)s = %(volume)s + %%s, '
+        '%(start)s = CASE WHEN %(start)s > %%s THEN %%s ELSE %(start)s END, '
+        '%(end)s = CASE WHEN %(end)s < %%s THEN %%s ELSE %(end)s END '
+        'WHERE %(where)s') % {
+      'table': qn(cls._meta.db_table),
+      'volume': qn('volume_ml'),
+      'start': qn('start_time'),
+      'end': qn('end_time'),
+      'where': ' AND '.join(where),
+    }
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    transaction.commit_unless_managed()
+    if not getattr(_session_writes, 'active', False):
+      _ActiveSession.Invalidate()
+    return cursor.rowcount
+
+  @classmethod
+  def _AddDrinkToChunk(cls, drink, session_delta, **lookup):
+    """Adds `drink` to the chunk given by `lookup`, creating it if needed.
+
+    Creates are serialized by locking the session row: the unique constraints
+    can't catch concurrent ones when the user or keg is NULL.
+    """
+    if cls._Accumulate(drink, session_delta, **lookup):
+      return
+    if transaction.is_managed():
+      cls._CreateChunk(drink, session_delta, **lookup)
+      return
+    with transaction.commit_on_success():
+      cls._CreateChunk(drink, session_delta, **lookup)
+
+  @classmethod
+  def _CreateChunk(cls, drink, session_delta, **lookup):
+    list(DrinkingSession.objects.select_for_update().filter(
+        pk=lookup['session_id']).values_list('pk', flat=True))
+    if cls._Accumulate(drink, session_delta, **lookup):
+      # Created by a concurrent pour.
+      return
+    cls.objects.create(start_time=drink.time,
+        end_time=drink.time + session_delta, volume_ml=drink.volume_ml,
+        **lookup)
+
+  def _RemoveDrink(self, drink, remaining):
+    """Removes a drink from the chunk.
+
+    Args
+      drink: the drink to remove
+      remaining: queryset of the valid drinks left in the chunk
+    """
+    session_delta = drink.site.settings.GetSessionTimeoutDelta()
+    if drink.time <= self.start_time or drink.time + session_delta >= self.end_time:
+      # The drink bounded the chunk; find the new bounds.
+      times = remaining.aggregate(models.Min('time'), models.Max('time'))
+      if times['time__min'] is None:
+        self.delete()
+        return
+      self.start_time = times['time__min']
+      self.end_time = times['time__max'] + session_delta
+      type(self).objects.filter(pk=self.pk).update(
+          start_time=self.start_time, end_time=self.end_time)
+    self._SubtractVolume(drink.volume_ml)
+
+  def _SubtractVolume(self, volume_ml):
+    self.volume_ml -= volume_ml
+    type(self).objects.filter(pk=self.pk).update(
+        volume_ml=models.F('volume_ml') - volume_ml)
 
 
 class DrinkingSession(_AbstractChunk):
@@ -669,29 +1205,39 @@ class DrinkingSession(_AbstractChunk):
     else:
       return 'Session %i' % (self.seqn,)
 
-  def AddDrink(self, drink):
-    super(DrinkingSession, self).AddDrink(drink)
+  def AddDrink(self, drink, session_delta=None):
+    if session_delta is None:
+      session_delta = drink.site.settings.GetSessionTimeoutDelta()
+    super(DrinkingSession, self).AddDrink(drink, session_delta)
+    self._AddDrinkToChunks(drink, session_delta)
+
+  def _AddDrinkToChunks(self, drink, session_delta):
+    SessionChunk._AddDrinkToChunk(drink, session_delta, session_id=self.pk,
+        user_id=drink.user_id, keg_id=drink.keg_id)
+    UserSessionChunk._AddDrinkToChunk(drink, session_delta,
+        site_id=drink.site_id, session_id=self.pk, user_id=drink.user_id)
+    KegSessionChunk._AddDrinkToChunk(drink, session_delta,
+        site_id=drink.site_id, session_id=self.pk, keg_id=drink.keg_id)
+
+  def RemoveDrink(self, drink):
+    """Removes a drink, which must no longer be valid, from the session."""
     session_delta = drink.site.settings.GetSessionTimeoutDelta()
+    if drink.time <= self.start_time or drink.time + session_delta >= self.end_time:
+      # The drink bounded the session; rebuild it to find the new bounds.
+      self.Rebuild()
+      return
+    self._SubtractVolume(drink.volume_ml)
 
-    defaults = {
-      'start_time': drink.time,
-      'end_time': drink.time + session_delta,
-    }
-
-    # Update or create a SessionChunk.
-    chunk, created = SessionChunk.objects.get_or_create(session=self,
-        user=drink.user, keg=drink.keg, defaults=defaults)
-    chunk.AddDrink(drink)
-
-    # Update or create a UserSessionChunk.
-    chunk, created = UserSessionChunk.objects.get_or_create(session=self,
-        site=drink.site, user=drink.user, defaults=defaults)
-    chunk.AddDrink(drink)
-
-    # Update or create a KegSessionChunk.
-    chunk, created = KegSessionChunk.objects.get_or_create(session=self,
-        site=drink.site, keg=drink.keg, defaults=defaults)
-    chunk.AddDrink(drink)
+    drinks = self.drinks.valid()
+    chunks = (
+      (self.chunks.filter(user=drink.user, keg=drink.keg),
+          drinks.filter(user=drink.user, keg=drink.keg)),
+      (self.user_chunks.filter(user=drink.user), drinks.filter(user=drink.user)),
+      (self.keg_chunks.filter(keg=drink.keg), drinks.filter(keg=drink.keg)),
+    )
+    for chunk_qs, remaining in chunks:
+      for chunk in chunk_qs:
+        chunk._RemoveDrink(drink, remaining)
 
   def UserChunksByVolume(self):
     chunks = self.user_chunks.all().order_by('-volume_ml')
@@ -703,66 +1249,276 @@ class DrinkingSession(_AbstractChunk):
   def IsActive(self, now):
     return self.end_time > now
 
+  def _Merge(self, others):
+    """Moves the drinks of `others`, later sessions, into this one.
+
+    The other sessions are deleted, and the stats they figure in rebuilt.
+    """
+    site = self.site
+    others = [s.pk for s in others]
+    Drink.objects.filter(session__in=others).update(session=self)
+    Picture.objects.filter(session__in=others).update(session=self)
+
+    # Keep this session's start event, and one join event per drinker.
+    events = SystemEvent.objects.filter(session__in=others)
+    events.filter(kind='session_started').delete()
+    joined = self.events.filter(kind='session_joined').values_list('user',
+        flat=True)
+    events.filter(kind='session_joined', user__in=list(joined)).delete()
+    events.update(session=self)
+
+    DrinkingSession.objects.filter(pk__in=others).delete()
+    self.Rebuild()
+
+    # Session counts and session start times have changed.
+    drinks = self.drinks.valid().filter(postprocessed=True)
+    lookups = [(SystemStats, {})]
+    lookups += [(UserStats, {'user': u}) for u in
+        set(drinks.values_list('user', flat=True)) if u is not None]
+    lookups += [(KegStats, {'keg': k}) for k in
+        set(drinks.values_list('keg', flat=True)) if k is not None]
+    lookups.append((SessionStats, {'session': self}))
+    for model, lookup in lookups:
+      for record in model.objects.filter(site=site, **lookup):
+        record.Refresh(drinks.filter(**lookup)[0])
+
   def Rebuild(self):
-    self.volume_ml = 0
+    """Recomputes the session and its chunks from its valid drinks.
+
+    Each table is written with one grouped query and one bulk insert.
+    """
     self.chunks.all().delete()
     self.user_chunks.all().delete()
     self.keg_chunks.all().delete()
 
-    drinks = self.drinks.valid()
-    if not drinks:
+    drinks = self.drinks.valid().order_by()
+    totals = drinks.aggregate(models.Min('time'), models.Max('time'),
+        models.Sum('volume_ml'))
+    if totals['time__min'] is None:
       # TODO(mikey): cancel/delete the session entirely.  As it is, session will
       # remain a placeholder.
+      self.volume_ml = 0
+      self.save()
       return
 
     session_delta = self.site.settings.GetSessionTimeoutDelta()
-    min_time = None
-    max_time = None
-    for d in drinks:
-      self.AddDrink(d)
-      if min_time is None or d.time < min_time:
-        min_time = d.time
-      if max_time is None or d.time > max_time:
-        max_time = d.time
-    self.start_time = min_time
-    self.end_time = max_time + session_delta
+    self.start_time = totals['time__min']
+    self.end_time = totals['time__max'] + session_delta
+    self.volume_ml = totals['volume_ml__sum']
     self.save()
 
+    for model, group_by, extra in (
+        (SessionChunk, ('user', 'keg'), {}),
+        (UserSessionChunk, ('user',), {'site_id': self.site_id}),
+        (KegSessionChunk, ('keg',), {'site_id': self.site_id})):
+      groups = drinks.values(*group_by).annotate(models.Min('time'),
+          models.Max('time'), models.Sum('volume_ml'))
+      chunks = []
+      for group in groups:
+        fields = dict(extra)
+        for name in group_by:
+          fields[name + '_id'] = group[name]
+        chunks.append(model(session=self, start_time=group['time__min'],
+            end_time=group['time__max'] + session_delta,
+            volume_ml=group['volume_ml__sum'], **fields))
+      _BulkCreate(model, chunks)
+
   @classmethod
   def AssignSessionForDrink(cls, drink):
     # Return existing session if already assigned.
     if drink.session:
       return drink.session
 
-    # Return last session if one already exists
-    q = drink.site.sessions.all().order_by('-end_time')[:1]
-    if q and q[0].IsActive(drink.time):
-      session = q[0]
-      session.AddDrink(drink)
-      drink.session = session
-      drink.save()
-      return session
-
-    # Create a new session
-    session = cls(start_time=drink.time, end_time=drink.time,
-        site=drink.site)
-    session.save()
-    session.AddDrink(drink)
+    with _ActiveSession.lock:
+      version = _ActiveSession.Version()
+      active = _ActiveSession.ForSite(drink.site, version)
+      _session_writes.active = True
+      try:
+        if not (active and active.Covers(drink) and
+            active.AddDrink(drink)):
+          session_delta = drink.site.settings.GetSessionTimeoutDelta()
+          # The drink joins every session it falls within the timeout of, so
+          # a late drink may bridge (and merge) several.
+          sessions = list(drink.site.sessions.overlapping(drink.time,
+              drink.time + session_delta)[:3])
+          if sessions:
+            session = sessions[0]
+            if len(sessions) > 1:
+              session._Merge(sessions[1:])
+          else:
+            session = cls(start_time=drink.time, end_time=drink.time,
+                site=drink.site)
+            session.save()
+          active = _ActiveSession(session, session_delta)
+          active.AddDrink(drink)
+          active.latest = not drink.site.sessions.filter(
+              start_time__gt=session.start_time).exists()
+      finally:
+        _session_writes.active = False
+      active.Store(drink.site, version)
+
+    session = active.session
     drink.session = session
     drink.save()
     return session
 
+  @classmethod
+  def AssignSessionsForDrinks(cls, drinks):
+    """Assigns sessions to saved drinks of one site, in one sweep.
+
+    The drinks are split into runs wherever one comes after the previous has
+    timed out.  Each run joins (and merges) the sessions it overlaps, as its
+    drinks would one at a time, and each session touched is rebuilt once.
+    """
+    drinks = sorted(drinks, key=lambda d: d.time)
+    if not drinks:
+      return
+    site = drinks[0].site
+    session_delta = site.settings.GetSessionTimeoutDelta()
+    runs = [[drinks[0]]]
+    for d in drinks[1:]:
+      if d.time < runs[-1][-1].time + session_delta:
+        runs[-1].append(d)
+      else:
+        runs.append([d])
+
+    with _ActiveSession.lock:
+      for run in runs:
+        # The run spans less than len(run) timeouts.
+        sessions = list(site.sessions.overlapping(run[0].time,
+            run[-1].time + session_delta)[:len(run) + 2])
+        if sessions:
+          session = sessions[0]
+        else:
+          session = cls(start_time=run[0].time, end_time=run[0].time,
+              site=site)
+          session.save()
+        pks = [d.pk for d in run]
+        for i in xrange(0, len(pks), SessionRegenerator.UPDATE_SIZE):
+          Drink.objects.filter(pk__in=pks[i:i+SessionRegenerator.UPDATE_SIZE]
+              ).update(session=session)
+        if len(sessions) > 1:
+          session._Merge(sessions[1:])
+        else:
+          session.Rebuild()
+        for d in run:
+          d.session = session
+
+def _drinking_session_post_init(sender, instance, **kwargs):
+  # Remembered so that the slug is only recomputed when the name changes.
+  instance._saved_name = instance.name
+
 def _drinking_session_pre_save(sender, instance, **kwargs):
   session = instance
   if not session.name:
     session.name = 'Session %i' % session.seqn
 
-  # NOTE(mikey): Clear the slug so that updates cause it to be recomputed by
-  # AutoSlugField.  This could be spurious; is there a better way?
-  session.slug = ''
+  # Clear the slug so that AutoSlugField recomputes it from the new name.
+  if session.name != session._saved_name:
+    session.slug = ''
+
+def _drinking_session_post_save(sender, instance, **kwargs):
+  instance._saved_name = instance.name
 
+post_init.connect(_drinking_session_post_init, sender=DrinkingSession)
 pre_save.connect(_set_seqn_pre_save, sender=DrinkingSession)
 pre_save.connect(_drinking_session_pre_save, sender=DrinkingSession)
+post_save.connect(_drinking_session_post_save, sender=DrinkingSession)
+
+# Set while AssignSessionForDrink writes sessions and chunks, so that its own
+# writes don't invalidate the _ActiveSession it is updating.
+_session_writes = threading.local()
+
+class _ActiveSession(object):
+  """A site's latest session and the session timeout.
+
+  AssignSessionForDrink keeps one of these per site, so that a drink joining
+  the current session costs one indexed read, one UPDATE for the session and
+  one for each of its three chunks.
+
+  Any other write to a session, chunk or SiteSettings bumps a version number
+  kept in the Django cache, which discards every _ActiveSession.  The cache
+  may be per process (eg LocMemCache), so AddDrink also checks the database
+  for sessions written by other processes.
+  """
+  VERSION_KEY = 'kb:active-session-version'
+
+  lock = threading.RLock()
+
+  # _ActiveSession by site id.
+  _by_site = {}
+
+  def __init__(self, session, session_delta):
+    self.session = session
+    self.session_delta = session_delta
+    self.version = None
+    # Whether no session starts after this one.
+    self.latest = False
+
+  @classmethod
+  def Version(cls):
+    """Returns the current version, creating it if needed."""
+    return _CacheVersion(cls.VERSION_KEY)
+
+  @classmethod
+  def Invalidate(cls):
+    """Discards every _ActiveSession; returns the new version."""
+    return _BumpCacheVersion(cls.VERSION_KEY)
+
+  @classmethod
+  def ForSite(cls, site, version):
+    """Returns the _ActiveSession of `site` if it is still current."""
+    active = cls._by_site.get(site.id)
+    if active and version is not None and active.version == version:
+      return active
+    return None
+
+  def Store(self, site, version):
+    """Records this as the current _ActiveSession of `site`.
+
+    `version` is the version seen before this was last written to.  Anything
+    else written meanwhile means this may be out of date, so it is dropped.
+    """
+    new_version = self.Invalidate()
+    if self.latest and version is not None and new_version == version + 1:
+      self.version = new_version
+      self._by_site[site.id] = self
+    else:
+      self._by_site.pop(site.id, None)
+
+  def Covers(self, drink):
+    """Returns True if `drink` can only belong to this session.
+
+    This checks the database too, in case another process has ended, deleted
+    or started a session since this was stored.
+    """
+    session = self.session
+    if not (session.start_time <= drink.time and session.IsActive(drink.time)):
+      return False
+    overlapping = list(drink.site.sessions.overlapping(drink.time,
+        drink.time + self.session_delta).values_list('pk', 'start_time',
+        'end_time')[:2])
+    if len(overlapping) != 1 or overlapping[0][0] != session.pk:
+      return False
+    # Take up any drinks another process has added.
+    session.start_time, session.end_time = overlapping[0][1:]
+    return True
+
+  def AddDrink(self, drink):
+    """Adds `drink` to the session and its chunks.
+
+    Returns False, having written nothing, if the session no longer exists.
+    """
+    session = self.session
+    if not session._Accumulate(drink, self.session_delta, id=session.pk):
+      return False
+    session._AddDrinkNoSave(drink, self.session_delta)
+    session._AddDrinkToChunks(drink, self.session_delta)
+    return True
+
+def _sessions_changed(sender, instance, **kwargs):
+  if not getattr(_session_writes, 'active', False):
+    _ActiveSession.Invalidate()
 
 
 class SessionChunk(_AbstractChunk):
@@ -815,6 +1571,183 @@ class KegSessionChunk(_AbstractChunk):
     return self.session.GetTitle()
 
 
+post_save.connect(_sessions_changed, sender=DrinkingSession)
+post_delete.connect(_sessions_changed, sender=DrinkingSession)
+post_save.connect(_sessions_changed, sender=SessionChunk)
+post_delete.connect(_sessions_changed, sender=SessionChunk)
+post_save.connect(_sessions_changed, sender=UserSessionChunk)
+post_delete.connect(_sessions_changed, sender=UserSessionChunk)
+post_save.connect(_sessions_changed, sender=KegSessionChunk)
+post_delete.connect(_sessions_changed, sender=KegSessionChunk)
+post_save.connect(_sessions_changed, sender=SiteSettings)
+post_delete.connect(_sessions_changed, sender=SiteSettings)
+
+
+class _SweptSession(object):
+  """A session being built by SessionRegenerator."""
+  def __init__(self, seqn):
+    self.seqn = seqn
+    self.start_time = None
+    self.last_time = None
+    self.volume_ml = 0
+    self.drink_ids = []
+    # [start_time, last drink time, volume_ml], by (user id, keg id), user id
+    # and keg id.
+    self.chunks = {}
+    self.user_chunks = {}
+    self.keg_chunks = {}
+
+  def AddRow(self, drink_id, time, volume_ml, user_id, keg_id):
+    if self.start_time is None:
+      self.start_time = time
+    self.last_time = time
+    self.volume_ml += volume_ml
+    self.drink_ids.append(drink_id)
+    for chunks, key in ((self.chunks, (user_id, keg_id)),
+        (self.user_chunks, user_id), (self.keg_chunks, keg_id)):
+      chunk = chunks.get(key)
+      if chunk is None:
+        chunks[key] = [time, time, volume_ml]
+      else:
+        chunk[1] = time
+        chunk[2] += volume_ml
+
+
+class SessionRegenerator(object):
+  """Rebuilds every session of a site in one sweep over its drinks.
+
+  Valid drinks are read in time order and split into sessions wherever a
+  drink comes after the current session has timed out, as
+  DrinkingSession.AssignSessionForDrink does.  Sessions and chunks are
+  computed in memory and written with bulk inserts, a batch of sessions per
+  transaction; an interrupted run can be resumed from the last batch written.
+
+  Events and stats of the old sessions are deleted; run kb_regen_events and
+  kb_regen_stats afterwards.
+  """
+  # Sessions written per transaction.
+  BATCH_SIZE = 100
+
+  # Drinks per UPDATE.
+  UPDATE_SIZE = 500
+
+  def __init__(self, site):
+    self.site = site
+    self.session_delta = site.settings.GetSessionTimeoutDelta()
+    self.current = None
+    self.pending = []
+    self.next_seqn = 1
+
+  def Drinks(self):
+    """Returns the drinks still to be assigned, in sweep order."""
+    return self.site.drinks.valid().filter(session__isnull=True).order_by(
+        'time', 'seqn')
+
+  def Run(self, resume=False, progress=None):
+    """Rebuilds the sessions, calling `progress(drinks done)` as it goes.
+
+    If `resume` is set, the sessions written by an interrupted run are kept
+    and only the remaining drinks are swept.
+    """
+    _session_writes.active = True
+    try:
+      if resume:
+        last_seqn = self.site.sessions.aggregate(
+            models.Max('seqn'))['seqn__max']
+        self.next_seqn = (last_seqn or 0) + 1
+      else:
+        self.Clear()
+      rows = self.Drinks().values_list('id', 'time', 'volume_ml', 'user_id',
+          'keg_id')
+      for pos, row in enumerate(rows.iterator()):
+        self.AddRow(*row)
+        if progress:
+          progress(pos + 1)
+      self.Finish()
+    finally:
+      _session_writes.active = False
+      _ActiveSession.Invalidate()
+      SequenceCounter.Reset(self.site, DrinkingSession)
+
+  def Clear(self):
+    """Deletes every session of the site, with its chunks, events and stats."""
+    site = self.site
+    with transaction.commit_on_success():
+      site.drinks.filter(session__isnull=False).update(session=None)
+      Picture.objects.filter(session__site=site).update(session=None)
+      for model in (SystemEvent, SessionStats, SessionChunk, UserSessionChunk,
+          KegSessionChunk):
+        model.objects.filter(session__site=site).delete()
+      site.sessions.all().delete()
+
+  def AddRow(self, drink_id, time, volume_ml, user_id, keg_id):
+    """Adds the next drink, which must not be earlier than the last."""
+    current = self.current
+    if current is None or time >= current.last_time + self.session_delta:
+      if current is not None:
+        self.pending.append(current)
+        if len(self.pending) >= self.BATCH_SIZE:
+          self._WriteSessions(self.pending)
+          self.pending = []
+      current = self.current = _SweptSession(self.next_seqn)
+      self.next_seqn += 1
+    current.AddRow(drink_id, time, volume_ml, user_id, keg_id)
+
+  def Finish(self):
+    """Writes any sessions not yet written."""
+    if self.current is not None:
+      self.pending.append(self.current)
+      self.current = None
+    if self.pending:
+      self._WriteSessions(self.pending)
+      self.pending = []
+
+  def _WriteSessions(self, swept):
+    site = self.site
+    delta = self.session_delta
+    with transaction.commit_on_success():
+      _BulkCreate(DrinkingSession, [DrinkingSession(site=site,
+          seqn=s.seqn, name='Session %i' % s.seqn, start_time=s.start_time,
+          end_time=s.last_time + delta, volume_ml=s.volume_ml) for s in swept])
+      # bulk_create() doesn't report the new ids.
+      ids = dict(site.sessions.filter(seqn__in=[s.seqn for s in swept])
+          .values_list('seqn', 'id'))
+
+      chunks = []
+      user_chunks = []
+      keg_chunks = []
+      for s in swept:
+        session_id = ids[s.seqn]
+        for (user_id, keg_id), (start, last, volume) in s.chunks.iteritems():
+          chunks.append(SessionChunk(session_id=session_id, user_id=user_id,
+              keg_id=keg_id, start_time=start, end_time=last + delta,
+              volume_ml=volume))
+        for user_id, (start, last, volume) in s.user_chunks.iteritems():
+          user_chunks.append(UserSessionChunk(site=site, session_id=session_id,
+              user_id=user_id, start_time=start, end_time=last + delta,
+              volume_ml=volume))
+        for keg_id, (start, last, volume) in s.keg_chunks.iteritems():
+          keg_chunks.append(KegSessionChunk(site=site, session_id=session_id,
+              keg_id=keg_id, start_time=start, end_time=last + delta,
+              volume_ml=volume))
+      _BulkCreate(SessionChunk, chunks)
+      _BulkCreate(UserSessionChunk, user_chunks)
+      _BulkCreate(KegSessionChunk, keg_chunks)
+
+      for s in swept:
+        for i in xrange(0, len(s.drink_ids), self.UPDATE_SIZE):
+          drink_ids = s.drink_ids[i:i+self.UPDATE_SIZE]
+          Drink.objects.filter(pk__in=drink_ids).update(session=ids[s.seqn])
+          Picture.objects.filter(drink__in=drink_ids).update(
+              session=ids[s.seqn])
+
+
+# Default number of points returned by ThermoSensor.History().
+DEFAULT_HISTORY_POINTS = 500
+
+# Interval of raw temperature readings.
+RAW_PERIOD = datetime.timedelta(minutes=1)
+
 class ThermoSensor(models.Model):
   class Meta:
     unique_together = ('site', 'seqn')
@@ -828,12 +1761,72 @@ class ThermoSensor(models.Model):
     return '%s (%s) ' % (self.nice_name, self.raw_name)
 
   def LastLog(self):
+    if thermostore.Enabled():
+      latest = thermostore.ForSensor(self).Latest()
+      return latest and self._RingLog(*latest)
     try:
       return self.thermolog_set.latest()
     except Thermolog.DoesNotExist:
       return None
 
+  def Logs(self, start, end=None):
+    """Returns the Thermologs of this sensor from `start` until `end`, in order.
+
+    With the ring buffer store (see pykeg.core.thermostore) these are unsaved
+    Thermologs, numbered by minute.
+    """
+    if thermostore.Enabled():
+      return [self._RingLog(time, temp) for time, temp in
+          thermostore.ForSensor(self).Get(start, end)]
+    logs = self.thermolog_set.filter(time__gte=start)
+    if end is not None:
+      logs = logs.filter(time__lt=end)
+    return list(logs.order_by('time'))
+
+  def RecentLogs(self, count):
+    """Returns the latest `count` Thermologs of this sensor, newest first,
+    however old they are."""
+    if thermostore.Enabled():
+      readings = thermostore.ForSensor(self).Get(thermostore.EPOCH)[-count:]
+      return [self._RingLog(time, temp) for time, temp in reversed(readings)]
+    return list(self.thermolog_set.order_by('-time')[:count])
+
+  def Summaries(self, period, start, end=None):
+    """Returns the `period` summaries of this sensor covering `start` to `end`."""
+    summaries = self.thermosummarylog_set.filter(period=period,
+        time__gte=ThermoSummaryLog.PeriodStart(period, start))
+    if end is not None:
+      summaries = summaries.filter(time__lt=end)
+    return summaries.order_by('time')
+
+  def History(self, start, end=None, max_points=DEFAULT_HISTORY_POINTS):
+    """Returns (period, records) for this sensor from `start` to `end`.
+
+    The records are the finest that cover the range in at most `max_points`:
+    Thermologs, with period None, while raw readings are still kept;
+    otherwise hourly, daily or weekly ThermoSummaryLogs.
+    """
+    now = datetime.datetime.now()
+    span = (end or now) - start
+    if thermostore.Enabled():
+      keep_time = datetime.timedelta(minutes=getattr(settings,
+          'KEGBOT_THERMO_STORE_MINUTES', thermostore.DEFAULT_MINUTES))
+    else:
+      keep_time = Thermolog.KEEP_TIME
+    if start >= now - keep_time and span <= max_points * RAW_PERIOD:
+      return None, self.Logs(start, end)
+    for period, length in ThermoSummaryLog.PERIODS:
+      if span <= max_points * length:
+        break
+    return period, list(self.Summaries(period, start, end))
+
+  def _RingLog(self, time, temp):
+    return Thermolog(site_id=self.site_id, sensor=self,
+        seqn=thermostore.ToMinute(time), temp=temp, time=time)
+
 pre_save.connect(_set_seqn_pre_save, sender=ThermoSensor)
+post_save.connect(_tap_config_changed, sender=ThermoSensor)
+post_delete.connect(_tap_config_changed, sender=ThermoSensor)
 
 
 class Thermolog(models.Model):
@@ -843,6 +1836,18 @@ class Thermolog(models.Model):
     get_latest_by = 'time'
     ordering = ('-time',)
 
+  # Readings are kept at least this long; see PurgeOld().
+  KEEP_TIME = datetime.timedelta(hours=24)
+
+  # Readings deleted per query by PurgeOld().
+  PURGE_CHUNK_SIZE = 500
+
+  # Least time between purges by PurgeOldIfDue().
+  PURGE_INTERVAL = datetime.timedelta(minutes=10)
+
+  _purge_lock = threading.Lock()
+  _last_purge = None
+
   site = models.ForeignKey(KegbotSite, related_name='thermologs')
   seqn = models.PositiveIntegerField(editable=False)
   sensor = models.ForeignKey(ThermoSensor)
@@ -859,42 +1864,96 @@ class Thermolog(models.Model):
   def TempF(self):
     return util.CtoF(self.temp)
 
-def _thermolog_post_save(sender, instance, **kwargs):
-  daily_date = datetime.datetime(year=instance.time.year,
-      month=instance.time.month,
-      day=instance.time.day)
-  defaults = {
-      'site': instance.site,
-      'num_readings': 1,
-      'min_temp': instance.temp,
-      'max_temp': instance.temp,
-      'mean_temp': instance.temp,
-  }
-  daily_log, created = ThermoSummaryLog.objects.get_or_create(
-      sensor=instance.sensor,
-      period='daily',
-      time=daily_date,
-      defaults=defaults)
-
-  if not created:
-    new_mean = daily_log.num_readings * daily_log.mean_temp + instance.temp
-    new_mean /= daily_log.num_readings + 1
-    daily_log.mean_temp = new_mean
-
-    daily_log.num_readings += 1
-
-    if instance.temp > daily_log.max_temp:
-      daily_log.max_temp = instance.temp
-    if instance.temp < daily_log.min_temp:
-      daily_log.min_temp = instance.temp
+  @classmethod
+  def PurgeOld(cls, keep_time=None, max_chunks=None):
+    """Deletes readings older than `keep_time` ago, a chunk at a time.
+
+    Stops after `max_chunks` chunks, if given.  Returns the number deleted.
+    """
+    if keep_time is None:
+      keep_time = cls.KEEP_TIME
+    cutoff = datetime.datetime.now() - keep_time
+    deleted = 0
+    chunks = 0
+    while max_chunks is None or chunks < max_chunks:
+      ids = list(cls.objects.filter(time__lt=cutoff).values_list('id',
+          flat=True)[:cls.PURGE_CHUNK_SIZE])
+      if not ids:
+        break
+      cls.objects.filter(id__in=ids).delete()
+      deleted += len(ids)
+      chunks += 1
+    return deleted
 
-  daily_log.save()
+  @classmethod
+  def PurgeOldIfDue(cls):
+    """Deletes a chunk of old readings, at most once per PURGE_INTERVAL.
+
+    Without Celery there is no purge_thermologs task, so LogSensorReadings
+    calls this instead.  Returns the number deleted.
+    """
+    now = datetime.datetime.now()
+    with cls._purge_lock:
+      if cls._last_purge and now - cls._last_purge < cls.PURGE_INTERVAL:
+        return 0
+      cls._last_purge = now
+    return cls.PurgeOld(max_chunks=1)
 
-  # Keep at least the most recent 24 hours, dropping any older entries.
-  now = datetime.datetime.now()
-  keep_time = now - datetime.timedelta(hours=24)
-  old_entries = Thermolog.objects.filter(site=instance.site, time__lt=keep_time)
-  old_entries.delete()
+  @classmethod
+  def SaveMany(cls, logs):
+    """Saves new readings of one site, with times rounded to the minute.
+
+    A reading replaces any already kept for its sensor and minute, and a later
+    reading in `logs` replaces an earlier one.  Existing readings are found with
+    one query and replaced with one update per distinct temperature; the rest
+    are inserted in bulk.  Returns the saved Thermolog for each of `logs`.
+    """
+    if not logs:
+      return []
+    site = logs[0].site
+    latest = {}
+    for log in logs:
+      latest[(log.sensor_id, log.time)] = log
+
+    def _Saved():
+      times = [time for sensor_id, time in latest]
+      return cls.objects.filter(site=site,
+          sensor__in=set(sensor_id for sensor_id, time in latest),
+          time__gte=min(times), time__lte=max(times))
+
+    existing = {}
+    for pk, sensor_id, time in _Saved().values_list('id', 'sensor', 'time'):
+      existing.setdefault((sensor_id, time), []).append(pk)
+
+    replaced = {}
+    new = []
+    for key, log in latest.iteritems():
+      if key in existing:
+        replaced.setdefault(log.temp, []).extend(existing[key])
+      else:
+        new.append(log)
+    for temp, ids in replaced.iteritems():
+      for i in xrange(0, len(ids), BULK_CREATE_PARAMS):
+        cls.objects.filter(id__in=ids[i:i+BULK_CREATE_PARAMS]).update(
+            temp=temp)
+
+    if new:
+      new.sort(key=lambda log: log.time)
+      first = SequenceCounter.Reserve(site, cls, len(new))
+      for i, log in enumerate(new):
+        log.seqn = first + i
+      _BulkCreate(cls, new)
+      # bulk_create sends no signals, so do what _thermolog_post_save would.
+      for log in new:
+        ThermoSummaryLog.AddReading(log)
+
+    saved = dict(((log.sensor_id, log.time), log) for log in
+        _Saved().select_related('sensor'))
+    return [saved[(log.sensor_id, log.time)] for log in logs]
+
+def _thermolog_post_save(sender, instance, created, **kwargs):
+  if created:
+    ThermoSummaryLog.AddReading(instance)
 
 pre_save.connect(_set_seqn_pre_save, sender=Thermolog)
 post_save.connect(_thermolog_post_save, sender=Thermolog)
@@ -903,10 +1962,19 @@ post_save.connect(_thermolog_post_save, sender=Thermolog)
 class ThermoSummaryLog(models.Model):
   """A summarized temperature sensor log."""
   class Meta:
-    unique_together = ('site', 'seqn')
+    unique_together = (('site', 'seqn'), ('sensor', 'period', 'time'))
 
   PERIOD_CHOICES = (
+    ('hourly', 'hourly'),
     ('daily', 'daily'),
+    ('weekly', 'weekly'),
+  )
+
+  # Length of each period, finest first.
+  PERIODS = (
+    ('hourly', datetime.timedelta(hours=1)),
+    ('daily', datetime.timedelta(days=1)),
+    ('weekly', datetime.timedelta(weeks=1)),
   )
   site = models.ForeignKey(KegbotSite, related_name='thermosummarylogs')
   seqn = models.PositiveIntegerField(editable=False)
@@ -919,8 +1987,145 @@ class ThermoSummaryLog(models.Model):
   max_temp = models.FloatField()
   mean_temp = models.FloatField()
 
-pre_save.connect(_set_seqn_pre_save, sender=ThermoSummaryLog)
+  # Readings not yet written, as [count, sum, min, max] by (site id, sensor
+  # id, period, time).
+  _pending = {}
+  _pending_lock = threading.Lock()
+  _last_flush = datetime.datetime.now()
+  # Flushes pending readings if no later reading does; see AddReading().
+  _timer = None
+
+  @classmethod
+  def PeriodStart(cls, period, time):
+    """Returns the start of the `period` containing `time`."""
+    if period == 'hourly':
+      return time.replace(minute=0, second=0, microsecond=0)
+    day = datetime.datetime(time.year, time.month, time.day)
+    if period == 'weekly':
+      day -= datetime.timedelta(days=day.weekday())
+    return day
+
+  @classmethod
+  def AddReading(cls, log):
+    """Adds a Thermolog to its hourly, daily and weekly summaries.
+
+    Readings are summed in memory and written by Flush(), which is called
+    every KEGBOT_THERMO_FLUSH_SECONDS: by the next reading once that is due,
+    or else by a timer started with the first reading pending.  Readings not
+    yet flushed are lost if the process exits.
+    """
+    now = datetime.datetime.now()
+    seconds = getattr(settings, 'KEGBOT_THERMO_FLUSH_SECONDS', 300)
+    interval = datetime.timedelta(seconds=seconds)
+    with cls._pending_lock:
+      for period, length in cls.PERIODS:
+        key = (log.site_id, log.sensor_id, period,
+            cls.PeriodStart(period, log.time))
+        pending = cls._pending.get(key)
+        if pending is None:
+          cls._pending[key] = [1, log.temp, log.temp, log.temp]
+        else:
+          pending[0] += 1
+          pending[1] += log.temp
+          pending[2] = min(pending[2], log.temp)
+          pending[3] = max(pending[3], log.temp)
+      due = now - cls._last_flush >= interval
+      if not due and cls._timer is None:
+        cls._timer = threading.Timer(seconds, cls._TimedFlush)
+        cls._timer.daemon = True
+        cls._timer.start()
+    if due:
+      cls.Flush()
+
+  @classmethod
+  def _TimedFlush(cls):
+    try:
+      cls.Flush()
+    except Exception:
+      logger.exception('Error flushing temperature summaries')
+    finally:
+      # The timer's thread has a database connection of its own.
+      connection.close()
+
+  @classmethod
+  def Flush(cls):
+    """Writes the summaries of readings added since the last flush."""
+    with cls._pending_lock:
+      pending, cls._pending = cls._pending, {}
+      cls._last_flush = datetime.datetime.now()
+      timer, cls._timer = cls._timer, None
+    if timer:
+      timer.cancel()
+    for key, values in sorted(pending.iteritems()):
+      with transaction.commit_on_success():
+        if cls._Merge(key, values):
+          continue
+        site_id, sensor_id, period, time = key
+        count, total, low, high = values
+        sid = transaction.savepoint()
+        try:
+          cls.objects.create(site_id=site_id, sensor_id=sensor_id,
+              period=period, time=time, num_readings=count,
+              min_temp=low, max_temp=high, mean_temp=total / count)
+          transaction.savepoint_commit(sid)
+        except IntegrityError:
+          # Created by a concurrent flush.
+          transaction.savepoint_rollback(sid)
+          cls._Merge(key, values)
+
+  @classmethod
+  def _Merge(cls, key, values):
+    """Adds pending readings to their summary, if it exists.
+
+    Returns False, having written nothing, if it does not.
+    """
+    site_id, sensor_id, period, time = key
+    count, total, low, high = values
+    rows = list(cls.objects.select_for_update().filter(sensor=sensor_id,
+        period=period, time=time)[:1])
+    if not rows:
+      return False
+    log = rows[0]
+    num_readings = log.num_readings + count
+    log.mean_temp = (log.mean_temp * log.num_readings + total) / num_readings
+    log.num_readings = num_readings
+    log.min_temp = min(log.min_temp, low)
+    log.max_temp = max(log.max_temp, high)
+    log.save()
+    return True
 
+  @classmethod
+  def _FlushAtExit(cls):
+    """Writes pending readings, then stops the flush timer."""
+    with cls._pending_lock:
+      timer = cls._timer
+    try:
+      cls.Flush()
+    except Exception:
+      logger.exception('Error flushing temperature summaries')
+    if timer:
+      timer.cancel()
+      timer.join()
+
+pre_save.connect(_set_seqn_pre_save, sender=ThermoSummaryLog)
+atexit.register(ThermoSummaryLog._FlushAtExit)
+
+
+def _KnownFields(values, descriptor):
+  """Returns `values` limited to the fields of a message `descriptor`, as
+  protoutil.DictToProtoMessage would read them."""
+  ret = {}
+  for name, field in descriptor.fields_by_name.iteritems():
+    if name not in values:
+      continue
+    value = values[name]
+    if field.type == field.TYPE_MESSAGE:
+      if field.label == field.LABEL_REPEATED:
+        value = [_KnownFields(v, field.message_type) for v in value]
+      else:
+        value = _KnownFields(value, field.message_type)
+    ret[name] = value
+  return ret
 
 class _StatsModel(models.Model):
   STATS_BUILDER = None
@@ -928,20 +2133,86 @@ class _StatsModel(models.Model):
   class Meta:
     abstract = True
 
+  def _IndexCacheKey(self):
+    return (self.__class__.__name__, self.pk)
+
+  def StatsJson(self):
+    """Returns the stats as stored JSON text, decoding them only if modified."""
+    return self._meta.get_field('stats').value_to_string(self)
+
+  def _PreviousStats(self):
+    """Returns the current stats as a StatsIndex or models_pb2.Stats."""
+    # Reuse the indexed stats from this process's last update of the record,
+    # unless the record has changed since.
+    previous = stats.CachedIndex(self._IndexCacheKey(), self.StatsJson())
+    if previous is None and self.stats:
+      try:
+        previous = protoutil.DictToProtoMessage(self.stats, models_pb2.Stats())
+      except TypeError:
+        pass
+    return previous
+
+  def _SaveStats(self, builder, result):
+    serialized = kbjson.dumps(protoutil.ProtoMessageToDict(result))
+    self.stats = serialized
+    self.save()
+    if builder.index:
+      stats.CacheIndex(self._IndexCacheKey(), builder.index, serialized)
+
   def Update(self, drink, force=False):
     previous = None
-    try:
-      if not force and self.stats:
-        previous = protoutil.DictToProtoMessage(self.stats, models_pb2.Stats())
-    except TypeError, e:
-      pass
+    if not force:
+      previous = self._PreviousStats()
     builder = self.STATS_BUILDER(drink, previous)
-    self.stats = protoutil.ProtoMessageToDict(builder.Build())
-    self.save()
+    self._SaveStats(builder, builder.Build())
+
+  def UpdateMany(self, drinks):
+    """Adds several drinks, in seqn order, saving the record once."""
+    previous = self._PreviousStats()
+    for drink in drinks:
+      builder = self.STATS_BUILDER(drink, previous)
+      result = builder.Build()
+      previous = builder.index
+    self._SaveStats(builder, result)
+
+  def Refresh(self, drink):
+    """Rebuilds the record, whose stats cover `drink`, from scratch.
+
+    Only post-processed drinks are included; the rest are added as they are
+    post-processed.
+    """
+    builder = self.STATS_BUILDER(drink)
+    last_qs = builder._ScopeDrinks().filter(postprocessed=True)
+    last_qs = last_qs.order_by('-seqn')[:1]
+    if not last_qs:
+      self.delete()
+      return
+    self.Update(last_qs[0], force=True)
+
+  def Revert(self, drink):
+    """Removes `drink`, which must no longer be valid, from these stats.
+
+    The record is deleted once it covers no drinks.
+    """
+    previous = self._PreviousStats()
+    builder = self.STATS_BUILDER(drink, previous)
+    if not previous or not builder.CanRevert():
+      # Some stat can't be reverted; rebuild from the remaining drinks.
+      last_qs = builder._ScopeDrinks().order_by('-seqn')[:1]
+      if not last_qs:
+        self.delete()
+        return
+      self.Update(last_qs[0], force=True)
+      return
+    result = builder.Revert()
+    if not result.total_pours:
+      self.delete()
+      return
+    self._SaveStats(builder, result)
 
   site = models.ForeignKey(KegbotSite)
   time = models.DateTimeField(default=datetime.datetime.now)
-  stats = fields.JSONField()
+  stats = jsonfield.LazyJSONField()
 
 
 class SystemStats(_StatsModel):
@@ -978,6 +2249,16 @@ class SessionStats(_StatsModel):
   def __str__(self):
     return 'SessionStats for %s' % self.session
 
+def _stats_pre_save(sender, instance, **kwargs):
+  # Only fields of models_pb2.Stats are stored, so the API can send the stored
+  # text as is.  Text from the stats builders has no others.
+  value = instance.__dict__['stats']
+  if not isinstance(value, basestring):
+    instance.stats = _KnownFields(value, models_pb2.Stats.DESCRIPTOR)
+
+for _model in (SystemStats, UserStats, KegStats, SessionStats):
+  pre_save.connect(_stats_pre_save, sender=_model)
+
 
 class SystemEvent(models.Model):
   class Meta:
@@ -3,7 +3,15 @@
 import datetime
 import unittest
 
+from django.core.management import call_command
+from django.db import IntegrityError
+from django.db import connection
+from django.db.models import F
+from django.test.utils import override_settings
+
+from pykeg.core.backend import backend
 from pykeg.core.backend.django import KegbotBackend
+from pykeg.core import forecast
 from pykeg.core import kb_common
 from pykeg.core import models
 
@@ -73,6 +81,9 @@ class CoreModelsTestCase(unittest.TestCase):
         username='kb_tester2',
     )
 
+    self.sensor = models.ThermoSensor.objects.create(site=self.site,
+        raw_name='thermo-test', nice_name='Test Sensor')
+
   def tearDown(self):
     self.user.delete()
     self.user2.delete()
@@ -81,6 +92,8 @@ class CoreModelsTestCase(unittest.TestCase):
     self.beer_type.delete()
     self.beer_style.delete()
     self.brewer.delete()
+    # Drinks without a keg or user, eg from testTapConfig, go with the site.
+    self.site.delete()
 
   def testKegStuff(self):
     """Test basic keg relations that should always work."""
@@ -101,7 +114,506 @@ class CoreModelsTestCase(unittest.TestCase):
 
     print d
 
-    self.assertEqual(self.keg.served_volume(), d.volume_ml)
+    keg = models.Keg.objects.get(pk=self.keg.pk)
+    self.assertEqual(keg.served_volume(), d.volume_ml)
+    self.assertEqual(d.keg.served_volume(), d.volume_ml)
+
+    # Edits and cancellations are reflected.
+    d2 = self.backend.RecordDrink(tap_name=self.tap.meter_name, ticks=2200)
+    d.volume_ml += 10
+    d.save()
+    self.backend.CancelDrink(d2.seqn)
+    keg = models.Keg.objects.get(pk=self.keg.pk)
+    self.assertAlmostEqual(keg.served_volume(), d.volume_ml)
+    self.assertAlmostEqual(keg.ServedVolumeFromDrinks(), d.volume_ml)
+
+    # A keg saved from an out of date copy keeps the counter.
+    self.keg.description = 'Still our first keg'
+    self.keg.save()
+    keg = models.Keg.objects.get(pk=self.keg.pk)
+    self.assertAlmostEqual(keg.served_volume(), d.volume_ml)
+
+    # Drift is repaired by kb_reconcile_kegs.
+    models.Keg.objects.filter(pk=keg.pk).update(served_ml=1)
+    call_command('kb_reconcile_kegs')
+    keg = models.Keg.objects.get(pk=self.keg.pk)
+    self.assertAlmostEqual(keg.served_volume(), d.volume_ml)
+
+  def testKegForecast(self):
+    start = self.keg.start_time
+    def record(days):
+      return self.backend.RecordDrink(tap_name=self.tap.meter_name,
+          ticks=220, pour_time=start + datetime.timedelta(days=days))
+
+    # Too little history for a forecast.
+    self.assertEqual(self.keg.ConsumptionRate(now=start), None)
+    self.assertEqual(self.keg.PredictedEmptyTime(now=start), None)
+
+    # 100 mL a day, for ten days.
+    drinks = [record(days) for days in range(10)]
+    now = start + datetime.timedelta(days=10)
+    keg = models.Keg.objects.get(pk=self.keg.pk)
+    rate = keg.ConsumptionRate(now=now)
+    self.assertTrue(abs(rate * 24 - 100) < 10, rate)
+    empty_time = keg.PredictedEmptyTime(now=now)
+    days_left = (keg.remaining_volume() / 100.0)
+    self.assertTrue(abs(empty_time - now - datetime.timedelta(days=days_left))
+        < datetime.timedelta(days=2), empty_time)
+
+    # A cancelled drink is taken back out.
+    self.backend.CancelDrink(drinks[-1].seqn)
+    keg = models.Keg.objects.get(pk=self.keg.pk)
+    self.assertTrue(keg.ConsumptionRate(now=now) < rate)
+
+    # Rebuilding from the session chunks gives the same model.
+    rate = keg.ConsumptionRate(now=now)
+    models.Keg.objects.filter(pk=keg.pk).update(forecast_weight=0)
+    keg.RebuildForecast()
+    keg = models.Keg.objects.get(pk=self.keg.pk)
+    self.assertAlmostEqual(keg.ConsumptionRate(now=now), rate)
+
+    # Pours long after the epoch move it, without changing the model.
+    later = now + forecast.REBASE_AFTER
+    rate = keg.ConsumptionRate(now=later)
+    keg.AddServedVolume(0, later)
+    keg = models.Keg.objects.get(pk=self.keg.pk)
+    self.assertEqual(keg.forecast_epoch, later)
+    self.assertAlmostEqual(keg.ConsumptionRate(now=later) / rate, 1.0)
+
+    keg.status = 'offline'
+    self.assertEqual(keg.PredictedEmptyTime(now=now), None)
+
+  def testRecordDrinks(self):
+    base_time = datetime.datetime(2009, 1, 1, 1, 0, 0)
+    def item(minutes, username=None, **kwargs):
+      kwargs.setdefault('tap_name', self.tap.meter_name)
+      kwargs.update(ticks=100, username=username,
+          pour_time=base_time + datetime.timedelta(minutes=minutes))
+      return kwargs
+
+    earlier = self.backend.RecordDrink(**item(0))
+    results = self.backend.RecordDrinks([
+      item(500, self.user.username),
+      item(10, self.user2.username),
+      item(20, tap_name='unknown'),
+      item(30, spilled=True),
+      item(5, self.user.username),
+    ])
+    self.assertEqual(len(results), 5)
+    d500, d10, error, spill, d5 = results
+    self.assertTrue(isinstance(error, backend.BackendError))
+    self.assertEqual(spill, None)
+
+    # Numbered in time order, after the earlier drink.
+    self.assertEqual([d.seqn for d in (d5, d10, d500)],
+        range(earlier.seqn + 1, earlier.seqn + 4))
+    self.assertEqual(d5.session, earlier.session)
+    self.assertEqual(d10.session, earlier.session)
+    self.assertNotEqual(d500.session, earlier.session)
+    session = models.DrinkingSession.objects.get(pk=earlier.session.pk)
+    self.assertAlmostEqual(session.volume_ml,
+        earlier.volume_ml + d5.volume_ml + d10.volume_ml)
+    self.assertEqual(session.user_chunks.count(), 3)
+
+    keg = models.Keg.objects.get(pk=self.keg.pk)
+    self.assertAlmostEqual(keg.served_volume(), keg.ServedVolumeFromDrinks())
+    self.assertAlmostEqual(keg.spilled_ml, d5.volume_ml)
+    stats = self.site.GetStats()
+    self.assertEqual(stats['total_pours'], 4)
+    self.assertEqual(stats['sessions_count'], 2)
+    self.assertEqual(models.UserStats.objects.get(user=self.user).stats[
+        'total_pours'], 2)
+
+  def testTapConfig(self):
+    def record(**kwargs):
+      return self.backend.RecordDrink(tap_name=self.tap.meter_name, ticks=100,
+          **kwargs)
+
+    record()
+    connection.use_debug_cursor = True
+    try:
+      del connection.queries[:]
+      d = record()
+      # A spill is written to the keg directly, leaving the config cached.
+      record(spilled=True)
+      record()
+      queries = [q['sql'] for q in connection.queries]
+    finally:
+      connection.use_debug_cursor = False
+    for table in ('core_kegtap', 'core_keg', 'core_sitesettings'):
+      self.assertFalse([q for q in queries
+          if q.startswith('SELECT') and 'FROM "%s"' % table in q], table)
+    self.assertEqual(d.keg, self.keg)
+    self.assertAlmostEqual(models.Keg.objects.get(pk=self.keg.pk).spilled_ml,
+        d.volume_ml)
+
+    # A change made by another process, with its own cache, is seen too.
+    models.KegTap.objects.filter(pk=self.tap.pk).update(ml_per_tick=3.0)
+    models.KegbotSite.objects.filter(pk=self.site.pk).update(
+        config_version=F('config_version') + 1)
+    self.assertAlmostEqual(record().volume_ml, 300.0)
+
+    # Saving a tap, keg or settings is seen by the next pour.
+    self.tap.ml_per_tick = 2.0
+    self.tap.save()
+    self.assertAlmostEqual(record().volume_ml, 200.0)
+    self.keg.status = 'offline'
+    self.keg.save()
+    self.assertEqual(record().keg, None)
+    self.site.settings.default_user = self.user
+    self.site.settings.save()
+    self.assertEqual(record().user, self.user)
+    self.site.settings.default_user = None
+    self.site.settings.save()
+
+  def testThermoSummary(self):
+    now = datetime.datetime.now().replace(second=0, microsecond=0)
+    day = datetime.datetime(now.year, now.month, now.day)
+    # Purged explicitly below.
+    models.Thermolog._last_purge = datetime.datetime.now()
+    models.Thermolog.objects.create(site=self.site, sensor=self.sensor,
+        temp=1.0, time=now - datetime.timedelta(days=2))
+    with override_settings(KEGBOT_THERMO_FLUSH_SECONDS=3600):
+      models.ThermoSummaryLog.Flush()
+      for minutes, temp in ((0, 4.0), (1, 2.0)):
+        self.backend.LogSensorReading(self.sensor.raw_name, temp,
+            when=now.replace(minute=minutes))
+      # Replacing a reading writes no new row.
+      self.backend.LogSensorReading(self.sensor.raw_name, 3.0,
+          when=now.replace(minute=1))
+      summaries = models.ThermoSummaryLog.objects.filter(sensor=self.sensor,
+          time=day)
+      self.assertEqual(summaries.count(), 0)
+
+      models.ThermoSummaryLog.Flush()
+      self.backend.LogSensorReading(self.sensor.raw_name, 9.0,
+          when=now.replace(minute=2))
+      models.ThermoSummaryLog.Flush()
+    summary = summaries.get()
+    self.assertEqual(summary.num_readings, 3)
+    self.assertEqual(summary.min_temp, 2.0)
+    self.assertEqual(summary.max_temp, 9.0)
+    self.assertAlmostEqual(summary.mean_temp, 5.0)
+
+    # Pending readings are flushed by a timer if no later reading comes.
+    with override_settings(KEGBOT_THERMO_FLUSH_SECONDS=3600):
+      self.backend.LogSensorReading(self.sensor.raw_name, 1.0,
+          when=now.replace(minute=3))
+      self.assertNotEqual(models.ThermoSummaryLog._timer, None)
+      models.ThermoSummaryLog.Flush()
+      self.assertEqual(models.ThermoSummaryLog._timer, None)
+    self.assertEqual(summaries.get().num_readings, 4)
+    self.assertRaises(IntegrityError, models.ThermoSummaryLog.objects.create,
+        site=self.site, sensor=self.sensor, period='daily', time=day,
+        num_readings=1, min_temp=1.0, max_temp=1.0, mean_temp=1.0)
+
+    # Only readings older than KEEP_TIME are purged.
+    self.assertEqual(self.sensor.thermolog_set.count(), 5)
+    self.assertEqual(models.Thermolog.PurgeOld(), 1)
+    self.assertEqual(self.sensor.thermolog_set.count(), 4)
+
+    # Without Celery, logging readings purges too, at most once per interval.
+    def log_old():
+      models.Thermolog.objects.create(site=self.site, sensor=self.sensor,
+          temp=1.0, time=now - datetime.timedelta(days=2))
+      self.backend.LogSensorReading(self.sensor.raw_name, 2.0,
+          when=now.replace(minute=3))
+    models.Thermolog._last_purge = None
+    log_old()
+    self.assertEqual(self.sensor.thermolog_set.count(), 4)
+    log_old()
+    self.assertEqual(self.sensor.thermolog_set.count(), 5)
+    self.assertEqual(models.Thermolog.PurgeOld(max_chunks=1), 1)
+
+  def testRecentLogs(self):
+    now = datetime.datetime.now().replace(second=0, microsecond=0)
+    sensor = models.ThermoSensor.objects.create(site=self.site,
+        raw_name='thermo-quiet', nice_name='thermo-quiet')
+    for hours in (5, 4, 3):
+      models.Thermolog.objects.create(site=self.site, sensor=sensor,
+          temp=float(hours), time=now - datetime.timedelta(hours=hours))
+    # However old, the latest readings are returned, newest first.
+    self.assertEqual([l.temp for l in sensor.RecentLogs(2)], [3.0, 4.0])
+
+  def testLogSensorReadings(self):
+    now = datetime.datetime.now().replace(second=0, microsecond=0)
+    minute = lambda n: now - datetime.timedelta(minutes=n)
+    sensor = models.ThermoSensor.objects.create(site=self.site,
+        raw_name='thermo-batch', nice_name='thermo-batch')
+    models.Thermolog.objects.create(site=self.site, sensor=sensor,
+        temp=1.0, time=minute(5))
+    self.backend.LogSensorReading('thermo-new', 2.0, when=minute(9))
+    models.TapConfig.ForSite(self.site)
+
+    connection.use_debug_cursor = True
+    try:
+      del connection.queries[:]
+      results = self.backend.LogSensorReadings([
+        (sensor.raw_name, 4.0, minute(5) + datetime.timedelta(seconds=30)),
+        (sensor.raw_name, 5.0, minute(4)),
+        ('thermo-new', 6.0, minute(4)),
+        (sensor.raw_name, 1000.0, minute(3)),
+        ('thermo-new', 7.0, minute(4)),
+      ])
+      queries = [q['sql'] for q in connection.queries]
+    finally:
+      connection.use_debug_cursor = False
+
+    # Sensors came from the cache; one insert for both new readings.
+    self.assertFalse([q for q in queries if 'FROM "core_thermosensor"' in q])
+    self.assertEqual(len([q for q in queries
+        if q.startswith('INSERT INTO "core_thermolog"')]), 1)
+
+    self.assertTrue(isinstance(results[3], ValueError))
+    self.assertEqual([r.temp for r in results[:3]], [4.0, 5.0, 7.0])
+    self.assertEqual(results[2], results[4])
+    self.assertEqual(results[0].time, minute(5))
+    self.assertEqual(
+        [(l.time, l.temp) for l in sensor.thermolog_set.order_by('time')],
+        [(minute(5), 4.0), (minute(4), 5.0)])
+    new_sensor = models.ThermoSensor.objects.get(site=self.site,
+        raw_name='thermo-new')
+    self.assertEqual(new_sensor.nice_name, 'thermo-new')
+    self.assertEqual(new_sensor.thermolog_set.count(), 2)
+
+  def testThermoHistory(self):
+    now = datetime.datetime.now().replace(second=0, microsecond=0)
+    start = now - datetime.timedelta(days=10)
+    models.ThermoSummaryLog.Flush()
+    for i in range(40):
+      models.Thermolog.objects.create(site=self.site, sensor=self.sensor,
+          temp=float(i % 4), time=start + datetime.timedelta(hours=6 * i))
+    models.ThermoSummaryLog.Flush()
+
+    weekly = self.sensor.Summaries('weekly', start)
+    self.assertEqual(sum(s.num_readings for s in weekly), 40)
+    self.assertTrue(all(s.time.weekday() == 0 for s in weekly))
+    daily = self.sensor.Summaries('daily', start)
+    self.assertEqual(sum(s.num_readings for s in daily), 40)
+    self.assertEqual(daily[1].mean_temp, 1.5)
+
+    period, records = self.sensor.History(now - datetime.timedelta(hours=8))
+    self.assertEqual(period, None)
+    self.assertEqual(len(records), 1)
+    for max_points, expected in ((500, 'hourly'), (20, 'daily'),
+        (5, 'weekly')):
+      period, records = self.sensor.History(start, max_points=max_points)
+      self.assertEqual(period, expected)
+      self.assertEqual(sum(r.num_readings for r in records), 40)
+
+  def testSequenceCounter(self):
+    def record():
+      return self.backend.RecordDrink(tap_name=self.tap.meter_name, ticks=100)
+
+    self.assertEqual(record().seqn, 1)
+    self.assertEqual(record().seqn, 2)
+
+    # Counters start from the largest stored seqn.
+    models.SequenceCounter.Reset(self.site)
+    self.assertEqual(record().seqn, 3)
+
+    # Another process claiming numbers is noticed.
+    models.SequenceCounter.objects.filter(site=self.site,
+        name='drink').update(value=10)
+    self.assertEqual(record().seqn, 11)
+
+    with override_settings(KEGBOT_SEQN_BLOCK_SIZE=5):
+      # Drinks are never numbered in blocks.
+      self.assertEqual([record().seqn for i in range(2)], [12, 13])
+      counter = models.SequenceCounter.objects.get(site=self.site,
+          name='drink')
+      self.assertEqual(counter.value, 13)
+
+      def event():
+        return models.SequenceCounter.Next(self.site, models.SystemEvent)
+      models.SequenceCounter.Reset(self.site, models.SystemEvent)
+      first = event()
+      self.assertEqual([event() for i in range(5)], range(first + 1,
+          first + 6))
+      counter = models.SequenceCounter.objects.get(site=self.site,
+          name='systemevent')
+      self.assertEqual(counter.value, first + 9)
+
+      # A reset by another process discards this process's block.
+      models.SequenceCounter.objects.filter(pk=counter.pk).update(
+          value=first, generation=F('generation') + 1)
+      self.assertEqual(event(), first + 1)
+    models.SequenceCounter.Reset(self.site)
+    self.assertEqual(models.SequenceCounter.objects.get(pk=counter.pk).value,
+        first - 1)
+
+  def testActiveSession(self):
+    base_time = datetime.datetime(2009, 1, 1, 1, 0, 0)
+    def record(minutes):
+      return self.backend.RecordDrink(tap_name=self.tap.meter_name,
+          ticks=100, username=self.user.username,
+          pour_time=base_time + datetime.timedelta(minutes=minutes))
+    def set_timeout(minutes):
+      site_settings = self.site.settings
+      site_settings.session_timeout_minutes = minutes
+      site_settings.save()
+
+    set_timeout(15)
+    d1 = record(0)
+    d2 = record(10)
+    s1 = d1.session
+    self.assertEqual(d2.session, s1)
+    self.assertEqual(s1.user_chunks.get().volume_ml,
+        d1.volume_ml + d2.volume_ml)
+
+    # A settings change applies to the next drink.
+    set_timeout(60)
+    self.assertEqual(record(20).session, s1)
+    self.assertEqual(record(75).session, s1)
+
+    # So does a session deleted elsewhere.
+    s1.delete()
+    s2 = record(80).session
+    self.assertNotEqual(s2, s1)
+    self.assertEqual(s2.chunks.get().volume_ml, s2.volume_ml)
+
+    # Writes by another process don't reach this process's cache, but are
+    # seen in the database: here, a session ended early and a new one begun.
+    models.DrinkingSession.objects.filter(pk=s2.pk).update(
+        end_time=base_time + datetime.timedelta(minutes=85))
+    models.DrinkingSession.objects.bulk_create([models.DrinkingSession(
+        site=self.site, seqn=1000, name='Elsewhere',
+        start_time=base_time + datetime.timedelta(minutes=86),
+        end_time=base_time + datetime.timedelta(minutes=146))])
+    s3 = models.DrinkingSession.objects.get(site=self.site, seqn=1000)
+    self.assertEqual(record(90).session, s3)
+    set_timeout(kb_common.DRINK_SESSION_TIME_MINUTES)
+
+  def testSessionAccumulation(self):
+    d1 = self.backend.RecordDrink(tap_name=self.tap.meter_name, ticks=100,
+        pour_time=datetime.datetime(2009, 1, 1, 1, 0, 0))
+    d2 = self.backend.RecordDrink(tap_name=self.tap.meter_name, ticks=200,
+        pour_time=datetime.datetime(2009, 1, 1, 1, 5, 0))
+    session = d1.session
+    slug = session.slug
+
+    # Writes from out of date copies add up, rather than overwriting.
+    first = models.KegSessionChunk.objects.get(session=session)
+    second = models.KegSessionChunk.objects.get(session=session)
+    first.AddDrink(d1)
+    second.AddDrink(d2)
+    chunk = models.KegSessionChunk.objects.get(session=session)
+    self.assertAlmostEqual(chunk.volume_ml, 2 * (d1.volume_ml + d2.volume_ml))
+    self.assertEqual(chunk.start_time, d1.time)
+
+    # The slug only changes with the name.
+    session = models.DrinkingSession.objects.get(pk=session.pk)
+    session.save()
+    self.assertEqual(session.slug, slug)
+    session.name = 'Party time'
+    session.save()
+    self.assertEqual(session.slug, 'party-time')
+
+  def testRegenerateSessions(self):
+    base_time = datetime.datetime(2009, 1, 1, 1, 0, 0)
+    minutes = (0, 5, 20, 300, 310, 600, 601, 900)
+    usernames = (self.user.username, self.user2.username, None)
+    for i, m in enumerate(minutes):
+      self.backend.RecordDrink(tap_name=self.tap.meter_name, ticks=100 + i,
+          username=usernames[i % 3],
+          pour_time=base_time + datetime.timedelta(minutes=m))
+
+    def snapshot():
+      result = []
+      for s in self.site.sessions.order_by('seqn'):
+        result.append((s.seqn, s.start_time, s.end_time, s.volume_ml,
+            sorted((c.user_id, c.keg_id, c.start_time, c.end_time,
+                c.volume_ml) for c in s.chunks.all()),
+            sorted((c.user_id, c.volume_ml) for c in s.user_chunks.all()),
+            sorted((c.keg_id, c.volume_ml) for c in s.keg_chunks.all()),
+            sorted(s.drinks.values_list('seqn', flat=True))))
+      return result
+
+    expected = snapshot()
+    self.assertEqual(len(expected), 4)
+    models.SessionRegenerator(self.site).Run()
+    self.assertEqual(snapshot(), expected)
+
+    # Interrupt a run after two sessions have been written, then resume it.
+    class Interrupted(Exception):
+      pass
+    def interrupt(pos):
+      if pos == 6:
+        raise Interrupted
+    regen = models.SessionRegenerator(self.site)
+    regen.BATCH_SIZE = 1
+    self.assertRaises(Interrupted, regen.Run, progress=interrupt)
+    self.assertEqual(self.site.sessions.count(), 2)
+    models.SessionRegenerator(self.site).Run(resume=True)
+    self.assertEqual(snapshot(), expected)
+
+    # New drinks go to the right session afterwards.
+    d = self.backend.RecordDrink(tap_name=self.tap.meter_name, ticks=100,
+        pour_time=base_time + datetime.timedelta(minutes=905))
+    self.assertEqual(d.session.seqn, 4)
+    d = self.backend.RecordDrink(tap_name=self.tap.meter_name, ticks=100,
+        pour_time=base_time + datetime.timedelta(minutes=2000))
+    self.assertEqual(d.session.seqn, 5)
+
+  def testRebuildSession(self):
+    base_time = datetime.datetime(2009, 1, 1, 1, 0, 0)
+    usernames = (self.user.username, self.user2.username, None)
+    for i in range(6):
+      d = self.backend.RecordDrink(tap_name=self.tap.meter_name,
+          ticks=100 + i, username=usernames[i % 3],
+          pour_time=base_time + datetime.timedelta(minutes=i))
+    session = d.session
+
+    def snapshot():
+      s = models.DrinkingSession.objects.get(pk=session.pk)
+      def rows(chunks, *fields):
+        return sorted(tuple(getattr(c, f) for f in fields) +
+            (c.start_time, c.end_time, round(c.volume_ml, 6)) for c in chunks)
+      return (s.start_time, s.end_time, round(s.volume_ml, 6),
+          rows(s.chunks.all(), 'user_id', 'keg_id'),
+          rows(s.user_chunks.all(), 'user_id', 'site_id'),
+          rows(s.keg_chunks.all(), 'keg_id', 'site_id'))
+
+    expected = snapshot()
+    session.Rebuild()
+    self.assertEqual(snapshot(), expected)
+
+  def testLateDrinkMergesSessions(self):
+    base_time = datetime.datetime(2009, 1, 1, 1, 0, 0)
+    def record(minutes, username):
+      return self.backend.RecordDrink(tap_name=self.tap.meter_name,
+          ticks=100, username=username,
+          pour_time=base_time + datetime.timedelta(minutes=minutes))
+
+    d1 = record(0, self.user.username)
+    d2 = record(200, self.user2.username)
+    self.assertNotEqual(d1.session, d2.session)
+    self.assertEqual(self.site.GetStats()['sessions_count'], 2)
+
+    # Replayed from an offline kegboard, within the timeout of both.
+    d3 = record(100, self.user2.username)
+    session = d3.session
+    self.assertEqual(session, d1.session)
+    self.assertEqual(list(self.site.sessions.all()), [session])
+    self.assertEqual(session.drinks.count(), 3)
+    self.assertEqual(session.start_time, base_time)
+    self.assertEqual(session.end_time, d2.time + datetime.timedelta(
+        minutes=kb_common.DRINK_SESSION_TIME_MINUTES))
+    self.assertAlmostEqual(session.volume_ml,
+        d1.volume_ml + d2.volume_ml + d3.volume_ml)
+    self.assertEqual(session.user_chunks.count(), 2)
+    self.assertEqual(session.events.filter(kind='session_started').count(), 1)
+    self.assertEqual(session.events.filter(kind='session_joined').count(), 2)
+
+    stats = self.site.GetStats()
+    self.assertEqual(stats['sessions_count'], 1)
+    self.assertEqual(stats['total_pours'], 3)
+    stats = models.UserStats.objects.get(user=self.user2).stats
+    self.assertEqual(stats['sessions_count'], 1)
+    self.assertEqual(stats['total_pours'], 2)
+
+    # A later drink after the merge joins the same session.
+    self.assertEqual(record(210, self.user.username).session, session)
 
   def testDrinkSessions(self):
     """ Checks for the DrinkingSession records. """
@@ -174,15 +686,15 @@ class CoreModelsTestCase(unittest.TestCase):
 
     SESSION_DELTA = datetime.timedelta(minutes=kb_common.DRINK_SESSION_TIME_MINUTES)
 
-    # session 1: should be 10 minutes long as created above
-    self.assertEqual(s1.start_time, drinks_u1[0].start_time)
-    self.assertEqual(s1.start_time, drinks_u1[1].end_time)
+    # session 1: drinks 10 minutes apart, plus the session timeout
+    self.assertEqual(s1.start_time, drinks_u1[0].time)
+    self.assertEqual(s1.end_time, drinks_u1[1].time + SESSION_DELTA)
     self.assertEqual(s1.drinks.valid().filter(user=u1).count(), 2)
     self.assertEqual(s1.drinks.valid().filter(user=u2).count(), 1)
 
     # session 2: at time 200, 1 drink
     self.assertEqual(s2.start_time, base_time + td_190m)
-    self.assertEqual(s2.end_time, base_time + td_200m)
+    self.assertEqual(s2.end_time, base_time + td_200m + SESSION_DELTA)
     self.assertEqual(s2.drinks.valid().filter(user=u1).count(), 1)
     self.assertEqual(s2.drinks.valid().filter(user=u2).count(), 2)
 
@@ -190,7 +702,7 @@ class CoreModelsTestCase(unittest.TestCase):
     # match
     u2_c2 = u2_chunks[1]
     self.assertEqual(u2_c2.start_time, base_time+td_190m)
-    self.assertEqual(u2_c2.end_time, base_time+td_200m)
+    self.assertEqual(u2_c2.end_time, base_time+td_200m+SESSION_DELTA)
 
     # Now check DrinkingSessions were created correctly; there should be
     # two groups capturing all 4 sessions.
@@ -198,9 +710,9 @@ class CoreModelsTestCase(unittest.TestCase):
     self.assertEqual(len(all_groups), 2)
 
     self.assertEqual(all_groups[0].start_time, base_time)
-    self.assertEqual(all_groups[0].end_time, base_time+td_10m)
+    self.assertEqual(all_groups[0].end_time, base_time+td_10m+SESSION_DELTA)
     self.assertEqual(all_groups[0].user_chunks.all().count(), 2)
 
     self.assertEqual(all_groups[1].start_time, base_time+td_190m)
-    self.assertEqual(all_groups[1].end_time, base_time+td_200m)
+    self.assertEqual(all_groups[1].end_time, base_time+td_200m+SESSION_DELTA)
     self.assertEqual(all_groups[1].user_chunks.all().count(), 2)
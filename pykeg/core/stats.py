@@ -18,230 +18,704 @@
 
 """Methods to generate cached statistics from drinks."""
 
-import copy
-import inspect
-import itertools
-import logging
+import collections
 
 from kegbot.api import models_pb2
 
+from pykeg.core.optional_modules import HAVE_NUMPY
+
+if HAVE_NUMPY:
+  from pykeg.core import stats_numpy
+
+# Stats plugged in by register_stat(), keyed by statname.  Each value is a
+# (function, builders) tuple.
 STAT_MAP = {}
 
-def stat(statname):
+# Volume below which a reverted volume_by_* entry is considered empty, allowing
+# for floating point residue.
+EMPTY_VOLUME_ML = 0.001
+
+# Cache of _OrderedStats() results, keyed by builder class.
+_ORDERED_STATS = {}
+
+def stat(statname, depends=()):
+  """Marks a builder method as the implementation of stat `statname`.
+
+  The method is called with each DrinkRow added to the stats.  The stats named
+  in `depends` are always updated before it.
+  """
   def decorate(f):
     setattr(f, 'statname', statname)
+    setattr(f, 'depends', tuple(depends))
+    return f
+  return decorate
+
+def inverse(statname):
+  """Marks a builder method as the inverse of stat `statname`.
+
+  The method is called with a DrinkRow to be removed from the stats, and must
+  undo that drink's contribution.  The drink is no longer among the builder's
+  _ScopeDrinks() when it is called.
+  """
+  def decorate(f):
+    setattr(f, 'inverse_of', statname)
+    return f
+  return decorate
+
+def merge(statname):
+  """Marks a builder method as the merge function of stat `statname`.
+
+  The method is called with another builder, whose full rebuild covered the
+  drinks following this builder's, and must add that builder's stat to its own.
+  """
+  def decorate(f):
+    setattr(f, 'merge_of', statname)
+    return f
+  return decorate
+
+def register_stat(statname, depends=(), builders=None, inverse=None,
+    merge=None):
+  """Decorator which plugs a new stat into existing builders.
+
+  The decorated function is called as `fn(builder, row)`, just like a @stat
+  method.  By default the stat is added to every builder; otherwise only to
+  `builders` and their subclasses.  Registering an existing statname replaces
+  it.  Without an `inverse` function, stats including this one are rebuilt in
+  full when a drink is removed; without a `merge` function, they can't be
+  rebuilt in parallel.
+  """
+  def decorate(f):
+    stat(statname, depends)(f)
+    setattr(f, 'inverse', inverse)
+    setattr(f, 'merge', merge)
+    STAT_MAP[statname] = (f, builders)
+    _ORDERED_STATS.clear()
     return f
   return decorate
 
-class StatsBuilder:
+def unregister_stat(statname):
+  """Removes a stat plugged in by register_stat()."""
+  del STAT_MAP[statname]
+  _ORDERED_STATS.clear()
+
+def _OrderedStats(builder_class):
+  """Returns the stat functions of `builder_class`, dependencies first."""
+  ordered = _ORDERED_STATS.get(builder_class)
+  if ordered is not None:
+    return ordered
+
+  stat_map = dict(builder_class.STATS)
+  for statname, (fn, builders) in STAT_MAP.iteritems():
+    if builders is None or issubclass(builder_class, tuple(builders)):
+      stat_map[statname] = fn
+
+  ordered = []
+  done = set()
+  def visit(statname, pending):
+    if statname in done:
+      return
+    if statname in pending:
+      raise ValueError('Circular stat dependency: %s' % statname)
+    if statname not in stat_map:
+      raise ValueError('Unknown stat: %s' % statname)
+    fn = stat_map[statname]
+    for dep in fn.depends:
+      visit(dep, pending + (statname,))
+    done.add(statname)
+    ordered.append(fn)
+  for statname in sorted(stat_map):
+    visit(statname, ())
+
+  _ORDERED_STATS[builder_class] = ordered
+  return ordered
+
+def _OrderedCompanions(builder_class, kind):
+  """Returns the `kind` function ('inverse' or 'merge') of each of
+  _OrderedStats(), or None where missing."""
+  if kind == 'inverse':
+    class_fns = builder_class.INVERSES
+  else:
+    class_fns = builder_class.MERGES
+  companions = []
+  for fn in _OrderedStats(builder_class):
+    if builder_class.STATS.get(fn.statname) is fn:
+      companions.append(class_fns.get(fn.statname))
+    else:
+      companions.append(getattr(fn, kind, None))
+  return companions
+
+def _Vectorizable(builder_class):
+  """Returns True if stats_numpy computes exactly the stats of `builder_class`.
+  """
+  if not HAVE_NUMPY:
+    return False
+  stat_fns = _OrderedStats(builder_class)
+  base_stats = BaseStatsBuilder.STATS
+  return (len(stat_fns) == len(base_stats) and
+      all(base_stats.get(fn.statname) is fn for fn in stat_fns))
+
+class _StatsBuilderMeta(type):
+  """Collects the @stat, @inverse and @merge methods of a builder class.
+
+  This happens once, when the class is defined, rather than every time a
+  builder is constructed.
+  """
+  def __init__(cls, name, bases, attrs):
+    super(_StatsBuilderMeta, cls).__init__(name, bases, attrs)
+    cls.STATS = {}
+    cls.INVERSES = {}
+    cls.MERGES = {}
+    for attrname in dir(cls):
+      fn = getattr(cls, attrname)
+      statname = getattr(fn, 'statname', None)
+      if statname:
+        cls.STATS[statname] = fn.im_func
+      inverse_of = getattr(fn, 'inverse_of', None)
+      if inverse_of:
+        cls.INVERSES[inverse_of] = fn.im_func
+      merge_of = getattr(fn, 'merge_of', None)
+      if merge_of:
+        cls.MERGES[merge_of] = fn.im_func
+
+# Drink columns read by a full rebuild, in DrinkRow order.
+DRINK_ROW_FIELDS = ('seqn', 'volume_ml', 'time', 'user__username',
+    'session', 'session__start_time', 'user', 'keg')
+
+class DrinkRow(collections.namedtuple('DrinkRow', ('seqn', 'volume_ml', 'time',
+    'username', 'session_id', 'session_start_time', 'user_id', 'keg_id'))):
+  """The subset of a Drink that stats are computed from.
+
+  A full rebuild reads these straight off a values_list() cursor, rather than
+  instantiating (and lazily joining) a Drink model per row.
+  """
+  __slots__ = ()
+
+  @classmethod
+  def FromDrink(cls, drink):
+    username = None
+    if drink.user:
+      username = drink.user.username
+    session_start_time = None
+    if drink.session:
+      session_start_time = drink.session.start_time
+    return cls(drink.seqn, drink.volume_ml, drink.time, username,
+        drink.session_id, session_start_time, drink.user_id, drink.keg_id)
+
+
+# Maximum number of StatsIndex objects kept by CacheIndex().
+INDEX_CACHE_SIZE = 1000
+
+_INDEX_CACHE = {}
+
+class StatsIndex(object):
+  """A models_pb2.Stats message, plus lookup tables over its contents.
+
+  The tables are kept in step with the message as stats are added, so that
+  adding a drink costs the same no matter how many drinkers, years or sessions
+  the stats already cover.
+  """
+  def __init__(self, stats=None):
+    if stats is None:
+      stats = models_pb2.Stats()
+    self.stats = stats
+    self.drinkers = set(stats.registered_drinkers)
+    # Every session seen, when known (ie, after a full rebuild).
+    self.sessions = None
+    # Session of the drink given by stats.last_drink_id, if known.
+    self.last_session_id = None
+    self._entries = {}
+
+  def Entry(self, fieldname, keyname, key):
+    """Returns the entry of repeated field `fieldname` with the given key.
+
+    A new entry is added if none exists.
+    """
+    entries = self._entries.get(fieldname)
+    if entries is None:
+      entries = dict((getattr(entry, keyname), entry)
+          for entry in getattr(self.stats, fieldname))
+      self._entries[fieldname] = entries
+    entry = entries.get(key)
+    if entry is None:
+      entry = getattr(self.stats, fieldname).add()
+      setattr(entry, keyname, key)
+      entries[key] = entry
+    return entry
+
+  def RemoveEntry(self, fieldname, keyname, key):
+    """Drops the entry of repeated field `fieldname` with the given key."""
+    entries = getattr(self.stats, fieldname)
+    for i, entry in enumerate(entries):
+      if getattr(entry, keyname) == key:
+        del entries[i]
+        break
+    self._entries.pop(fieldname, None)
+
+  def RemoveEmptyEntries(self, fieldname):
+    """Drops entries of repeated field `fieldname` having no volume."""
+    entries = getattr(self.stats, fieldname)
+    for i in reversed(xrange(len(entries))):
+      if not entries[i].volume_ml:
+        del entries[i]
+    self._entries.pop(fieldname, None)
+
+  def __getstate__(self):
+    return (self.stats.SerializeToString(), self.sessions, self.last_session_id)
+
+  def __setstate__(self, state):
+    serialized, sessions, last_session_id = state
+    stats = models_pb2.Stats()
+    stats.ParseFromString(serialized)
+    self.__init__(stats)
+    self.sessions = sessions
+    self.last_session_id = last_session_id
+
+
+def CachedIndex(key, serialized):
+  """Returns the cached StatsIndex for `key`, if it was stored as `serialized`.
+
+  Comparing the stored form, rather than decoding it, lets an unchanged record
+  skip decoding altogether.
+  """
+  cached = _INDEX_CACHE.get(key)
+  if cached is not None and cached[1] == serialized:
+    return cached[0]
+  return None
+
+def CacheIndex(key, index, serialized):
+  """Keeps `index`, stored as `serialized`, for a later incremental build."""
+  if len(_INDEX_CACHE) >= INDEX_CACHE_SIZE and key not in _INDEX_CACHE:
+    _INDEX_CACHE.clear()
+  _INDEX_CACHE[key] = (index, serialized)
+
+
+class StatsBuilder(object):
+  __metaclass__ = _StatsBuilderMeta
+
   def __init__(self, drink, previous=None):
+    """Constructor.
+
+    Args
+      drink: the most recent drink to include in the stats
+      previous: stats as of the drink before `drink`, either as a
+          models_pb2.Stats message or a StatsIndex; if not given, stats are
+          rebuilt from every drink.  A StatsIndex is updated in place.
+    """
     self.drink = drink
     self.previous = previous
-    self.STAT_MAP = {}
-    for name, fn in inspect.getmembers(self, inspect.ismethod):
-      if hasattr(fn, 'statname'):
-        self.STAT_MAP[fn.statname] = fn
+    self.index = None
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state.pop('stats', None)
+    state.pop('_stat_fns', None)
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    if self.index:
+      self.stats = self.index.stats
+    self._stat_fns = _OrderedStats(self.__class__)
+
+  def _ScopeDrinks(self):
+    """Returns every valid drink the builder's stats cover, unordered."""
+    return []
 
   def _AllDrinks(self):
     return []
 
+  def _DrinkRows(self):
+    """Streams every drink in the builder's scope, in order, as DrinkRows."""
+    qs = self._AllDrinks().values_list(*DRINK_ROW_FIELDS)
+    return (DrinkRow._make(values) for values in qs.iterator())
+
+  def _Reset(self):
+    """Sets initial values of a full rebuild."""
+    pass
+
+  def _Prepare(self):
+    """Called before adding a drink to previous stats."""
+    pass
+
+  def _Finish(self):
+    """Called after all drinks have been added."""
+    pass
+
+  def _LoadIndex(self):
+    if isinstance(self.previous, StatsIndex):
+      self.index = self.previous
+    elif self.previous:
+      stats = models_pb2.Stats()
+      stats.MergeFrom(self.previous)
+      self.index = StatsIndex(stats)
+    else:
+      self.index = StatsIndex()
+    self.stats = self.index.stats
+
   def Build(self):
-    self.stats = models_pb2.Stats()
     if not self.drink:
-      return self.stats
-    self.drinks = self._AllDrinks()
+      return models_pb2.Stats()
+    self._LoadIndex()
     if self.previous:
-      self.stats.MergeFrom(self.previous)
-    for statname, fn in self.STAT_MAP.iteritems():
-      fn()
+      self._Prepare()
+      rows = [DrinkRow.FromDrink(self.drink)]
+    elif _Vectorizable(self.__class__):
+      return self.BuildFromColumns(stats_numpy.DrinkColumns(self._DrinkRows()))
+    else:
+      self._Reset()
+      rows = self._DrinkRows()
+    stat_fns = _OrderedStats(self.__class__)
+    for row in rows:
+      for fn in stat_fns:
+        fn(self, row)
+    self._Finish()
+    return self.stats
+
+  def BuildFromColumns(self, columns):
+    """Builds stats from all drinks in a stats_numpy.DrinkColumns."""
+    stats, sessions, last_session_id = columns.Stats()
+    self.previous = None
+    self.index = StatsIndex(stats)
+    self.index.sessions = sessions
+    self.index.last_session_id = last_session_id
+    self.stats = stats
+    return stats
+
+  def Start(self):
+    """Begins a full rebuild, fed with AddRow() rather than by Build()."""
+    self.previous = None
+    self._LoadIndex()
+    self._Reset()
+    self._stat_fns = _OrderedStats(self.__class__)
+
+  def AddRow(self, row):
+    """Adds a DrinkRow, following the previous one, to a Start()ed rebuild."""
+    for fn in self._stat_fns:
+      fn(self, row)
+
+  def Finish(self):
+    """Completes a Start()ed rebuild, returning its stats."""
+    self._Finish()
+    return self.stats
+
+  def CanMerge(self):
+    """Returns True if every stat of this builder has a merge function."""
+    return None not in _OrderedCompanions(self.__class__, 'merge')
+
+  def Merge(self, other):
+    """Adds another Start()ed rebuild to this one, before Finish().
+
+    `other` must cover the drinks immediately following those of this builder.
+    Raises ValueError if some stat cannot be merged; see CanMerge().
+    """
+    merge_fns = _OrderedCompanions(self.__class__, 'merge')
+    if None in merge_fns:
+      raise ValueError('Stats cannot be merged.')
+    for fn in merge_fns:
+      fn(self, other)
+
+  def CanRevert(self):
+    """Returns True if every stat of this builder has an inverse."""
+    return None not in _OrderedCompanions(self.__class__, 'inverse')
+
+  def Revert(self):
+    """Returns the previous stats, less the contribution of `self.drink`.
+
+    The drink must no longer be valid.  Raises ValueError if some stat cannot
+    be reverted; see CanRevert().
+    """
+    inverse_fns = _OrderedCompanions(self.__class__, 'inverse')
+    if not self.previous or None in inverse_fns:
+      raise ValueError('Stats cannot be reverted.')
+    self._LoadIndex()
+    row = DrinkRow.FromDrink(self.drink)
+    for fn in inverse_fns:
+      fn(self, row)
     return self.stats
 
 
 class BaseStatsBuilder(StatsBuilder):
-  """Builder which generates a variety of stats from object information."""
+  """Builder which generates a variety of stats from object information.
+
+  Each stat method adds a single DrinkRow to `self.stats`.  An incremental
+  build applies them to the new drink only; a full rebuild applies them to
+  every drink, in a single pass.
+  """
+
+  def _Reset(self):
+    self.stats.last_drink_id = 0
+    self.stats.total_volume_ml = 0
+    self.stats.total_pours = 0
+    self.stats.average_volume_ml = 0.0
+    self.stats.greatest_volume_ml = 0
+    self.stats.greatest_volume_id = 0
+    self.stats.has_guest_pour = False
+    self.stats.sessions_count = 0
+    self.index.sessions = set()
+
+  def _Prepare(self):
+    index = self.index
+    if index.last_session_id is None and index.sessions is None:
+      # Not known from an earlier build; one lookup by primary key.
+      prev = self.drink.site.drinks.filter(seqn=self.stats.last_drink_id)
+      prev = prev.values_list('session', flat=True)
+      if prev:
+        index.last_session_id = prev[0]
+
+  def _Finish(self):
+    if not self.previous:
+      # A full rebuild omits empty entries from these.
+      self.index.RemoveEmptyEntries('volume_by_day_of_week')
+      self.index.RemoveEmptyEntries('volume_by_drinker')
+
+  def _SubtractVolume(self, fieldname, keyname, key, volume_ml):
+    entry = self.index.Entry(fieldname, keyname, key)
+    entry.volume_ml -= volume_ml
+    if entry.volume_ml < EMPTY_VOLUME_ML:
+      self.index.RemoveEntry(fieldname, keyname, key)
+
+  def _AddVolumes(self, other, fieldname, keyname):
+    for entry in getattr(other.stats, fieldname):
+      key = getattr(entry, keyname)
+      self.index.Entry(fieldname, keyname, key).volume_ml += entry.volume_ml
 
   @stat('last_drink_id')
-  def LastDrinkId(self):
-    self.stats.last_drink_id = self.drink.seqn
+  def LastDrinkId(self, row):
+    self.stats.last_drink_id = row.seqn
+
+  @inverse('last_drink_id')
+  def RevertLastDrinkId(self, row):
+    if row.seqn != self.stats.last_drink_id:
+      return
+    last = self._ScopeDrinks().order_by('-seqn')
+    last = last.values_list('seqn', 'session')[:1]
+    if last:
+      self.stats.last_drink_id, self.index.last_session_id = last[0]
+    else:
+      self.stats.last_drink_id = 0
+      self.index.last_session_id = None
+
+  @merge('last_drink_id')
+  def MergeLastDrinkId(self, other):
+    if other.stats.last_drink_id:
+      self.stats.last_drink_id = other.stats.last_drink_id
+      self.index.last_session_id = other.index.last_session_id
 
   @stat('total_volume_ml')
-  def TotalVolume(self):
-    if not self.previous:
-      self.stats.total_volume_ml = sum(drink.volume_ml for drink in self.drinks)
-    else:
-      self.stats.total_volume_ml += self.drink.volume_ml
+  def TotalVolume(self, row):
+    self.stats.total_volume_ml += row.volume_ml
 
-  @stat('total_pours')
-  def TotalPours(self):
-    if not self.previous:
-      self.stats.total_pours = self.drinks.count()
-    else:
-      self.stats.total_pours += 1
+  @inverse('total_volume_ml')
+  def RevertTotalVolume(self, row):
+    self.stats.total_volume_ml -= row.volume_ml
 
-  @stat('average_volume_ml')
-  def AverageVolume(self):
-    if not self.previous:
-      count = self.drinks.count()
-      average = 0.0
-      if count:
-        average = sum(drink.volume_ml for drink in self.drinks) / float(count)
-      self.stats.average_volume_ml = average
-    else:
-      vol = self.previous.total_volume_ml
-      count = self.previous.total_pours
-      vol += self.drink.volume_ml
-      count += 1
-      self.stats.average_volume_ml = vol / float(count)
+  @merge('total_volume_ml')
+  def MergeTotalVolume(self, other):
+    self.stats.total_volume_ml += other.stats.total_volume_ml
 
-  @stat('greatest_volume_ml')
-  def GreatestVolume(self):
-    if not self.previous:
-      res = 0
-      drinks = self.drinks.order_by('-volume_ml')
-      if drinks.count():
-        res = drinks[0].volume_ml
-      self.stats.greatest_volume_ml = res
+  @stat('total_pours')
+  def TotalPours(self, row):
+    self.stats.total_pours += 1
+
+  @inverse('total_pours')
+  def RevertTotalPours(self, row):
+    self.stats.total_pours -= 1
+
+  @merge('total_pours')
+  def MergeTotalPours(self, other):
+    self.stats.total_pours += other.stats.total_pours
+
+  @stat('average_volume_ml', depends=('total_volume_ml', 'total_pours'))
+  def AverageVolume(self, row):
+    count = self.stats.total_pours
+    if count:
+      self.stats.average_volume_ml = self.stats.total_volume_ml / float(count)
+
+  @inverse('average_volume_ml')
+  def RevertAverageVolume(self, row):
+    self._RecomputeAverageVolume()
+
+  @merge('average_volume_ml')
+  def MergeAverageVolume(self, other):
+    self._RecomputeAverageVolume()
+
+  def _RecomputeAverageVolume(self):
+    count = self.stats.total_pours
+    if count:
+      self.stats.average_volume_ml = self.stats.total_volume_ml / float(count)
     else:
-      if self.drink.volume_ml > self.previous.greatest_volume_ml:
-        self.stats.greatest_volume_ml = self.drink.volume_ml
+      self.stats.average_volume_ml = 0.0
 
-  @stat('greatest_volume_id')
-  def GreatestVolumeId(self):
-    if not self.previous:
-      res = 0
-      drinks = self.drinks.order_by('-volume_ml')
-      if drinks.count():
-        res = drinks[0].seqn
-      self.stats.greatest_volume_id = res
+  @stat('greatest_volume_ml')
+  def GreatestVolume(self, row):
+    """Records greatest_volume_ml and greatest_volume_id."""
+    if (row.volume_ml > self.stats.greatest_volume_ml or
+        not self.stats.greatest_volume_id):
+      self.stats.greatest_volume_ml = row.volume_ml
+      self.stats.greatest_volume_id = row.seqn
+
+  @inverse('greatest_volume_ml')
+  def RevertGreatestVolume(self, row):
+    # A maximum can't be inverted; look for the next greatest drink, but only
+    # when the removed drink was the greatest.
+    if row.seqn != self.stats.greatest_volume_id:
+      return
+    greatest = self._ScopeDrinks().order_by('-volume_ml', 'seqn')
+    greatest = greatest.values_list('volume_ml', 'seqn')[:1]
+    if greatest:
+      self.stats.greatest_volume_ml, self.stats.greatest_volume_id = greatest[0]
     else:
-      if self.drink.volume_ml > self.previous.greatest_volume_ml:
-        self.stats.greatest_volume_id = self.drink.seqn
+      self.stats.greatest_volume_ml = 0
+      self.stats.greatest_volume_id = 0
+
+  @merge('greatest_volume_ml')
+  def MergeGreatestVolume(self, other):
+    # Ties go to the earlier drink, as in GreatestVolume.
+    if not other.stats.greatest_volume_id:
+      return
+    if (other.stats.greatest_volume_ml > self.stats.greatest_volume_ml or
+        not self.stats.greatest_volume_id):
+      self.stats.greatest_volume_ml = other.stats.greatest_volume_ml
+      self.stats.greatest_volume_id = other.stats.greatest_volume_id
 
   @stat('volume_by_day_of_week')
-  def VolumeByDayOfweek(self):
-    result = self.stats.volume_by_day_of_week
-    if not self.previous:
-      # Note: uses the session's start_time, rather than the drink's. This
-      # causes late-night sessions to be reported for the day on which they were
-      # started.
-      volmap = {}
-      for drink in self.drinks:
-        weekday = drink.session.start_time.strftime('%w')
-        if weekday not in volmap:
-          volmap[weekday] = 0.0
-        volmap[weekday] += drink.volume_ml
-      for weekday, volume_ml in volmap.iteritems():
-        if volume_ml:
-          day = result.add()
-          day.weekday = weekday
-          day.volume_ml = volume_ml
-    else:
-      drink_weekday = self.drink.session.start_time.strftime('%w')
-      for message in self.stats.volume_by_day_of_week:
-        if message.weekday == drink_weekday:
-          message.volume_ml += self.drink.volume_ml
-          return
-      message = result.add()
-      message.weekday = drink_weekday
-      message.volume_ml = self.drink.volume_ml
+  def VolumeByDayOfweek(self, row):
+    # Note: uses the session's start_time, rather than the drink's. This
+    # causes late-night sessions to be reported for the day on which they were
+    # started.
+    if row.session_start_time is None:
+      return
+    weekday = row.session_start_time.strftime('%w')
+    self.index.Entry('volume_by_day_of_week', 'weekday', weekday).volume_ml += \
+        row.volume_ml
+
+  @inverse('volume_by_day_of_week')
+  def RevertVolumeByDayOfWeek(self, row):
+    if row.session_start_time is None:
+      return
+    weekday = row.session_start_time.strftime('%w')
+    self._SubtractVolume('volume_by_day_of_week', 'weekday', weekday,
+        row.volume_ml)
+
+  @merge('volume_by_day_of_week')
+  def MergeVolumeByDayOfWeek(self, other):
+    self._AddVolumes(other, 'volume_by_day_of_week', 'weekday')
 
   @stat('registered_drinkers')
-  def RegisteredDrinkers(self):
-    if not self.previous:
-      drinkers = set()
-      for drink in self.drinks:
-        if drink.user:
-          drinkers.add(str(drink.user.username))
-      self.stats.registered_drinkers.extend(drinkers)
-    else:
-      if self.drink.user:
-        result = self.stats.registered_drinkers
-        username = str(self.drink.user.username)
-        if username not in result:
-          result.append(username)
+  def RegisteredDrinkers(self, row):
+    if not row.username:
+      return
+    username = str(row.username)
+    if username not in self.index.drinkers:
+      self.index.drinkers.add(username)
+      self.stats.registered_drinkers.append(username)
+
+  @inverse('registered_drinkers')
+  def RevertRegisteredDrinkers(self, row):
+    if not row.username:
+      return
+    username = str(row.username)
+    if username not in self.index.drinkers:
+      return
+    if not self._ScopeDrinks().filter(user__username=row.username).exists():
+      self.index.drinkers.remove(username)
+      self.stats.registered_drinkers.remove(username)
+
+  @merge('registered_drinkers')
+  def MergeRegisteredDrinkers(self, other):
+    for username in other.stats.registered_drinkers:
+      if username not in self.index.drinkers:
+        self.index.drinkers.add(username)
+        self.stats.registered_drinkers.append(username)
 
   @stat('sessions_count')
-  def SessionsCount(self):
-    if not self.previous:
-      all_sessions = set()
-      for drink in self.drinks:
-        all_sessions.add(drink.session.seqn)
-      self.stats.sessions_count = len(all_sessions)
+  def SessionsCount(self, row):
+    if row.session_id is None:
+      return
+    index = self.index
+    if index.sessions is not None:
+      is_new = row.session_id not in index.sessions
+      index.sessions.add(row.session_id)
     else:
-      first_drink = self.drink.session.drinks.order_by('seqn')[0]
-      if self.drink.seqn == first_drink.seqn:
-        self.stats.sessions_count += 1
+      # Drinks are added in order, so a session is new when it differs from
+      # that of the previous drink, unless a late drink joined an earlier one.
+      is_new = (row.session_id != index.last_session_id and
+          not self._ScopeDrinks().filter(session=row.session_id,
+              seqn__lt=row.seqn).exists())
+    if is_new:
+      self.stats.sessions_count += 1
+    index.last_session_id = row.session_id
+
+  @inverse('sessions_count')
+  def RevertSessionsCount(self, row):
+    if row.session_id is None:
+      return
+    if not self._ScopeDrinks().filter(session=row.session_id).exists():
+      self.stats.sessions_count -= 1
+      if self.index.sessions is not None:
+        self.index.sessions.discard(row.session_id)
+
+  @merge('sessions_count')
+  def MergeSessionsCount(self, other):
+    # Sessions may span both builders' drinks.
+    self.index.sessions.update(other.index.sessions)
+    self.stats.sessions_count = len(self.index.sessions)
 
   @stat('volume_by_year')
-  def VolumeByYear(self):
-    if not self.previous:
-      volmap = {}
-      for drink in self.drinks:
-        year = drink.time.year
-        volmap[year] = volmap.get(year, 0) + drink.volume_ml
-      for year, volume_ml in volmap.iteritems():
-        rec = self.stats.volume_by_year.add()
-        rec.year = year
-        rec.volume_ml = volume_ml
-    else:
-      year = self.drink.time.year
-      for entry in self.stats.volume_by_year:
-        if entry.year == year:
-          entry.volume_ml += self.drink.volume_ml
-          return
-      rec = self.stats.volume_by_year.add()
-      rec.year = year
-      rec.volume_ml = self.drink.volume_ml
+  def VolumeByYear(self, row):
+    self.index.Entry('volume_by_year', 'year', row.time.year).volume_ml += \
+        row.volume_ml
+
+  @inverse('volume_by_year')
+  def RevertVolumeByYear(self, row):
+    self._SubtractVolume('volume_by_year', 'year', row.time.year,
+        row.volume_ml)
+
+  @merge('volume_by_year')
+  def MergeVolumeByYear(self, other):
+    self._AddVolumes(other, 'volume_by_year', 'year')
 
   @stat('has_guest_pour')
-  def HasGuestPour(self):
-    if not self.previous:
-      for drink in self.drinks:
-        if not drink.user:
-          self.stats.has_guest_pour = True
-          return
-      self.stats.has_guest_pour = False
-    else:
-      if not self.stats.has_guest_pour:
-        if not self.drink.user:
-          self.stats.has_guest_pour = True
+  def HasGuestPour(self, row):
+    if not row.username:
+      self.stats.has_guest_pour = True
+
+  @inverse('has_guest_pour')
+  def RevertHasGuestPour(self, row):
+    if not row.username and self.stats.has_guest_pour:
+      guest_drinks = self._ScopeDrinks().filter(user__isnull=True)
+      self.stats.has_guest_pour = guest_drinks.exists()
+
+  @merge('has_guest_pour')
+  def MergeHasGuestPour(self, other):
+    if other.stats.has_guest_pour:
+      self.stats.has_guest_pour = True
 
   @stat('volume_by_drinker')
-  def VolumeByDrinker(self):
-    if not self.previous:
-      result = self.stats.volume_by_drinker
-      volmap = {}
-      for drink in self.drinks:
-        if drink.user:
-          u = drink.user.username
-        else:
-          u = ''
-        volmap[u] = volmap.get(u, 0) + drink.volume_ml
-      for username, volume_ml in volmap.iteritems():
-        if volume_ml:
-          record = result.add()
-          record.username = username
-          record.volume_ml = volume_ml
-    else:
-      result = self.stats.volume_by_drinker
-      if self.drink.user:
-        u = self.drink.user.username
-      else:
-        u = ''
-      for message in result:
-        if message.username == u:
-          message.volume_ml += self.drink.volume_ml
-          return
-      message = result.add()
-      message.username = u
-      message.volume_ml = self.drink.volume_ml
+  def VolumeByDrinker(self, row):
+    username = row.username or ''
+    self.index.Entry('volume_by_drinker', 'username', username).volume_ml += \
+        row.volume_ml
+
+  @inverse('volume_by_drinker')
+  def RevertVolumeByDrinker(self, row):
+    username = row.username or ''
+    self._SubtractVolume('volume_by_drinker', 'username', username,
+        row.volume_ml)
+
+  @merge('volume_by_drinker')
+  def MergeVolumeByDrinker(self, other):
+    self._AddVolumes(other, 'volume_by_drinker', 'username')
 
 class SystemStatsBuilder(BaseStatsBuilder):
   """Builder of systemwide stats by drink."""
   REVISION = 5
 
+  def _ScopeDrinks(self):
+    return self.drink.site.drinks.valid()
+
   def _AllDrinks(self):
-    qs = self.drink.site.drinks.valid().filter(seqn__lte=self.drink.seqn)
+    qs = self._ScopeDrinks().filter(seqn__lte=self.drink.seqn)
     qs = qs.order_by('seqn')
     return qs
 
@@ -250,8 +724,8 @@ class DrinkerStatsBuilder(SystemStatsBuilder):
   """Builder of user-specific stats by drink."""
   REVISION = 5
 
-  def _AllDrinks(self):
-    qs = SystemStatsBuilder._AllDrinks(self)
+  def _ScopeDrinks(self):
+    qs = SystemStatsBuilder._ScopeDrinks(self)
     qs = qs.filter(user=self.drink.user)
     return qs
 
@@ -260,8 +734,8 @@ class KegStatsBuilder(SystemStatsBuilder):
   """Builder of keg-specific stats."""
   REVISION = 5
 
-  def _AllDrinks(self):
-    qs = SystemStatsBuilder._AllDrinks(self)
+  def _ScopeDrinks(self):
+    qs = SystemStatsBuilder._ScopeDrinks(self)
     qs = qs.filter(keg=self.drink.keg)
     return qs
 
@@ -270,12 +744,153 @@ class SessionStatsBuilder(SystemStatsBuilder):
   """Builder of user-specific stats by drink."""
   REVISION = 5
 
-  def _AllDrinks(self):
-    qs = SystemStatsBuilder._AllDrinks(self)
+  def _ScopeDrinks(self):
+    qs = SystemStatsBuilder._ScopeDrinks(self)
     qs = qs.filter(session=self.drink.session)
     return qs
 
 
+class StatsRegenerator(object):
+  """Rebuilds every stats record of a site in one pass over its drinks.
+
+  Each drink is fed to the system, keg, drinker and session builders it
+  belongs to at once, instead of each of them scanning its own drinks.
+  Builders are kept in `kegs`, `users` and `sessions`, keyed by id.
+
+  A regeneration may be split into consecutive ranges of drinks, each handled
+  by its own StatsRegenerator (eg, in another process), then combined in order
+  with Merge().
+  """
+  def __init__(self, site, seqn_range=None):
+    """Constructor.
+
+    Args
+      site: the KegbotSite whose stats are built
+      seqn_range: optional (first, last) seqns of the drinks to build from,
+          inclusive
+    """
+    self.site = site
+    self.seqn_range = seqn_range
+    self.system = self._NewBuilder(SystemStatsBuilder)
+    self.kegs = {}
+    self.users = {}
+    self.sessions = {}
+
+  def _NewBuilder(self, builder_class):
+    builder = builder_class(None)
+    builder.Start()
+    return builder
+
+  def _AddTo(self, builders, key, builder_class, row):
+    if key is None:
+      return
+    builder = builders.get(key)
+    if builder is None:
+      builder = self._NewBuilder(builder_class)
+      builders[key] = builder
+    builder.AddRow(row)
+
+  def DrinkRows(self):
+    """Streams the site's valid drinks, in order, as DrinkRows."""
+    qs = self.site.drinks.valid().order_by('seqn')
+    if self.seqn_range:
+      qs = qs.filter(seqn__range=self.seqn_range)
+    qs = qs.values_list(*DRINK_ROW_FIELDS)
+    return (DrinkRow._make(values) for values in qs.iterator())
+
+  def AddRow(self, row):
+    self.system.AddRow(row)
+    self._AddTo(self.kegs, row.keg_id, KegStatsBuilder, row)
+    self._AddTo(self.users, row.user_id, DrinkerStatsBuilder, row)
+    self._AddTo(self.sessions, row.session_id, SessionStatsBuilder, row)
+
+  @classmethod
+  def CanMerge(cls):
+    return all(builder_class(None).CanMerge() for builder_class in
+        (SystemStatsBuilder, KegStatsBuilder, DrinkerStatsBuilder,
+        SessionStatsBuilder))
+
+  def Merge(self, other):
+    """Adds the builders of `other`, which covered the following drinks."""
+    self.system.Merge(other.system)
+    for attrname in ('kegs', 'users', 'sessions'):
+      builders = getattr(self, attrname)
+      for key, builder in getattr(other, attrname).iteritems():
+        if key in builders:
+          builders[key].Merge(builder)
+        else:
+          builders[key] = builder
+
+  def Finish(self):
+    self.system.Finish()
+    for builders in (self.kegs, self.users, self.sessions):
+      for builder in builders.itervalues():
+        builder.Finish()
+
+  def Feed(self):
+    """Adds all drinks in range, leaving the rebuild open to Merge()."""
+    for row in self.DrinkRows():
+      self.AddRow(row)
+
+  def Run(self, progress=None):
+    """Builds all stats.
+
+    Args
+      progress: optional function called with the number of drinks built so
+          far, every 1000 drinks (when vectorized, as they are loaded, and
+          once more when done)
+    """
+    builder_classes = (SystemStatsBuilder, KegStatsBuilder,
+        DrinkerStatsBuilder, SessionStatsBuilder)
+    if all(_Vectorizable(c) for c in builder_classes):
+      columns = stats_numpy.DrinkColumns(self._Loading(progress))
+      self._RunVectorized(columns)
+      if progress:
+        progress(len(columns))
+      return
+    for pos, row in enumerate(self.DrinkRows()):
+      self.AddRow(row)
+      if progress and (pos + 1) % 1000 == 0:
+        progress(pos + 1)
+    self.Finish()
+
+  def _Loading(self, progress):
+    for pos, row in enumerate(self.DrinkRows()):
+      yield row
+      if progress and (pos + 1) % 1000 == 0:
+        progress(pos + 1)
+
+  def _RunVectorized(self, columns):
+    self.system = SystemStatsBuilder(None)
+    self.system.BuildFromColumns(columns)
+    groups = (
+      (self.kegs, 'keg_id', KegStatsBuilder),
+      (self.users, 'user_id', DrinkerStatsBuilder),
+      (self.sessions, 'session_id', SessionStatsBuilder),
+    )
+    for builders, column, builder_class in groups:
+      for key, group in columns.GroupBy(column):
+        builders[key] = builder_class(None)
+        builders[key].BuildFromColumns(group)
+
+
+def DrinksStats(drinks):
+  """Returns stats for an arbitrary queryset of drinks, eg a date range.
+
+  The result is the same as a full rebuild over those drinks, taken in seqn
+  order.
+  """
+  qs = drinks.order_by('seqn').values_list(*DRINK_ROW_FIELDS)
+  rows = (DrinkRow._make(values) for values in qs.iterator())
+  builder = BaseStatsBuilder(None)
+  if _Vectorizable(BaseStatsBuilder):
+    return builder.BuildFromColumns(stats_numpy.DrinkColumns(rows))
+  builder.Start()
+  for row in rows:
+    builder.AddRow(row)
+  return builder.Finish()
+
+
 def main():
   from pykeg.core import models
   last_drink = models.Drink.objects.valid().order_by('-seqn')[0]
@@ -0,0 +1,156 @@
+# Copyright 2013 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Vectorized stats computation, used when NumPy is installed.
+
+DrinkColumns.Stats() computes the same models_pb2.Stats as a full rebuild by
+stats.BaseStatsBuilder, with grouped array operations in place of per-drink
+Python code.
+"""
+
+import numpy
+
+from kegbot.api import models_pb2
+
+# Stand-in for a missing id in integer columns.
+NO_ID = -1
+
+# numpy day 0 (1970-01-01) was a Thursday; strftime('%w') counts from Sunday.
+_EPOCH_WEEKDAY = 4
+
+def _IdColumn(values):
+  return numpy.array([NO_ID if v is None else v for v in values],
+      dtype=numpy.int64)
+
+def _GroupSums(keys, weights):
+  """Returns (key, sum of weights) for each distinct key, by first appearance.
+
+  Each sum is accumulated in order, as the builders do.
+  """
+  if not len(keys):
+    return []
+  uniq, first, inverse = numpy.unique(keys, return_index=True,
+      return_inverse=True)
+  sums = numpy.bincount(inverse, weights=weights, minlength=len(uniq))
+  return [(uniq[i].item(), sums[i].item()) for i in numpy.argsort(first)]
+
+
+class DrinkColumns(object):
+  """The columns of an ordered sequence of DrinkRows, as NumPy arrays."""
+
+  def __init__(self, rows=None):
+    if rows is None:
+      return
+    rows = list(rows)
+    self.seqn = numpy.array([r.seqn for r in rows], dtype=numpy.int64)
+    self.volume_ml = numpy.array([r.volume_ml for r in rows],
+        dtype=numpy.float64)
+    times = numpy.array([r.time for r in rows], dtype='datetime64[us]')
+    self.year = times.astype('datetime64[Y]').astype(numpy.int64) + 1970
+    starts = numpy.array([r.session_start_time for r in rows],
+        dtype='datetime64[us]')
+    days = starts.astype('datetime64[D]').astype(numpy.int64)
+    self.weekday = numpy.where(numpy.isnat(starts), NO_ID,
+        (days + _EPOCH_WEEKDAY) % 7)
+    self.user_id = _IdColumn(r.user_id for r in rows)
+    self.session_id = _IdColumn(r.session_id for r in rows)
+    self.keg_id = _IdColumn(r.keg_id for r in rows)
+    self.usernames = dict((r.user_id, str(r.username)) for r in rows
+        if r.user_id is not None)
+
+  def __len__(self):
+    return len(self.seqn)
+
+  def Select(self, indices):
+    """Returns the columns of the drinks at `indices` (an index array)."""
+    result = DrinkColumns()
+    for name in ('seqn', 'volume_ml', 'year', 'weekday', 'user_id',
+        'session_id', 'keg_id'):
+      setattr(result, name, getattr(self, name)[indices])
+    result.usernames = self.usernames
+    return result
+
+  def GroupBy(self, column):
+    """Yields (id, DrinkColumns) for each id in integer column `column`."""
+    ids = getattr(self, column)
+    # A stable sort keeps each group's drinks in order.
+    order = numpy.argsort(ids, kind='mergesort')
+    sorted_ids = ids[order]
+    bounds = numpy.flatnonzero(numpy.diff(sorted_ids)) + 1
+    for indices in numpy.split(order, bounds):
+      if not len(indices):
+        continue
+      key = ids[indices[0]].item()
+      if key != NO_ID:
+        yield key, self.Select(indices)
+
+  def Stats(self):
+    """Returns (stats, session ids, last session id) for these drinks."""
+    stats = models_pb2.Stats()
+    stats.last_drink_id = 0
+    stats.total_volume_ml = 0
+    stats.total_pours = 0
+    stats.average_volume_ml = 0.0
+    stats.greatest_volume_ml = 0
+    stats.greatest_volume_id = 0
+    stats.has_guest_pour = False
+    stats.sessions_count = 0
+    if not len(self):
+      return stats, set(), None
+
+    stats.last_drink_id = self.seqn[-1].item()
+    # cumsum adds in order, matching the builders' floating point result.
+    stats.total_volume_ml = self.volume_ml.cumsum()[-1].item()
+    stats.total_pours = len(self)
+    stats.average_volume_ml = stats.total_volume_ml / float(len(self))
+    # argmax picks the first of equal volumes, as GreatestVolume does.
+    greatest = self.volume_ml.argmax()
+    stats.greatest_volume_ml = self.volume_ml[greatest].item()
+    stats.greatest_volume_id = self.seqn[greatest].item()
+
+    has_session = self.weekday != NO_ID
+    for weekday, volume_ml in _GroupSums(self.weekday[has_session],
+        self.volume_ml[has_session]):
+      if volume_ml:
+        entry = stats.volume_by_day_of_week.add()
+        entry.weekday = str(weekday)
+        entry.volume_ml = volume_ml
+
+    for user_id, volume_ml in _GroupSums(self.user_id, self.volume_ml):
+      if user_id != NO_ID:
+        stats.registered_drinkers.append(self.usernames[user_id])
+      if volume_ml:
+        entry = stats.volume_by_drinker.add()
+        entry.username = self.usernames.get(user_id, '')
+        entry.volume_ml = volume_ml
+
+    sessions = set(numpy.unique(self.session_id).tolist())
+    sessions.discard(NO_ID)
+    stats.sessions_count = len(sessions)
+
+    for year, volume_ml in _GroupSums(self.year, self.volume_ml):
+      entry = stats.volume_by_year.add()
+      entry.year = year
+      entry.volume_ml = volume_ml
+
+    stats.has_guest_pour = bool((self.user_id == NO_ID).any())
+
+    last_session_id = self.session_id[-1].item()
+    if last_session_id == NO_ID:
+      last_session_id = None
+    return stats, sessions, last_session_id
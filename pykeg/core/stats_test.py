@@ -17,16 +17,29 @@
 # along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
 
 import datetime
+import pickle
 
+from django.core.management import call_command
 from django.utils import unittest
 
 from kegbot.api import models_pb2
 from kegbot.api.protoutil import ProtoMessageToDict
+from kegbot.util import kbjson
 
 from pykeg.core.backend.django import KegbotBackend
 from pykeg.core import models
 from pykeg.core import stats
 
+class PluginStatsBuilder(stats.SystemStatsBuilder):
+  """Builder used to test stats plugged in with register_stat."""
+
+# Plugged in by testRegisteredStat under its own statname, 'pours_so_far'.  It
+# fills peer_affinities, which no built-in stat sets.
+def _PoursSoFar(builder, row):
+  affinity = builder.stats.peer_affinities.add()
+  affinity.peer_name = str(row.username)
+  affinity.joint_session_count = builder.stats.total_pours
+
 class StatsTestCase(unittest.TestCase):
   def setUp(self):
     self.site, created = models.KegbotSite.objects.get_or_create(name='default')
@@ -47,6 +60,14 @@ class StatsTestCase(unittest.TestCase):
     #        volume_ml=amt, username=user.username, do_postprocess=False)
     #    self.drinks.append(d)
 
+  def tearDown(self):
+    if 'pours_so_far' in stats.STAT_MAP:
+      stats.unregister_stat('pours_so_far')
+    # Each test records its own drinks from seqn 1, so none may be left over.
+    for user in self.users:
+      user.delete()
+    self.site.delete()
+
   def assertProtosEqual(self, expected, actual):
     d1 = ProtoMessageToDict(expected)
     d2 = ProtoMessageToDict(actual)
@@ -136,3 +157,307 @@ class StatsTestCase(unittest.TestCase):
     system_stats_d2_inc = stats.SystemStatsBuilder(drink2, system_stats_d1).Build()
     self.assertProtosEqual(system_stats_d2, system_stats_d2_inc)
 
+
+  def testFullRebuildMatchesIncremental(self):
+    pour_time = datetime.datetime(2011, 05, 01, 12, 00)
+    pours = (
+        ('user1', 100),
+        ('user2', 250),
+        (None, 80),
+        ('user1', 300),
+        ('user3', 0),
+        ('user2', 120),
+    )
+    previous = None
+    for i, (username, volume_ml) in enumerate(pours):
+      # Span two years so volume_by_year has several entries.
+      when = pour_time.replace(year=2011 + (i / 3))
+      d = self.backend.RecordDrink('kegboard.flow0', ticks=volume_ml,
+          volume_ml=volume_ml, username=username, pour_time=when,
+          do_postprocess=False)
+      previous = stats.SystemStatsBuilder(d, previous).Build()
+
+    last_drink = models.Drink.objects.get(seqn=len(pours))
+    full = stats.SystemStatsBuilder(last_drink).Build()
+    self.assertEquals(850.0, full.total_volume_ml)
+    self.assertEquals(len(pours), full.total_pours)
+    self.assertEquals(4, full.greatest_volume_id)
+    self.assertTrue(full.has_guest_pour)
+    self.assertEquals(['user1', 'user2'], list(full.registered_drinkers)[:2])
+
+    # Incremental builds keep the zero-volume drinker entry; otherwise the
+    # results match.
+    del previous.volume_by_drinker[3]
+    self.assertProtosEqual(previous, full)
+
+  def testRegisteredStat(self):
+    stats.register_stat('pours_so_far', depends=('total_pours',),
+        builders=(PluginStatsBuilder,))(_PoursSoFar)
+    statnames = [fn.statname for fn in stats._OrderedStats(PluginStatsBuilder)]
+    self.assertTrue('pours_so_far' in statnames)
+    self.assertTrue(statnames.index('total_pours') <
+        statnames.index('pours_so_far'))
+    self.assertFalse('pours_so_far' in
+        [fn.statname for fn in stats._OrderedStats(stats.SystemStatsBuilder)])
+
+    for volume_ml in (100, 200):
+      d = self.backend.RecordDrink('kegboard.flow0', ticks=volume_ml,
+          volume_ml=volume_ml, username='user1', do_postprocess=False)
+
+    plugin_stats = PluginStatsBuilder(d).Build()
+    counts = [a.joint_session_count for a in plugin_stats.peer_affinities]
+    self.assertEquals([1, 2], counts)
+    self.assertEquals(150.0, plugin_stats.average_volume_ml)
+
+    # Other builders are unaffected.
+    system_stats = stats.SystemStatsBuilder(d).Build()
+    self.assertEquals([], list(system_stats.peer_affinities))
+
+    stats.unregister_stat('pours_so_far')
+    plugin_stats = PluginStatsBuilder(d).Build()
+    self.assertEquals([], list(plugin_stats.peer_affinities))
+
+  def testIncrementalSessionsCount(self):
+    pour_time = datetime.datetime(2011, 05, 01, 12, 00)
+    later = pour_time + datetime.timedelta(days=1)
+    pours = (
+        ('user1', pour_time),
+        ('user2', later),
+        ('user1', later),
+    )
+    previous = None
+    for username, when in pours:
+      d = self.backend.RecordDrink('kegboard.flow0', ticks=100,
+          volume_ml=100, username=username, pour_time=when,
+          do_postprocess=False)
+      if username == 'user1':
+        builder = stats.DrinkerStatsBuilder(d, previous)
+        builder.Build()
+        previous = builder.index
+
+    # user1 joined the second session after user2 started it.
+    self.assertEquals(2, previous.stats.sessions_count)
+    full = stats.DrinkerStatsBuilder(d).Build()
+    self.assertProtosEqual(full, previous.stats)
+
+    # Without a known previous session, it is looked up.
+    d1 = models.Drink.objects.get(seqn=1)
+    first = stats.DrinkerStatsBuilder(d1).Build()
+    second = stats.DrinkerStatsBuilder(d, first).Build()
+    self.assertEquals(2, second.sessions_count)
+
+  def testCancelDrinkMatchesRebuild(self):
+    pour_time = datetime.datetime(2011, 05, 01, 12, 00)
+    pours = (
+        ('user1', 100),
+        ('user2', 400),
+        (None, 80),
+        ('user1', 300),
+        ('user2', 120),
+    )
+    for i, (username, volume_ml) in enumerate(pours):
+      when = pour_time + datetime.timedelta(minutes=i)
+      self.backend.RecordDrink('kegboard.flow0', ticks=volume_ml,
+          volume_ml=volume_ml, username=username, pour_time=when)
+
+    # Cancel the greatest drink, then the only guest drink.
+    self.backend.CancelDrink(2)
+    self.backend.CancelDrink(3)
+
+    last_drink = models.Drink.objects.get(seqn=5)
+    record = models.SystemStats.objects.get(site=self.site)
+    full = stats.SystemStatsBuilder(last_drink).Build()
+    self.assertEquals(ProtoMessageToDict(full), record.stats)
+    self.assertEquals(300, full.greatest_volume_ml)
+    self.assertFalse(full.has_guest_pour)
+
+    user2_stats = models.UserStats.objects.get(site=self.site,
+        user=self.users[1])
+    full = stats.DrinkerStatsBuilder(last_drink).Build()
+    self.assertEquals(ProtoMessageToDict(full), user2_stats.stats)
+
+    session = last_drink.session
+    self.assertEquals(520, session.volume_ml)
+    user2_chunk = session.user_chunks.get(user=self.users[1])
+    self.assertEquals(120, user2_chunk.volume_ml)
+    self.assertEquals(last_drink.time, user2_chunk.start_time)
+    self.assertFalse(session.user_chunks.filter(user=None).exists())
+
+    # Cancelling a drink again changes nothing.
+    self.backend.CancelDrink(2)
+    self.assertEquals(record.stats,
+        models.SystemStats.objects.get(site=self.site).stats)
+    self.assertEquals(520,
+        models.DrinkingSession.objects.get(pk=session.pk).volume_ml)
+
+    # Cancelling every drink by a user removes their stats.
+    self.backend.CancelDrink(5)
+    self.assertFalse(models.UserStats.objects.filter(site=self.site,
+        user=self.users[1]).exists())
+
+  def testRegenerateStats(self):
+    pour_time = datetime.datetime(2011, 05, 01, 12, 00)
+    pours = (
+        ('user1', 100, 0),
+        ('user2', 250, 0),
+        (None, 80, 1),
+        ('user1', 300, 2),
+    )
+    for username, volume_ml, day in pours:
+      when = pour_time + datetime.timedelta(days=day)
+      d = self.backend.RecordDrink('kegboard.flow0', ticks=volume_ml,
+          volume_ml=volume_ml, username=username, pour_time=when)
+    call_command('kb_regen_stats')
+
+    record = models.SystemStats.objects.get(site=self.site)
+    self.assertEquals(ProtoMessageToDict(stats.SystemStatsBuilder(d).Build()),
+        record.stats)
+
+    for user in self.users[:2]:
+      last = user.drinks.valid().order_by('-seqn')[0]
+      record = models.UserStats.objects.get(site=self.site, user=user)
+      expected = stats.DrinkerStatsBuilder(last).Build()
+      self.assertEquals(ProtoMessageToDict(expected), record.stats)
+    self.assertFalse(models.UserStats.objects.filter(user=self.users[2]))
+
+    sessions = self.site.sessions.all()
+    self.assertEquals(3, len(sessions))
+    for session in sessions:
+      last = session.drinks.valid().order_by('-seqn')[0]
+      record = models.SessionStats.objects.get(session=session)
+      expected = stats.SessionStatsBuilder(last).Build()
+      self.assertEquals(ProtoMessageToDict(expected), record.stats)
+
+  def testRegenerateStatsWithoutMerge(self):
+    # A plugged-in stat with no merge function can't be built in parallel.
+    stats.register_stat('pours_so_far', depends=('total_pours',))(_PoursSoFar)
+    self.assertFalse(stats.StatsRegenerator.CanMerge())
+    for volume_ml in (100, 200):
+      d = self.backend.RecordDrink('kegboard.flow0', ticks=volume_ml,
+          volume_ml=volume_ml, username='user1')
+
+    call_command('kb_regen_stats', jobs=4)
+    record = models.SystemStats.objects.get(site=self.site)
+    self.assertEquals(ProtoMessageToDict(stats.SystemStatsBuilder(d).Build()),
+        record.stats)
+    self.assertEquals(2, len(record.stats['peer_affinities']))
+
+  def testMergeRegenerators(self):
+    pour_time = datetime.datetime(2011, 05, 01, 12, 00)
+    pours = (
+        ('user1', 100, 0),
+        ('user2', 450, 0),
+        (None, 80, 0),
+        ('user3', 450, 1),
+        ('user1', 300, 2),
+        ('user2', 0, 2),
+    )
+    for i, (username, volume_ml, day) in enumerate(pours):
+      when = pour_time + datetime.timedelta(days=day, minutes=i)
+      self.backend.RecordDrink('kegboard.flow0', ticks=volume_ml,
+          volume_ml=volume_ml, username=username, pour_time=when,
+          do_postprocess=False)
+
+    serial = stats.StatsRegenerator(self.site)
+    serial.Run()
+
+    # Split mid-session; shards travel between processes pickled.
+    merged = None
+    for seqn_range in ((1, 2), (3, 5), (6, 6)):
+      shard = stats.StatsRegenerator(self.site, seqn_range)
+      shard.Feed()
+      shard = pickle.loads(pickle.dumps(shard))
+      if merged is None:
+        merged = shard
+      else:
+        merged.Merge(shard)
+    merged.Finish()
+
+    self.assertProtosEqual(serial.system.stats, merged.system.stats)
+    self.assertEquals(2, merged.system.stats.greatest_volume_id)
+    self.assertEquals(3, merged.system.stats.sessions_count)
+    for attrname in ('kegs', 'users', 'sessions'):
+      serial_builders = getattr(serial, attrname)
+      merged_builders = getattr(merged, attrname)
+      self.assertEquals(sorted(serial_builders), sorted(merged_builders))
+      for key, builder in serial_builders.iteritems():
+        self.assertProtosEqual(builder.stats, merged_builders[key].stats)
+
+  @unittest.skipIf(not stats.HAVE_NUMPY, 'NumPy is not installed')
+  def testVectorizedMatchesRows(self):
+    pour_time = datetime.datetime(2011, 12, 31, 23, 00)
+    pours = (
+        ('user1', 100.1, 0),
+        ('user2', 450, 0),
+        (None, 80.3, 0),
+        ('user3', 0, 1),
+        ('user1', 450, 2),
+        ('user2', 33.3, 2),
+    )
+    for i, (username, volume_ml, day) in enumerate(pours):
+      when = pour_time + datetime.timedelta(days=day, minutes=i)
+      self.backend.RecordDrink('kegboard.flow0', ticks=100,
+          volume_ml=volume_ml, username=username, pour_time=when,
+          do_postprocess=False)
+
+    rows = stats.StatsRegenerator(self.site)
+    rows.Feed()
+    rows.Finish()
+    vectorized = stats.StatsRegenerator(self.site)
+    reported = []
+    vectorized.Run(progress=reported.append)
+    self.assertEquals([len(pours)], reported)
+
+    self.assertProtosEqual(rows.system.stats, vectorized.system.stats)
+    for attrname in ('kegs', 'users', 'sessions'):
+      row_builders = getattr(rows, attrname)
+      vectorized_builders = getattr(vectorized, attrname)
+      self.assertEquals(sorted(row_builders), sorted(vectorized_builders))
+      for key, builder in row_builders.iteritems():
+        self.assertProtosEqual(builder.stats, vectorized_builders[key].stats)
+        self.assertEquals(builder.index.sessions,
+            vectorized_builders[key].index.sessions)
+
+    # Ad-hoc queries over a subset of drinks.
+    stats_2012 = stats.DrinksStats(self.site.drinks.filter(time__year=2012))
+    self.assertEquals(3, stats_2012.total_pours)
+    self.assertEquals([2012], [y.year for y in stats_2012.volume_by_year])
+
+  def testLazyStatsRecord(self):
+    for volume_ml in (100, 200):
+      self.backend.RecordDrink('kegboard.flow0', ticks=volume_ml,
+          volume_ml=volume_ml, username='user1')
+
+    record = models.SystemStats.objects.get(site=self.site)
+    # Loading the record leaves its stats undecoded.
+    self.assertTrue(isinstance(record.__dict__['stats'], basestring))
+    serialized = record.StatsJson()
+    self.assertTrue(isinstance(record.__dict__['stats'], basestring))
+    self.assertEquals(2, record.stats['total_pours'])
+    self.assertEquals(kbjson.loads(serialized), record.stats)
+
+  def testPostProcessPending(self):
+    pour_time = datetime.datetime(2011, 05, 01, 12, 00)
+    for i, username in enumerate(('user1', 'user2', 'user1', None)):
+      d = self.backend.RecordDrink('kegboard.flow0', ticks=100,
+          volume_ml=100 + i, username=username,
+          pour_time=pour_time + datetime.timedelta(minutes=i),
+          do_postprocess=False)
+    self.assertFalse(self.backend.WaitForPostProcess(d.seqn))
+    self.backend.CancelDrink(3)
+
+    events = models.Drink.PostProcessPending(self.site)
+    self.assertTrue(self.backend.WaitForPostProcess(d.seqn))
+    self.assertEquals([], models.Drink.PostProcessPending(self.site))
+    self.assertEquals(['session_started', 'session_joined', 'drink_poured',
+        'session_joined', 'drink_poured', 'drink_poured'],
+        [e.kind for e in events])
+
+    # Coalesced updates match a full rebuild, without the cancelled drink.
+    record = models.SystemStats.objects.get(site=self.site)
+    self.assertEquals(ProtoMessageToDict(stats.SystemStatsBuilder(d).Build()),
+        record.stats)
+    self.assertEquals(3, record.stats['total_pours'])
+    user1_stats = models.UserStats.objects.get(site=self.site,
+        user=self.users[0])
+    self.assertEquals(100, user1_stats.stats['total_volume_ml'])
@@ -0,0 +1,171 @@
+# Copyright 2013 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Ring buffer storage for temperature sensor readings.
+
+When KEGBOT_THERMO_STORE_DIR is set, each sensor's readings are kept in a
+memory-mapped file there, in place of Thermolog rows.  The file has one slot
+per minute, reused after KEGBOT_THERMO_STORE_MINUTES; writing a reading is a
+couple of stores into the mapping, and reading a range is a slice of it.
+
+File layout (little-endian):
+  header: int32 capacity, int32 last minute written
+  stamps: int32[capacity], the minute each slot holds
+  values: float32[capacity], the reading for that minute
+
+Minutes are counted from 1970-01-01 in the same local time as Thermolog.time.
+"""
+
+import array
+import datetime
+import mmap
+import os
+import struct
+import sys
+import threading
+
+from django.conf import settings
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# Default number of minutes kept.
+DEFAULT_MINUTES = 7 * 24 * 60
+
+# Stamp of a slot never written.
+EMPTY = -1
+
+_HEADER = struct.Struct('<ii')
+_INT = struct.Struct('<i')
+_FLOAT = struct.Struct('<f')
+
+def Enabled():
+  return bool(getattr(settings, 'KEGBOT_THERMO_STORE_DIR', None))
+
+def ToMinute(time):
+  delta = time - EPOCH
+  return delta.days * 24 * 60 + delta.seconds // 60
+
+def FromMinute(minute):
+  return EPOCH + datetime.timedelta(minutes=minute)
+
+def _Array(typecode, data):
+  result = array.array(typecode)
+  result.fromstring(data)
+  if sys.byteorder != 'little':
+    result.byteswap()
+  return result
+
+
+class RingBuffer(object):
+  """The readings of one sensor, one float32 per minute."""
+
+  def __init__(self, path, minutes=DEFAULT_MINUTES):
+    if not os.path.exists(path):
+      with open(path, 'wb') as f:
+        f.write(_HEADER.pack(minutes, EMPTY))
+        f.write(_INT.pack(EMPTY) * minutes)
+        f.write(_FLOAT.pack(0) * minutes)
+    with open(path, 'r+b') as f:
+      self._map = mmap.mmap(f.fileno(), 0)
+    self.capacity, last = _HEADER.unpack_from(self._map, 0)
+    self._stamps = _HEADER.size
+    self._values = self._stamps + self.capacity * _INT.size
+    self._lock = threading.Lock()
+
+  def Put(self, time, value):
+    """Stores the reading for the minute of `time`.
+
+    Returns True if the minute already had a reading, which is replaced.  A
+    reading too old to be kept is dropped, and True returned as well: its slot
+    belongs to a later minute.
+    """
+    minute = ToMinute(time)
+    slot = minute % self.capacity
+    stamp_offset = self._stamps + slot * _INT.size
+    with self._lock:
+      stamp = _INT.unpack_from(self._map, stamp_offset)[0]
+      last = self._Last()
+      if stamp > minute or (last != EMPTY and minute <= last - self.capacity):
+        return True
+      replaced = stamp == minute
+      # Value before stamp, so a reader never pairs a new stamp with an old
+      # value.
+      _FLOAT.pack_into(self._map, self._values + slot * _FLOAT.size, value)
+      _INT.pack_into(self._map, stamp_offset, minute)
+      if minute > self._Last():
+        _INT.pack_into(self._map, _INT.size, minute)
+    return replaced
+
+  def Get(self, start, end=None):
+    """Returns (time, value) for each stored minute in [start, end)."""
+    first = ToMinute(start)
+    if start > FromMinute(first):
+      first += 1
+    if end is None:
+      last = self._Last() + 1
+    else:
+      last = ToMinute(end - datetime.timedelta(microseconds=1)) + 1
+    # Older minutes have been overwritten.
+    first = max(first, last - self.capacity)
+    if first >= last:
+      return []
+
+    start_slot = first % self.capacity
+    count = last - first
+    slots = [(start_slot, min(count, self.capacity - start_slot))]
+    if slots[0][1] < count:
+      slots.append((0, count - slots[0][1]))
+    stamps = array.array('i')
+    values = array.array('f')
+    for slot, n in slots:
+      offset = self._stamps + slot * _INT.size
+      stamps.extend(_Array('i', self._map[offset:offset + n * _INT.size]))
+      offset = self._values + slot * _FLOAT.size
+      values.extend(_Array('f', self._map[offset:offset + n * _FLOAT.size]))
+
+    return [(FromMinute(first + i), values[i]) for i in xrange(count)
+        if stamps[i] == first + i]
+
+  def Latest(self):
+    """Returns (time, value) of the latest reading, or None."""
+    last = self._Last()
+    if last == EMPTY:
+      return None
+    readings = self.Get(FromMinute(last))
+    return readings[-1] if readings else None
+
+  def _Last(self):
+    return _INT.unpack_from(self._map, _INT.size)[0]
+
+
+_buffers = {}
+_buffers_lock = threading.Lock()
+
+def ForSensor(sensor):
+  """Returns the RingBuffer of a ThermoSensor, creating it if needed."""
+  directory = settings.KEGBOT_THERMO_STORE_DIR
+  path = os.path.join(directory, 'sensor-%i.ring' % sensor.id)
+  with _buffers_lock:
+    buf = _buffers.get(path)
+    if buf is None:
+      if not os.path.isdir(directory):
+        os.makedirs(directory)
+      minutes = getattr(settings, 'KEGBOT_THERMO_STORE_MINUTES',
+          DEFAULT_MINUTES)
+      buf = _buffers[path] = RingBuffer(path, minutes)
+    return buf
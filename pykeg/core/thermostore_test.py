@@ -0,0 +1,108 @@
+# Copyright 2013 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unittests for pykeg.core.thermostore"""
+
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+from django.test.utils import override_settings
+
+from pykeg.core.backend.django import KegbotBackend
+from pykeg.core import models
+from pykeg.core import thermostore
+
+class RingBufferTestCase(unittest.TestCase):
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    self.path = os.path.join(self.tempdir, 'test.ring')
+    self.start = datetime.datetime(2013, 3, 1, 12, 0)
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+
+  def minute(self, n):
+    return self.start + datetime.timedelta(minutes=n)
+
+  def testPutGet(self):
+    buf = thermostore.RingBuffer(self.path, minutes=10)
+    self.assertEqual(buf.Latest(), None)
+    self.assertFalse(buf.Put(self.minute(0), 1.5))
+    self.assertFalse(buf.Put(self.minute(2), 2.5))
+    self.assertTrue(buf.Put(self.minute(2), 3.5))
+    self.assertEqual(buf.Get(self.minute(0)),
+        [(self.minute(0), 1.5), (self.minute(2), 3.5)])
+    self.assertEqual(buf.Get(self.minute(0), self.minute(2)),
+        [(self.minute(0), 1.5)])
+    self.assertEqual(buf.Latest(), (self.minute(2), 3.5))
+
+    # Reopened from the file.
+    buf = thermostore.RingBuffer(self.path)
+    self.assertEqual(buf.capacity, 10)
+    self.assertEqual(buf.Latest(), (self.minute(2), 3.5))
+
+  def testWrap(self):
+    buf = thermostore.RingBuffer(self.path, minutes=10)
+    for n in range(25):
+      buf.Put(self.minute(n), float(n))
+    self.assertEqual(buf.Get(self.start),
+        [(self.minute(n), float(n)) for n in range(15, 25)])
+    self.assertEqual(buf.Get(self.minute(18), self.minute(21)),
+        [(self.minute(n), float(n)) for n in range(18, 21)])
+
+    # A gap leaves the overwritten minutes empty.
+    buf.Put(self.minute(32), 32.0)
+    self.assertEqual(buf.Get(self.minute(20)),
+        [(self.minute(n), float(n)) for n in (23, 24, 32)])
+
+    # A reading older than the buffer doesn't overwrite a later one.
+    self.assertTrue(buf.Put(self.minute(22), -3.0))
+    self.assertTrue(buf.Put(self.minute(12), -3.0))
+    self.assertEqual(buf.Get(self.minute(20)),
+        [(self.minute(n), float(n)) for n in (23, 24, 32)])
+    self.assertEqual(buf.Latest(), (self.minute(32), 32.0))
+
+
+class ThermoStoreBackendTestCase(unittest.TestCase):
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    models.KegbotSite.objects.filter(name='default').delete()
+    self.site, created = models.KegbotSite.objects.get_or_create(name='default')
+    self.backend = KegbotBackend(site=self.site)
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+    self.site.delete()
+
+  def testLogSensorReading(self):
+    now = datetime.datetime.now().replace(second=0, microsecond=0)
+    with override_settings(KEGBOT_THERMO_STORE_DIR=self.tempdir):
+      for minutes, temp in ((-3, 4.0), (-1, 5.0)):
+        log = self.backend.LogSensorReading('fridge', temp,
+            when=now + datetime.timedelta(minutes=minutes))
+      sensor = models.ThermoSensor.objects.get(site=self.site,
+          raw_name='fridge')
+      self.assertEqual(models.Thermolog.objects.filter(sensor=sensor).count(),
+          0)
+      self.assertEqual(sensor.LastLog().time, log.time)
+      self.assertEqual([l.temp for l in
+          sensor.Logs(now - datetime.timedelta(hours=1))], [4.0, 5.0])
+      self.assertEqual([l.temp for l in sensor.RecentLogs(1)], [5.0])
@@ -305,7 +305,7 @@ def ThermoSummaryLogToProto(record, full=False):
   ret = models_pb2.ThermoSummaryLog()
   ret.id = record.seqn
   ret.sensor_id = record.sensor.seqn
-  ret.date = datestr(record.date)
+  ret.time = datestr(record.time)
   ret.period = record.period
   ret.num_readings = record.num_readings
   ret.min_temp = record.min_temp
@@ -124,6 +124,7 @@ MIDDLEWARE_CLASSES = (
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'pykeg.web.middleware.CommitHooksMiddleware',
     'django.middleware.transaction.TransactionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
 
@@ -172,6 +173,27 @@ if HAVE_DJCELERY and HAVE_DJKOMBU:
   CELERY_DEFAULT_QUEUE = "default"
   CELERYD_CONCURRENCY = 3
 
+# If True, and Celery is available, RecordDrink returns as soon as the drink is
+# saved, and stats and events are updated by a Celery worker.
+KEGBOT_ASYNC_POSTPROCESS = False
+
+# Number of sequence numbers (event ids, session ids, ...) each process
+# reserves at a time.  Values above 1 save a locking update per insert, but
+# leave gaps in the numbering when a process exits, and numbers from different
+# processes are not in time order.  Drink ids are always reserved one at a
+# time, since stats depend on their order.
+KEGBOT_SEQN_BLOCK_SIZE = 1
+
+# Seconds between writes of each process's daily temperature summaries.
+KEGBOT_THERMO_FLUSH_SECONDS = 300
+
+# If set, a directory where temperature readings are kept, one fixed-size ring
+# buffer file per sensor, rather than as database rows.
+KEGBOT_THERMO_STORE_DIR = None
+
+# Minutes of readings each ring buffer file holds (a week).
+KEGBOT_THERMO_STORE_MINUTES = 7 * 24 * 60
+
 ### debug_toolbar
 
 if HAVE_DEBUG_TOOLBAR:
@@ -17,6 +17,8 @@
 # along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
 
 from django import forms
+from django.forms.formsets import BaseFormSet
+from django.forms.formsets import formset_factory
 
 from pykeg.core import models
 
@@ -32,6 +34,20 @@ class DrinkPostForm(forms.Form):
   spilled = forms.BooleanField(required=False)
   shout = forms.CharField(required=False)
 
+class BatchDrinkPostForm(DrinkPostForm):
+  """One drink of a post to /drinks/batch/"""
+  tap = forms.CharField()
+
+class BaseBatchFormSet(BaseFormSet):
+  def _construct_form(self, i, **kwargs):
+    # Every item posted is required, not only the first INITIAL_FORMS.
+    form = super(BaseBatchFormSet, self)._construct_form(i, **kwargs)
+    form.empty_permitted = False
+    return form
+
+DrinkBatchFormSet = formset_factory(BatchDrinkPostForm,
+    formset=BaseBatchFormSet, extra=0, max_num=1000)
+
 class CancelDrinkForm(forms.Form):
   """Form to handled posts to /cancel-drink/"""
   id = forms.IntegerField()
@@ -43,6 +59,19 @@ class ThermoPostForm(forms.Form):
   when = forms.IntegerField(required=False)
   now = forms.IntegerField(required=False)
 
+class BatchThermoPostForm(ThermoPostForm):
+  """One reading of a post to /thermo-logs/batch/"""
+  sensor = forms.CharField()
+
+ThermoBatchFormSet = formset_factory(BatchThermoPostForm,
+    formset=BaseBatchFormSet, extra=0, max_num=1000)
+
+class ThermoHistoryForm(forms.Form):
+  """Range of a thermo sensor history request, as Unix times."""
+  start = forms.IntegerField(required=False)
+  end = forms.IntegerField(required=False)
+  max_points = forms.IntegerField(required=False, min_value=1, max_value=5000)
+
 class CreateKegTapForm(forms.ModelForm):
   class Meta:
     model = models.KegTap
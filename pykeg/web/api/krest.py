@@ -236,6 +236,29 @@ class KrestClient:
       post_data['shout'] = shout
     return self.DoPOST(endpoint, post_data=post_data).object
 
+  def RecordDrinks(self, drinks):
+    """Records several drinks in one request.
+
+    `drinks` is a list of dicts of RecordDrink arguments.  Returns a result for
+    each, holding either 'drink' or 'errors'.
+    """
+    endpoint = '/drinks/batch'
+    post_data = {
+      'form-TOTAL_FORMS': len(drinks),
+      'form-INITIAL_FORMS': 0,
+    }
+    now = int(datetime.datetime.now().strftime('%s'))
+    for i, drink in enumerate(drinks):
+      prefix = 'form-%i-' % i
+      for k, v in drink.iteritems():
+        if k == 'tap_name':
+          k = 'tap'
+        elif k == 'pour_time' and v:
+          v = int(v.strftime('%s'))
+          post_data[prefix + 'now'] = now
+        post_data[prefix + k] = v
+    return self.DoPOST(endpoint, post_data=post_data).objects
+
   def CancelDrink(self, seqn, spilled=False):
     endpoint = '/cancel-drink'
     post_data = {
@@ -252,6 +275,27 @@ class KrestClient:
     # TODO(mikey): include post data
     return self.DoPOST(endpoint, post_data=post_data).object
 
+  def LogSensorReadings(self, readings):
+    """Records several sensor readings in one request.
+
+    `readings` is a list of (sensor_name, temperature, when) tuples.  Returns a
+    result for each, holding either 'log' or 'errors'.
+    """
+    endpoint = '/thermo-logs/batch'
+    post_data = {
+      'form-TOTAL_FORMS': len(readings),
+      'form-INITIAL_FORMS': 0,
+    }
+    now = int(datetime.datetime.now().strftime('%s'))
+    for i, (sensor_name, temperature, when) in enumerate(readings):
+      prefix = 'form-%i-' % i
+      post_data[prefix + 'sensor'] = sensor_name
+      post_data[prefix + 'temp_c'] = float(temperature)
+      if when:
+        post_data[prefix + 'when'] = int(when.strftime('%s'))
+        post_data[prefix + 'now'] = now
+    return self.DoPOST(endpoint, post_data=post_data).objects
+
   def TapStatus(self):
     """Gets the status of all taps."""
     return self.DoGET('taps').objects
@@ -27,8 +27,10 @@ urlpatterns = patterns('pykeg.web.api.views',
     url(r'^cancel-drink/?$', 'cancel_drink'),
     url(r'^debug/log/?$', 'debug_log'),
     url(r'^drinks/?$', 'all_drinks'),
+    url(r'^drinks/batch/?$', 'record_drinks'),
     url(r'^drinks/(?P<drink_id>\d+)/?$', 'get_drink'),
     url(r'^drinks/(?P<drink_id>\d+)/add-photo/?$', 'add_drink_photo'),
+    url(r'^drinks/(?P<drink_id>\d+)/status/?$', 'get_drink_status'),
     url(r'^sessions/?$', 'all_sessions'),
     url(r'^sessions/current/?$', 'current_session'),
     url(r'^sessions/(?P<session_id>\d+)/?$', 'get_session'),
@@ -39,15 +41,19 @@ urlpatterns = patterns('pykeg.web.api.views',
     url(r'^kegs/(?P<keg_id>\d+)/?$', 'get_keg'),
     url(r'^kegs/(?P<keg_id>\d+)/drinks/?$', 'get_keg_drinks'),
     url(r'^kegs/(?P<keg_id>\d+)/events/?$', 'get_keg_events'),
+    url(r'^kegs/(?P<keg_id>\d+)/forecast/?$', 'get_keg_forecast'),
     url(r'^kegs/(?P<keg_id>\d+)/sessions/?$', 'get_keg_sessions'),
     url(r'^kegs/(?P<keg_id>\d+)/stats/?$', 'get_keg_stats'),
     url(r'^login/?$', 'login'),
     url(r'^logout/?$', 'logout'),
     url(r'^taps/?$', 'all_taps'),
     url(r'^taps/(?P<tap_id>[\w\.]+)/?$', 'tap_detail'),
+    url(r'^thermo-logs/batch/?$', 'log_sensor_readings'),
     url(r'^thermo-sensors/?$', 'all_thermo_sensors'),
     url(r'^thermo-sensors/(?P<sensor_name>[^/]+)/?$', 'get_thermo_sensor'),
     url(r'^thermo-sensors/(?P<sensor_name>[^/]+)/logs/?$', 'get_thermo_sensor_logs'),
+    url(r'^thermo-sensors/(?P<sensor_name>[^/]+)/history/?$',
+        'get_thermo_sensor_history'),
     url(r'^new-user/?$', 'register'),
     url(r'^users/?$', 'user_list'),
     url(r'^users/(?P<username>[\w@.+-_]+)/drinks/?$', 'get_user_drinks'),
@@ -123,11 +123,29 @@ def to_json_error(e, exc_info):
   }
   return result, http_code
 
+class RawJson(object):
+  """JSON text which build_response() splices into a response as-is."""
+  def __init__(self, text):
+    self.text = text
+
 def build_response(result_data, response_code=200):
-  """Builds an HTTP response for JSON data."""
+  """Builds an HTTP response for JSON data.
+
+  Top-level values of `result_data` may be RawJson, which is not re-encoded.
+  """
   indent = 2
-  return HttpResponse(kbjson.dumps(result_data, indent=indent),
-      mimetype='application/json', status=response_code)
+  raw = {}
+  if isinstance(result_data, dict):
+    result_data = result_data.copy()
+    for key, value in result_data.iteritems():
+      if isinstance(value, RawJson):
+        placeholder = '__raw_json_%i__' % id(value)
+        raw['"%s"' % placeholder] = value.text
+        result_data[key] = placeholder
+  body = kbjson.dumps(result_data, indent=indent)
+  for placeholder, text in raw.iteritems():
+    body = body.replace(placeholder, text, 1)
+  return HttpResponse(body, mimetype='application/json', status=response_code)
 
 def wrap_exception(request, exception):
   """Returns a HttpResponse with the exception in JSON form."""
@@ -31,6 +31,7 @@ from django.conf import settings
 from django.contrib.auth import login as auth_login
 from django.contrib.auth import logout as auth_logout
 from django.contrib.auth.forms import AuthenticationForm
+from django.db import transaction
 from django.db.utils import IntegrityError
 
 from django.http import Http404
@@ -92,7 +93,7 @@ def prepare_data(data, inner=False):
   if isinstance(data, QuerySet) or type(data) == types.ListType:
     result = [prepare_data(d, True) for d in data]
     container = 'objects'
-  elif isinstance(data, dict):
+  elif isinstance(data, (dict, util.RawJson)):
     result = data
     container = 'object'
   else:
@@ -107,12 +108,69 @@ def prepare_data(data, inner=False):
     }
 
 def to_dict(data):
+  obj = data
   if not isinstance(data, Message):
     data = protolib.ToProto(data, full=True)
-  return protoutil.ProtoMessageToDict(data)
+  result = protoutil.ProtoMessageToDict(data)
+  # The Keg message has no forecast fields; add them to keg dicts here.
+  if isinstance(obj, models.Keg):
+    _add_keg_forecast(obj, result)
+  elif isinstance(obj, models.KegTap) and 'current_keg' in result:
+    _add_keg_forecast(obj.current_keg, result['current_keg'])
+  return result
 
 ### Helpers
 
+def _stats_result(record):
+  """Returns the stored stats of `record`, without re-encoding them."""
+  if not record:
+    return {}
+  return util.RawJson(record.StatsJson())
+
+def _keg_forecast(keg):
+  rate = keg.ConsumptionRate()
+  empty_time = keg.PredictedEmptyTime()
+  return {
+    'consumption_ml_per_hour': rate,
+    'predicted_empty_time': empty_time and protolib.datestr(empty_time),
+  }
+
+def _add_keg_forecast(keg, result):
+  for k, v in _keg_forecast(keg).iteritems():
+    if v is not None:
+      result[k] = v
+
+def _drink_args(cd):
+  """Returns RecordDrink arguments for a valid DrinkPostForm."""
+  if cd.get('pour_time') and cd.get('now'):
+    pour_time = datetime.datetime.fromtimestamp(cd.get('pour_time'))
+    now = datetime.datetime.fromtimestamp(cd.get('now'))
+    skew = datetime.datetime.now() - now
+    pour_time += skew
+  else:
+    pour_time = None
+  duration = cd.get('duration')
+  if duration is None:
+    duration = 0
+  return {
+    'ticks': cd['ticks'],
+    'volume_ml': cd.get('volume_ml'),
+    'username': cd.get('username'),
+    'pour_time': pour_time,
+    'duration': duration,
+    'auth_token': cd.get('auth_token'),
+    'spilled': cd.get('spilled'),
+    'shout': cd.get('shout'),
+  }
+
+def _reading_time(cd):
+  """Returns the time of a valid ThermoPostForm's reading, or None for now."""
+  if cd.get('when') and cd.get('now'):
+    when = datetime.datetime.fromtimestamp(cd['when'])
+    now = datetime.datetime.fromtimestamp(cd['now'])
+    return when + (datetime.datetime.now() - now)
+  return None
+
 def _form_errors(form):
   ret = {}
   for field in form:
@@ -148,6 +206,37 @@ def get_drink(request, drink_id):
   drink = get_object_or_404(models.Drink, seqn=drink_id, site=request.kbsite)
   return protolib.ToProto(drink, full=True)
 
+# Longest wait allowed by get_drink_status.
+MAX_STATUS_WAIT_SECONDS = 10
+
+@api_view
+def get_drink_status(request, drink_id):
+  """Reports whether stats and events include a drink yet.
+
+  With a `wait` parameter, waits up to that many seconds for them to.
+  """
+  drink = get_object_or_404(models.Drink, seqn=drink_id, site=request.kbsite)
+  wait = 0
+  if 'wait' in request.GET:
+    try:
+      wait = min(float(request.GET['wait']), MAX_STATUS_WAIT_SECONDS)
+    except ValueError:
+      raise kbapi.BadRequestError('Bad value for "wait"')
+  b = KegbotBackend(site=request.kbsite)
+  return {
+    'id': drink.seqn,
+    'postprocessed': b.WaitForPostProcess(drink.seqn, timeout=wait,
+        refresh=_end_read_transaction),
+  }
+
+def _end_read_transaction():
+  # This view only reads, so its transaction can be ended while polling: the
+  # worker's commit is only visible to a new one under REPEATABLE READ.
+  if transaction.is_managed():
+    transaction.commit()
+  else:
+    transaction.commit_unless_managed()
+
 @csrf_exempt
 @api_view
 @auth_required
@@ -176,12 +265,12 @@ def get_session(request, session_id):
 def get_session_stats(request, session_id):
   session = get_object_or_404(models.DrinkingSession, seqn=session_id,
       site=request.kbsite)
-  return session.GetStats()
+  return _stats_result(session.GetStatsRecord())
 
 @api_view
 def get_keg(request, keg_id):
   keg = get_object_or_404(models.Keg, seqn=keg_id, site=request.kbsite)
-  return protolib.ToProto(keg, full=True)
+  return keg
 
 @api_view
 def get_keg_drinks(request, keg_id):
@@ -237,14 +326,22 @@ def get_keg_sessions(request, keg_id):
   sessions = [c.session for c in keg.keg_session_chunks.all()]
   return sessions
 
+@api_view
+def get_keg_forecast(request, keg_id):
+  keg = get_object_or_404(models.Keg, seqn=keg_id, site=request.kbsite)
+  result = _keg_forecast(keg)
+  result['id'] = keg.seqn
+  result['volume_ml_remain'] = float(keg.remaining_volume())
+  return result
+
 @api_view
 def get_keg_stats(request, keg_id):
   keg = get_object_or_404(models.Keg, seqn=keg_id, site=request.kbsite)
-  return keg.GetStatsRecord()
+  return _stats_result(keg.GetStatsRecord())
 
 @api_view
 def get_system_stats(request):
-  return request.kbsite.GetStatsRecord()
+  return _stats_result(request.kbsite.GetStatsRecord())
 
 @api_view
 def all_taps(request):
@@ -273,7 +370,7 @@ def get_user_events(request, username):
 @api_view
 def get_user_stats(request, username):
   user = get_object_or_404(models.User, username=username)
-  return user.get_profile().GetStatsRecord()
+  return _stats_result(user.get_profile().GetStatsRecord())
 
 @api_view
 @auth_required
@@ -336,13 +433,13 @@ def get_thermo_sensor(request, sensor_name):
 @api_view
 def _thermo_sensor_get(request, sensor_name):
   sensor = _get_sensor_or_404(request, sensor_name)
-  logs = sensor.thermolog_set.all()
-  if not logs:
+  log = sensor.LastLog()
+  if not log:
     last_temp = None
     last_time = None
   else:
-    last_temp = logs[0].temp
-    last_time = logs[0].time
+    last_temp = log.temp
+    last_time = log.time
   res = {
     'sensor': to_dict(sensor),
     'last_temp': last_temp,
@@ -358,15 +455,71 @@ def _thermo_sensor_post(request, sensor_name):
     raise kbapi.BadRequestError, _form_errors(form)
   cd = form.cleaned_data
   b = KegbotBackend(site=request.kbsite)
-  sensor, created = models.ThermoSensor.objects.get_or_create(site=request.kbsite,
-      raw_name=sensor_name)
-  # TODO(mikey): use form fields to compute `when`
-  return b.LogSensorReading(sensor.raw_name, cd['temp_c'])
+  try:
+    return b.LogSensorReading(sensor_name, cd['temp_c'], _reading_time(cd))
+  except ValueError, e:
+    raise kbapi.BadRequestError(str(e))
+
+@csrf_exempt
+@api_view
+@auth_required
+def log_sensor_readings(request):
+  """Records a batch of readings, posted as a formset of BatchThermoPostForms.
+
+  The result has an entry per posted reading, holding either the reading or
+  its errors.
+  """
+  if request.method != 'POST':
+    raise kbapi.BadRequestError('POST required.')
+  formset = forms.ThermoBatchFormSet(request.POST)
+  if not formset.management_form.is_valid():
+    raise kbapi.BadRequestError(_form_errors(formset.management_form))
+  formset.is_valid()
+
+  readings = []
+  for form in formset.forms:
+    if form.is_valid():
+      cd = form.cleaned_data
+      readings.append((cd['sensor'], cd['temp_c'], _reading_time(cd)))
+  results = iter(KegbotBackend(site=request.kbsite).LogSensorReadings(readings))
+
+  ret = []
+  for form in formset.forms:
+    if not form.is_valid():
+      ret.append({'errors': _form_errors(form)})
+      continue
+    res = results.next()
+    if isinstance(res, ValueError):
+      ret.append({'errors': {form['temp_c'].html_name: [str(res)]}})
+    else:
+      ret.append({'log': to_dict(res)})
+  return ret
 
 @api_view
 def get_thermo_sensor_logs(request, sensor_name):
   sensor = _get_sensor_or_404(request, sensor_name)
-  return sensor.thermolog_set.all()[:60*2]
+  return sensor.RecentLogs(60*2)
+
+@api_view
+def get_thermo_sensor_history(request, sensor_name):
+  sensor = _get_sensor_or_404(request, sensor_name)
+  form = forms.ThermoHistoryForm(request.GET)
+  if not form.is_valid():
+    raise kbapi.BadRequestError, _form_errors(form)
+  cd = form.cleaned_data
+  if cd.get('start'):
+    start = datetime.datetime.fromtimestamp(cd['start'])
+  else:
+    start = datetime.datetime.now() - datetime.timedelta(hours=24)
+  end = None
+  if cd.get('end'):
+    end = datetime.datetime.fromtimestamp(cd['end'])
+  max_points = cd.get('max_points') or models.DEFAULT_HISTORY_POINTS
+  period, records = sensor.History(start, end, max_points)
+  return {
+    'period': period or 'minute',
+    'objects': [to_dict(r) for r in records],
+  }
 
 @api_view
 def get_api_key(request):
@@ -394,32 +547,51 @@ def _tap_detail_post(request, tap):
   form = forms.DrinkPostForm(request.POST)
   if not form.is_valid():
     raise kbapi.BadRequestError, _form_errors(form)
-  cd = form.cleaned_data
-  if cd.get('pour_time') and cd.get('now'):
-    pour_time = datetime.datetime.fromtimestamp(cd.get('pour_time'))
-    now = datetime.datetime.fromtimestamp(cd.get('now'))
-    skew = datetime.datetime.now() - now
-    pour_time += skew
-  else:
-    pour_time = None
-  duration = cd.get('duration')
-  if duration is None:
-    duration = 0
   b = KegbotBackend(site=request.kbsite)
   try:
-    res = b.RecordDrink(tap_name=tap,
-      ticks=cd['ticks'],
-      volume_ml=cd.get('volume_ml'),
-      username=cd.get('username'),
-      pour_time=pour_time,
-      duration=duration,
-      auth_token=cd.get('auth_token'),
-      spilled=cd.get('spilled'),
-      shout=cd.get('shout'))
+    res = b.RecordDrink(tap_name=tap, **_drink_args(form.cleaned_data))
     return protolib.ToProto(res, full=True)
   except backend.BackendError, e:
     raise kbapi.ServerError(str(e))
 
+@csrf_exempt
+@api_view
+@auth_required
+def record_drinks(request):
+  """Records a batch of drinks, posted as a formset of DrinkPostForms.
+
+  The result has an entry per posted drink, holding either the drink or its
+  errors.
+  """
+  if request.method != 'POST':
+    raise kbapi.BadRequestError('POST required.')
+  formset = forms.DrinkBatchFormSet(request.POST)
+  if not formset.management_form.is_valid():
+    raise kbapi.BadRequestError(_form_errors(formset.management_form))
+  formset.is_valid()
+
+  batch = []
+  for form in formset.forms:
+    if form.is_valid():
+      args = _drink_args(form.cleaned_data)
+      args['tap_name'] = form.cleaned_data['tap']
+      batch.append(args)
+  results = iter(KegbotBackend(site=request.kbsite).RecordDrinks(batch))
+
+  ret = []
+  for form in formset.forms:
+    if not form.is_valid():
+      ret.append({'errors': _form_errors(form)})
+      continue
+    res = results.next()
+    if isinstance(res, backend.BackendError):
+      ret.append({'errors': {'__all__': [str(res)]}})
+    elif res is None:
+      ret.append({})
+    else:
+      ret.append({'drink': to_dict(res)})
+  return ret
+
 @csrf_exempt
 @api_view
 @auth_required
@@ -0,0 +1,103 @@
+# Copyright 2013 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unittests for pykeg.web.api"""
+
+import json
+import unittest
+
+from django.test.client import Client
+
+from kegbot.api.protoutil import ProtoMessageToDict
+
+from pykeg.core import models
+from pykeg.core.backend.django import KegbotBackend
+from pykeg.proto import protolib
+from pykeg.web.api import util
+
+class BuildResponseTestCase(unittest.TestCase):
+  def testRawJson(self):
+    text = '{"volume_by_year": [{"year": 2013, "volume_ml": 1.5}]}'
+    response = util.build_response({'object': util.RawJson(text),
+        'meta': {'result': 'ok'}})
+    self.assertTrue(text in response.content)
+    self.assertEqual(json.loads(response.content), {
+      'object': {'volume_by_year': [{'year': 2013, 'volume_ml': 1.5}]},
+      'meta': {'result': 'ok'},
+    })
+
+
+class StatsViewTestCase(unittest.TestCase):
+  def setUp(self):
+    models.KegbotSite.objects.filter(name='default').delete()
+    self.site, created = models.KegbotSite.objects.get_or_create(name='default')
+    self.client = Client()
+
+  def tearDown(self):
+    self.site.delete()
+
+  def getStats(self):
+    response = self.client.get('/api/stats')
+    self.assertEqual(response.status_code, 200)
+    return response
+
+  def testSystemStats(self):
+    stats = {
+      'total_pours': 2,
+      'total_volume_ml': 350.0,
+      'volume_by_drinker': [{'username': 'user1', 'volume_ml': 350.0}],
+    }
+    record = models.SystemStats.objects.create(site=self.site, stats=stats)
+    response = self.getStats()
+    self.assertTrue(record.StatsJson() in response.content)
+    self.assertEqual(json.loads(response.content)['object'], stats)
+
+    # Keys outside models_pb2.Stats are not stored, as by the protolib round
+    # trip.
+    record.stats = dict(stats, plugin_stat={'a': 1},
+        volume_by_drinker=[{'username': 'user1', 'volume_ml': 350.0,
+            'extra': True}])
+    record.save()
+    record = models.SystemStats.objects.get(pk=record.pk)
+    self.assertEqual(record.stats, stats)
+    self.assertEqual(ProtoMessageToDict(protolib.ToProto(record)), stats)
+    self.assertEqual(json.loads(self.getStats().content)['object'], stats)
+
+
+class DrinkStatusViewTestCase(unittest.TestCase):
+  def setUp(self):
+    models.KegbotSite.objects.filter(name='default').delete()
+    self.site, created = models.KegbotSite.objects.get_or_create(name='default')
+    self.backend = KegbotBackend(site=self.site)
+    self.backend.CreateTap('Test Tap', 'test', ml_per_tick=1.0)
+    self.client = Client()
+
+  def tearDown(self):
+    self.site.delete()
+
+  def testWait(self):
+    d = self.backend.RecordDrink('test', ticks=100, do_postprocess=False)
+    response = self.client.get('/api/drinks/%i/status?wait=0.2' % d.seqn)
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(json.loads(response.content)['object'],
+        {'id': d.seqn, 'postprocessed': False})
+
+    d.PostProcess()
+    response = self.client.get('/api/drinks/%i/status?wait=0.2' % d.seqn)
+    self.assertEqual(json.loads(response.content)['object'],
+        {'id': d.seqn, 'postprocessed': True})
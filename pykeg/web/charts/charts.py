@@ -20,51 +20,69 @@ import datetime
 
 from kegbot.util import units
 
+from pykeg.core import downsample
 from pykeg.core import models
 
+# Default range and size of TemperatureSensorChart.
+SENSOR_HOURS = 6
+DEFAULT_SENSOR_POINTS = 120
+
+# Records fetched per point drawn, for the downsampler to choose from.
+OVERSAMPLE = 4
+
+# A gap of more than this many periods between records breaks the line.
+GAP_STEPS = 2
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+def _Millis(time):
+  """Returns `time` as Highcharts milliseconds, leaving it in local time."""
+  delta = time - EPOCH
+  return (delta.days * 86400 + delta.seconds) * 1000 + delta.microseconds // 1000
+
 def to_pints(volume):
   return float(units.Quantity(volume).InPints())
 
 class ChartError(Exception):
   """Base chart exception."""
 
-def TemperatureSensorChart(sensor):
+def TemperatureSensorChart(sensor, start=None, end=None,
+    max_points=DEFAULT_SENSOR_POINTS):
   """ Shows a simple line plot of a specific temperature sensor.
 
   Syntax:
     {% chart sensor <sensorname> width height %}
   Args:
     sensorname - the nice_name of a ThermoSensor
+
+  Readings from `start` (default: SENSOR_HOURS ago) to `end` (default: now) are
+  fetched at OVERSAMPLE times `max_points`, and downsampled to `max_points`.
   """
   if not isinstance(sensor, models.ThermoSensor):
     raise ChartError('Bad sensor given')
 
-  hours = 6
-  now = datetime.datetime.now()
-  start = now - (datetime.timedelta(hours=hours))
-  start = start - (datetime.timedelta(seconds=start.second))
-
-  points = sensor.thermolog_set.filter(time__gte=start).order_by('time')
-
-  curr = start
-  temps = []
-  have_temps = False
-  for point in points:
-    while curr <= point.time:
-      curr += datetime.timedelta(minutes=1)
-      if curr < point.time:
-        temps.append(None)
-      else:
-        temps.append(point.temp)
-        have_temps = True
-
-  if not have_temps:
+  if start is None:
+    start = datetime.datetime.now() - datetime.timedelta(hours=SENSOR_HOURS)
+  start = start.replace(second=0, microsecond=0)
+
+  period, records = sensor.History(start, end, max_points * OVERSAMPLE)
+  if period:
+    step = dict(models.ThermoSummaryLog.PERIODS)[period]
+    temps = [r.mean_temp for r in records]
+  else:
+    step = models.RAW_PERIOD
+    temps = [r.temp for r in records]
+  if not temps:
     raise ChartError('Not enough data')
 
+  times = [_Millis(r.time) for r in records]
+  max_gap = GAP_STEPS * _Millis(EPOCH + step)
+  points = downsample.Downsample(times, temps, max_points, max_gap)
+
   res = {
     'series': [
       {
-        'data': temps,
+        'data': [list(p) for p in points],
         'marker': {
           'enabled': False,
         },
@@ -74,11 +92,10 @@ def TemperatureSensorChart(sensor):
       'enabled': False,
     },
     'xAxis': {
-      'categories': ['Temperature'],
+      'type': 'datetime',
       'labels': {
         'enabled': False,
       },
-      'tickInterval': 0,
     },
     'yAxis': {
       'labels': {
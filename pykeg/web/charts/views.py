@@ -18,9 +18,15 @@
 
 """Chart AJAX views."""
 
+import datetime
+
 from django.shortcuts import get_object_or_404
 
+from kegbot.api import kbapi
+
 from pykeg.core import models
+from pykeg.web.api import forms
+from pykeg.web.api.views import _form_errors
 from pykeg.web.api.views import api_view
 from pykeg.web.charts import charts
 
@@ -28,7 +34,18 @@ from pykeg.web.charts import charts
 def temperature_sensor_history(request, nice_name):
   sensor = get_object_or_404(models.ThermoSensor, nice_name=nice_name,
       site=request.kbsite)
-  return charts.TemperatureSensorChart(sensor)
+  form = forms.ThermoHistoryForm(request.GET)
+  if not form.is_valid():
+    raise kbapi.BadRequestError, _form_errors(form)
+  cd = form.cleaned_data
+  kwargs = {}
+  if cd.get('start'):
+    kwargs['start'] = datetime.datetime.fromtimestamp(cd['start'])
+  if cd.get('end'):
+    kwargs['end'] = datetime.datetime.fromtimestamp(cd['end'])
+  if cd.get('max_points'):
+    kwargs['max_points'] = cd['max_points']
+  return charts.TemperatureSensorChart(sensor, **kwargs)
 
 @api_view
 def keg_volume(request, keg_id):
@@ -18,6 +18,7 @@
 
 from pykeg import EPOCH
 
+from pykeg.core import commit_hooks
 from pykeg.core import models
 from pykeg.web.api import util as apiutil
 
@@ -49,6 +50,24 @@ def _path_allowed(path, kbsite):
   return False
 
 
+class CommitHooksMiddleware:
+  """Runs calls deferred by commit_hooks.Add() once the request's transaction
+  has been committed.
+
+  Must come before TransactionMiddleware, so that its process_response runs
+  after the commit.
+  """
+  def process_request(self, request):
+    commit_hooks.Discard()
+
+  def process_response(self, request, response):
+    commit_hooks.Run()
+    return response
+
+  def process_exception(self, request, exception):
+    commit_hooks.Discard()
+
+
 class KegbotSiteMiddleware:
   ALLOWED_VIEW_MODULE_PREFIXES = (
       'pykeg.web.setup_wizard.',
@@ -21,13 +21,18 @@
 from kegbot.util import util
 from kegbot.util import kbjson
 
+from pykeg.core import models
 from pykeg.proto import protolib
 
 from pykeg.connections import tasks as connection_tasks
 
+import datetime
 from urllib import urlencode
 import urllib2
 
+from django.conf import settings
+
+from celery.decorators import periodic_task
 from celery.decorators import task
 
 @task
@@ -55,6 +60,33 @@ def handle_new_events(site, event_list):
 
   return True
 
+@task
+def postprocess_drinks(site):
+  """Post-processes all pending drinks of a site.
+
+  Each run handles every drink pending at the time, so a burst of pours costs
+  one stats update per affected record; later runs find nothing to do.
+  """
+  event_list = models.Drink.PostProcessPending(site)
+  if event_list:
+    handle_new_events.delay(site, event_list)
+  return True
+
+@periodic_task(run_every=datetime.timedelta(minutes=1))
+def postprocess_pending():
+  """Post-processes drinks left pending, eg when the task queued for them ran
+  before they were committed, or was lost."""
+  if not settings.KEGBOT_ASYNC_POSTPROCESS:
+    return False
+  for site in models.KegbotSite.objects.all():
+    postprocess_drinks(site)
+  return True
+
+@periodic_task(run_every=datetime.timedelta(hours=1))
+def purge_thermologs():
+  """Deletes temperature readings older than Thermolog.KEEP_TIME."""
+  return models.Thermolog.PurgeOld()
+
 @task
 def handle_new_picture(picture_id):
   connection_tasks.handle_new_picture.delay(picture_id)